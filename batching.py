@@ -0,0 +1,160 @@
+"""Digest emails for repositories with bursty pushes."""
+
+import fnmatch
+import threading
+
+
+def parse_digest_rules(value, default_window=60.0):
+    """Returns list of (repo_pattern, window_seconds) tuples from a comma
+    separated config value like "org/bot-repo=30,org/docs-*"."""
+    rules = []
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' in item:
+            pattern, window = item.split('=', 1)
+            rules.append((pattern.strip(), float(window)))
+        else:
+            rules.append((item, float(default_window)))
+    return rules
+
+
+def window_for(rules, repo):
+    """Returns digest window in seconds of the first rule matching repo, or
+    None if pushes to repo are not digested."""
+    for pattern, window in rules:
+        if fnmatch.fnmatchcase(repo, pattern):
+            return window
+    return None
+
+
+def digest_group(msg_info):
+    """Returns the group a push is digested with: pushes to the same repo and
+    branch, so that a digest is routed like each of its pushes."""
+    return u'{0}:{1}'.format(msg_info['repo'], msg_info['branch'])
+
+
+def make_digest(msg_infos):
+    """Returns single message info that summarizes several pushes to the same
+    repo and branch. Uses the same fields as the message info of a single
+    push, plus "subject". Spool ids of the pushes, if any, are carried over
+    so they can be acked once the digest is sent, dedup keys so they can be
+    forgotten if it fails, and delivery ids so they are logged.
+    """
+    if len(msg_infos) == 1:
+        return msg_infos[0]
+
+    first = msg_infos[0]
+    branches = _unique(m['branch'] for m in msg_infos)
+    pushers = _unique(m['pusher'] for m in msg_infos)
+    changed_files = _unique(
+        line
+        for m in msg_infos
+        for line in m['changed_files'].splitlines())
+
+    messages = []
+    for m in msg_infos:
+        messages.append(u'{revision} on {branch} by {pusher}:\n\n{message}'
+                        .format(**m).rstrip())
+
+    digest = {
+        'repo': first['repo'],
+        'subject': u'[{0}] {1}'.format(
+            first['repo'],
+            u'{0} pushes to {1}'.format(len(msg_infos),
+                                        ', '.join(branches))[:50]),
+        'branch': ', '.join(branches),
+        'revision': ', '.join(m['revision'] for m in msg_infos),
+        'message': '\n\n'.join(messages),
+        'changed_files': '\n'.join(changed_files),
+        'pusher': ', '.join(pushers),
+        'pusher_email': first['pusher_email'],
+        'compare_url': '\n'.join(m['compare_url'] for m in msg_infos),
+    }
+    spool_ids = [i for m in msg_infos for i in m.get('spool_ids', [])]
+    if spool_ids:
+        digest['spool_ids'] = spool_ids
+    dedup_keys = [k for m in msg_infos for k in m.get('dedup_keys', [])]
+    if dedup_keys:
+        digest['dedup_keys'] = dedup_keys
+    delivery_ids = [m['delivery_id'] for m in msg_infos
+                    if 'delivery_id' in m]
+    if delivery_ids:
+        digest['delivery_id'] = ','.join(delivery_ids)
+    return digest
+
+
+def _unique(items):
+    """Returns list of items without duplicates, keeping first occurrence
+    order."""
+    seen = set()
+    result = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            result.append(item)
+    return result
+
+
+class DigestBuffer(object):
+    """Holds pushes to matching repos and merges them into one email per
+    branch.
+
+    The first push to a branch starts a timer for the window of its repo;
+    when it expires, or `max_messages` pushes are held, everything held for
+    the branch is passed to `flush_func` as a single digest message. Pushes
+    to repos that match no rule are never held.
+    """
+
+    def __init__(self, flush_func, rules, max_messages=50):
+        self._flush_func = flush_func
+        self._rules = rules
+        self._max_messages = max_messages
+        self._lock = threading.Lock()
+        self._held = {}
+        self._timers = {}
+
+    def window_for(self, repo):
+        """Returns digest window in seconds for repo, or None if pushes to
+        repo are not digested."""
+        return window_for(self._rules, repo)
+
+    def add(self, msg_info):
+        """Hold message for digest. Returns False, without holding it, if the
+        message's repo is not digested."""
+        window = self.window_for(msg_info['repo'])
+        if window is None:
+            return False
+
+        group = digest_group(msg_info)
+        with self._lock:
+            held = self._held.setdefault(group, [])
+            held.append(msg_info)
+            full = len(held) >= self._max_messages
+            if not full and group not in self._timers:
+                timer = threading.Timer(window, self.flush, args=(group,))
+                timer.daemon = True
+                self._timers[group] = timer
+                timer.start()
+
+        if full:
+            self.flush(group)
+        return True
+
+    def flush(self, group):
+        """Send digest of everything held for group, see digest_group()."""
+        with self._lock:
+            held = self._held.pop(group, None)
+            timer = self._timers.pop(group, None)
+        if timer is not None:
+            timer.cancel()
+        if held:
+            self._flush_func(make_digest(held))
+
+    def flush_all(self):
+        """Send all digests, e.g. before shutting down."""
+        with self._lock:
+            groups = list(self._held)
+        for group in groups:
+            self.flush(group)
@@ -0,0 +1,156 @@
+"""Stress test the emailer app with many concurrent web hooks per worker.
+
+Usage: python benchmarks/bench_concurrency.py [--worker-classes sync,gthread,
+           gevent] [--concurrency 128] [--requests 1000]
+           [--smtp-latency 20] [--pool-size 16]
+
+Runs emailer:app under gunicorn with one worker of each worker class, where
+gthread and gevent workers serve up to `concurrency` requests at once, and
+fires `requests` signed pushes at it from `concurrency` client threads. Each
+email is sent while the web hook is handled, to a local SMTP sink that waits
+`smtp-latency` milliseconds per message.
+
+Reports throughput, latency percentiles and errors, and checks every email
+the sink received: each push must be emailed exactly once, with the subject
+and body of that push. Two requests sending on the same SMTP connection at
+once would garble or mix up their messages, or lose them.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import os
+import os.path
+import re
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_load  # noqa
+import smtp_sink  # noqa
+
+_SUBJECT_RE = re.compile(r'^Subject: .*Push (\d+) body\r?$', re.MULTILINE)
+_BODY_RE = re.compile(r'^Push (\d+)\r?$', re.MULTILINE)
+
+
+def make_push(seq):
+    """Returns JSON push event body whose subject and body name `seq`."""
+    commit = {
+        'id': '{0:040x}'.format(seq + 1),
+        'message': 'Push {0}\n\nPush {0} body\n'.format(seq),
+        'added': [],
+        'removed': [],
+        'modified': ['README.md'],
+        'author': {'name': 'someone', 'email': 'someone@example.com'},
+    }
+    return json.dumps({
+        'ref': 'refs/heads/master',
+        'deleted': False,
+        'compare': 'https://github.com/chapel-lang/chapel/compare/a...b',
+        'repository': {'full_name': 'chapel-lang/chapel'},
+        'pusher': {'name': 'someone', 'email': 'someone@example.com'},
+        'head_commit': commit,
+        'commits': [commit],
+    })
+
+
+def check_messages(messages, requests):
+    """Returns list of problems with the emails received by the sink."""
+    problems = []
+    counts = collections.Counter()
+    for connection, data in messages:
+        subjects = _SUBJECT_RE.findall(data)
+        bodies = _BODY_RE.findall(data)
+        if len(subjects) != 1 or subjects != bodies:
+            problems.append('garbled message on connection {0}: subjects '
+                            '{1}, bodies {2}'.format(connection, subjects,
+                                                     bodies))
+            continue
+        counts[int(subjects[0])] += 1
+    for seq in range(requests):
+        if counts[seq] != 1:
+            problems.append('push {0} emailed {1} times'.format(
+                seq, counts[seq]))
+    return problems
+
+
+def run(worker_class, concurrency, requests, smtp_latency, pool_size):
+    sink = smtp_sink.SMTPSink(latency=smtp_latency, keep=True)
+    sink.start()
+    args = []
+    if worker_class == 'gthread':
+        args = ['--threads', str(concurrency)]
+    elif worker_class == 'gevent':
+        args = ['--worker-connections', str(concurrency)]
+    app = bench_load.App(sink.port, 1, worker_class, {
+        'GITHUB_COMMIT_EMAILER_SMTP_POOL_SIZE': str(pool_size),
+        'GITHUB_COMMIT_EMAILER_LOG_LEVEL': 'WARNING',
+    }, args=args + ['--timeout', '120'])
+    bodies = [make_push(i) for i in range(requests)]
+    pending = collections.deque(range(requests))
+    results = []
+
+    def client():
+        while True:
+            try:
+                seq = pending.popleft()
+            except IndexError:
+                return
+            results.append(bench_load.post_push(app.port, bodies[seq]))
+
+    try:
+        app.wait_ready()
+        threads = [threading.Thread(target=client)
+                   for _ in range(concurrency)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+    finally:
+        app.stop()
+        sink.shutdown()
+        sink.server_close()
+
+    latencies = sorted(seconds for _, seconds in results)
+    errors = sum(1 for status, _ in results if status != 200)
+    problems = check_messages(sink.messages, requests)
+    print('{0:<8} concurrency={1} req/s={2:7.1f} p50={3:7.1f}ms '
+          'p99={4:7.1f}ms errors={5} sent={6} connections={7} '
+          'problems={8}'.format(
+              worker_class, concurrency, len(results) / elapsed,
+              bench_load._percentile(latencies, 50) * 1000,
+              bench_load._percentile(latencies, 99) * 1000, errors,
+              len(sink.messages), sink.stats.as_dict()['connections'],
+              len(problems)))
+    for problem in problems[:10]:
+        print('  ' + problem)
+    return not problems and not errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--worker-classes', default='sync,gthread,gevent')
+    parser.add_argument('--concurrency', type=int, default=128)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--smtp-latency', type=float, default=20,
+                        help='milliseconds the sink waits before accepting '
+                        'each message')
+    parser.add_argument('--pool-size', type=int, default=16,
+                        help='SMTP connections per worker')
+    args = parser.parse_args()
+
+    ok = True
+    for worker_class in args.worker_classes.split(','):
+        ok = run(worker_class, args.concurrency, args.requests,
+                 args.smtp_latency / 1000.0, args.pool_size) and ok
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Measure requests per second of web hooks the emailer rejects.
+
+Usage: python benchmarks/bench_fastpath.py [--seconds 2]
+
+Calls the emailer WSGI app in-process, with and without the fast path
+middleware in front of flask, for events that are not emailed, unknown
+paths, and bodies over the max size. Logging is disabled, so only the cost
+of handling the request is measured.
+"""
+
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import flask  # noqa
+import werkzeug.test  # noqa
+
+import emailer  # noqa
+
+CASES = [
+    ('ping', dict(path='/commit-email', method='POST', data='{"zen": 1}',
+                  headers={'X-GitHub-Event': 'ping'})),
+    ('issues', dict(path='/commit-email', method='POST', data='x' * 4096,
+                    headers={'X-GitHub-Event': 'issues'})),
+    ('not_found', dict(path='/wp-login.php', method='GET')),
+    ('too_large', dict(path='/commit-email', method='POST',
+                       headers={'X-GitHub-Event': 'push'},
+                       environ_overrides={
+                           'CONTENT_LENGTH': str(100 * 1024 * 1024)})),
+]
+
+
+def _start_response(status, headers, exc_info=None):
+    pass
+
+
+def bench(name, app, kwargs, seconds):
+    builder = werkzeug.test.EnvironBuilder(**kwargs)
+    template = builder.get_environ()
+    body = template['wsgi.input'].read()
+    count = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        for _ in range(100):
+            environ = dict(template)
+            environ['wsgi.input'] = werkzeug.test.BytesIO(body)
+            for _ in app(environ, _start_response):
+                pass
+        count += 100
+    total = time.time() - start
+    return count / total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=2)
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    emailer.app.config['TESTING'] = True
+
+    def flask_only(environ, start_response):
+        return flask.Flask.wsgi_app(emailer.app, environ, start_response)
+
+    for name, kwargs in CASES:
+        before = bench(name, flask_only, kwargs, args.seconds)
+        after = bench(name, emailer.app, kwargs, args.seconds)
+        print('{0:<10} flask={1:8.0f} req/s  fast path={2:8.0f} req/s  '
+              'x{3:.1f}'.format(name, before, after, after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,367 @@
+"""Load test the emailer app under gunicorn against a local SMTP sink.
+
+Usage: python benchmarks/bench_load.py [--sizes 1,64,1024]
+           [--concurrency 1,4,16] [--requests 200] [--workers 2]
+           [--smtp-latency MS] [--smtp-fail-rate 0.0]
+           [--env NAME=VALUE ...] [--output results.json]
+           [--compare baseline.json]
+
+Sizes are in KB. For each (size, concurrency) pair, fires `requests` signed
+synthetic push events at emailer:app and reports throughput, latency
+percentiles, error rate, emails accepted by the sink and peak RSS of the
+gunicorn master and workers. Every push has a new head commit and delivery
+id, so dedup does not skip any.
+
+The app runs with the config given by --env on top of a minimal one, e.g.
+`--env GITHUB_COMMIT_EMAILER_SEND_WORKERS=4` to measure background delivery.
+Results are written as JSON to --output, and --compare prints the change in
+throughput and p99 latency against an earlier results file.
+"""
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import hmac
+import httplib
+import json
+import os
+import os.path
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import smtp_sink  # noqa
+
+SECRET = 'bench-secret'
+
+
+def make_push(size, seq):
+    """Returns JSON push event body of roughly `size` bytes, with a head
+    commit unique to `seq`."""
+    files = ['compiler/passes/file{0:04d}.cpp'.format(i) for i in range(20)]
+    commit = {
+        'id': '{0:040x}'.format(seq),
+        'message': 'Fix the thing that was broken\n\n' + 'Details. ' * 20,
+        'added': files[:5],
+        'removed': files[5:8],
+        'modified': files[8:],
+        'author': {'name': 'someone', 'email': 'someone@example.com'},
+    }
+    commit_size = len(json.dumps(commit))
+    push = {
+        'ref': 'refs/heads/master',
+        'deleted': False,
+        'compare': 'https://github.com/chapel-lang/chapel/compare/a...b',
+        'repository': {'full_name': 'chapel-lang/chapel'},
+        'pusher': {'name': 'someone', 'email': 'someone@example.com'},
+        'head_commit': commit,
+        'commits': [commit] * max(1, size // commit_size),
+    }
+    return json.dumps(push)
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def _free_port():
+    sink = smtp_sink.SMTPSink()
+    port = sink.port
+    sink.server_close()
+    return port
+
+
+def _rss(pid):
+    """Returns resident set size of process and its children, in bytes, or
+    None where /proc is not available."""
+    pids = set([pid])
+    try:
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open('/proc/{0}/stat'.format(entry)) as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (IOError, IndexError, ValueError):
+                continue
+            if ppid == pid:
+                pids.add(int(entry))
+        total = 0
+        for p in pids:
+            try:
+                with open('/proc/{0}/status'.format(p)) as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1]) * 1024
+            except IOError:
+                pass
+        return total
+    except OSError:
+        return None
+
+
+class _PeakRSS(object):
+    """Samples RSS of a process tree in the background, keeping the peak."""
+
+    def __init__(self, pid, interval=0.05):
+        self._pid = pid
+        self._interval = interval
+        self._stop = threading.Event()
+        self.peak = _rss(pid)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            rss = _rss(self._pid)
+            if rss is not None:
+                self.peak = max(self.peak, rss)
+
+
+class App(object):
+    """emailer:app running under gunicorn, sending to an SMTP sink."""
+
+    def __init__(self, smtp_port, workers, worker_class, env, args=()):
+        self.port = _free_port()
+        self._tmp_dir = tempfile.mkdtemp()
+        environ = dict(os.environ)
+        environ.update({
+            'GITHUB_COMMIT_EMAILER_SENDER': 'sender@example.com',
+            'GITHUB_COMMIT_EMAILER_RECIPIENT': 'recipient@example.com',
+            'GITHUB_COMMIT_EMAILER_SECRET': SECRET,
+            'GITHUB_COMMIT_EMAILER_SMTP_HOST': '127.0.0.1',
+            'GITHUB_COMMIT_EMAILER_SMTP_PORT': str(smtp_port),
+            'GITHUB_COMMIT_EMAILER_METRICS_DIR': os.path.join(
+                self._tmp_dir, 'metrics'),
+            'GITHUB_COMMIT_EMAILER_MAX_BODY_SIZE': str(200 * 1024 * 1024),
+        })
+        environ.update(env)
+        gunicorn = os.path.join(os.path.dirname(sys.executable), 'gunicorn')
+        if not os.path.exists(gunicorn):
+            gunicorn = 'gunicorn'
+        self._log = open(os.path.join(self._tmp_dir, 'gunicorn.log'), 'w+')
+        self._proc = subprocess.Popen(
+            [gunicorn, 'emailer:app', '--bind',
+             '127.0.0.1:{0}'.format(self.port), '--workers', str(workers),
+             '--worker-class', worker_class, '--log-file=-'] + list(args),
+            cwd=ROOT, env=environ, stdout=self._log,
+            stderr=subprocess.STDOUT)
+
+    @property
+    def pid(self):
+        return self._proc.pid
+
+    def wait_ready(self, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self._proc.poll() is not None:
+                break
+            try:
+                conn = httplib.HTTPConnection('127.0.0.1', self.port,
+                                              timeout=1)
+                conn.request('GET', '/')
+                conn.getresponse().read()
+                return
+            except (IOError, httplib.HTTPException):
+                time.sleep(0.1)
+        self._log.seek(0)
+        raise RuntimeError('gunicorn did not start:\n' + self._log.read())
+
+    def stop(self):
+        self._proc.terminate()
+        self._proc.wait()
+        self._log.close()
+        shutil.rmtree(self._tmp_dir)
+
+
+def push_headers(body):
+    """Returns headers of push event with body, signed with SECRET."""
+    mac = hmac.new(SECRET, body, hashlib.sha256)
+    return {
+        'content-type': 'application/json',
+        'x-github-event': 'push',
+        'x-github-delivery': str(uuid.uuid4()),
+        'x-hub-signature-256': 'sha256=' + mac.hexdigest(),
+    }
+
+
+def post_push(port, body):
+    """Returns (status, seconds) of posting signed push event, with status
+    None if the request failed."""
+    headers = push_headers(body)
+    start = time.time()
+    try:
+        conn = httplib.HTTPConnection('127.0.0.1', port, timeout=60)
+        conn.request('POST', '/commit-email', body, headers)
+        status = conn.getresponse().status
+        conn.close()
+    except (IOError, httplib.HTTPException):
+        status = None
+    return status, time.time() - start
+
+
+def run_scenario(app, sink, size, concurrency, requests):
+    """Returns result dict of firing `requests` pushes of `size` bytes from
+    `concurrency` threads."""
+    bodies = [make_push(size, i) for i in range(min(requests, 50))]
+    seq = [0]
+    seq_lock = threading.Lock()
+    results = []
+
+    def worker():
+        while True:
+            with seq_lock:
+                i = seq[0]
+                if i >= requests:
+                    return
+                seq[0] += 1
+            # Vary the head commit id per request, without building a new
+            # body of `size` bytes each time.
+            body = bodies[i % len(bodies)].replace(
+                '{0:040x}'.format(i % len(bodies)), '{0:040x}'.format(
+                    (i + 1) << 32), 1)
+            results.append(post_push(app.port, body))
+
+    before = sink.stats.as_dict()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    with _PeakRSS(app.pid) as rss:
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+    after = sink.stats.as_dict()
+
+    latencies = sorted(seconds for _, seconds in results)
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    errors = sum(1 for status, _ in results
+                 if status is None or status >= 300)
+    return {
+        'size_kb': size // 1024,
+        'body_bytes': len(bodies[0]),
+        'concurrency': concurrency,
+        'requests': len(results),
+        'seconds': elapsed,
+        'throughput': len(results) / elapsed,
+        'latency_ms': dict(
+            (name, _percentile(latencies, pct) * 1000)
+            for name, pct in (('p50', 50), ('p90', 90), ('p99', 99),
+                              ('max', 100))),
+        'errors': errors,
+        'error_rate': float(errors) / len(results),
+        'statuses': statuses,
+        'emails_accepted': after['accepted'] - before['accepted'],
+        'emails_rejected': after['rejected'] - before['rejected'],
+        'peak_rss_mb': rss.peak / 1024.0 / 1024 if rss.peak else None,
+    }
+
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+            stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, results):
+    """Print change of throughput and p99 latency per scenario."""
+    old = dict(((r['size_kb'], r['concurrency']), r)
+               for r in baseline['scenarios'])
+    for r in results['scenarios']:
+        b = old.get((r['size_kb'], r['concurrency']))
+        if b is None:
+            continue
+        print('size={0:>5} KB  concurrency={1:>3}  throughput {2:+6.1f}%  '
+              'p99 {3:+6.1f}%'.format(
+                  r['size_kb'], r['concurrency'],
+                  (r['throughput'] / b['throughput'] - 1) * 100,
+                  (r['latency_ms']['p99'] / b['latency_ms']['p99'] - 1) *
+                  100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1,64,1024')
+    parser.add_argument('--concurrency', default='1,4,16')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per scenario')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--worker-class', default='sync')
+    parser.add_argument('--smtp-latency', type=float, default=0,
+                        help='milliseconds the sink waits before accepting '
+                        'each message')
+    parser.add_argument('--smtp-fail-rate', type=float, default=0,
+                        help='fraction of messages the sink rejects')
+    parser.add_argument('--env', action='append', default=[],
+                        metavar='NAME=VALUE', help='extra app config')
+    parser.add_argument('--output', help='write results as JSON here')
+    parser.add_argument('--compare', help='earlier results to compare with')
+    args = parser.parse_args()
+
+    sink = smtp_sink.SMTPSink(latency=args.smtp_latency / 1000.0,
+                              fail_rate=args.smtp_fail_rate)
+    sink.start()
+    env = dict(e.split('=', 1) for e in args.env)
+    app = App(sink.port, args.workers, args.worker_class, env)
+    results = {
+        'revision': _revision(),
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'args': vars(args),
+        'scenarios': [],
+    }
+    try:
+        app.wait_ready()
+        for size in args.sizes.split(','):
+            for concurrency in args.concurrency.split(','):
+                r = run_scenario(app, sink, int(size) * 1024,
+                                 int(concurrency), args.requests)
+                results['scenarios'].append(r)
+                print('size={0:>5} KB  concurrency={1:>3}  req/s={2:7.1f}  '
+                      'p50={3:7.1f}ms  p99={4:7.1f}ms  errors={5:.1%}  '
+                      'sent={6}  rss={7}'.format(
+                          r['size_kb'], r['concurrency'], r['throughput'],
+                          r['latency_ms']['p50'], r['latency_ms']['p99'],
+                          r['error_rate'], r['emails_accepted'],
+                          '{0:.0f}MB'.format(r['peak_rss_mb'])
+                          if r['peak_rss_mb'] else '?'))
+    finally:
+        app.stop()
+        sink.shutdown()
+        sink.server_close()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""Compare peak memory and latency of handling large push payloads.
+
+Usage: python benchmarks/bench_payload.py [--sizes 1,10,50] [--runs N]
+
+Sizes are in MB. Each (handler, size) pair runs in a fresh process, so peak
+RSS is not polluted by earlier runs. The "legacy" handler reads the body with
+request.data, parses it with get_json() and logs the whole payload, like
+commit_email() used to. The "streaming" handler is the current emailer app,
+with the max body size raised to 100 MB unless set in the environment. Emails
+are not sent in either case.
+"""
+
+from __future__ import print_function
+
+import argparse
+import cStringIO
+import hmac
+import json
+import logging
+import os
+import os.path
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SECRET = 'bench-secret'
+
+
+def make_push(size):
+    """Returns JSON push event body of roughly `size` bytes."""
+    files = ['third-party/llvm/lib/Target/X86/File{0:06d}.cpp'.format(i)
+             for i in range(200)]
+    commit = {
+        'id': '0123456789abcdef0123456789abcdef01234567',
+        'message': 'Update vendored llvm\n\n' + 'Details. ' * 20,
+        'added': files,
+        'removed': [],
+        'modified': files,
+        'author': {'name': 'someone', 'email': 'someone@example.com'},
+    }
+    commit_size = len(json.dumps(commit))
+    push = {
+        'ref': 'refs/heads/master',
+        'deleted': False,
+        'compare': 'https://github.com/chapel-lang/chapel/compare/a...b',
+        'repository': {'full_name': 'chapel-lang/chapel'},
+        'pusher': {'name': 'someone', 'email': 'someone@example.com'},
+        'head_commit': commit,
+        'commits': [commit] * max(1, size // commit_size),
+    }
+    return json.dumps(push)
+
+
+def _legacy_app():
+    import flask
+    import sha
+
+    app = flask.Flask('legacy')
+
+    @app.route('/commit-email', methods=['POST'])
+    def commit_email():
+        mac = hmac.new(SECRET, flask.request.data, sha)
+        if not hmac.compare_digest(
+                'sha1=' + mac.hexdigest(),
+                str(flask.request.headers.get('x-hub-signature', ''))):
+            return 'nope'
+        json_dict = flask.request.get_json()
+        logging.info('json body: {0}'.format(json_dict))
+        return 'yep'
+
+    return app
+
+
+def _streaming_app():
+    import emailer
+    emailer.app.config['TESTING'] = True
+    emailer._send_email = lambda msg_info: None
+    return emailer.app
+
+
+def _environ(body, signature):
+    return {
+        'REQUEST_METHOD': 'POST',
+        'PATH_INFO': '/commit-email',
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body)),
+        'HTTP_X_GITHUB_EVENT': 'push',
+        'HTTP_X_HUB_SIGNATURE': signature,
+        'wsgi.input': cStringIO.StringIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.url_scheme': 'http',
+        'wsgi.version': (1, 0),
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+
+
+def child(handler, path, runs):
+    """Handle payload in `path` `runs` times and print JSON results."""
+    import sha
+
+    os.environ['GITHUB_COMMIT_EMAILER_SECRET'] = SECRET
+    os.environ.setdefault('GITHUB_COMMIT_EMAILER_MAX_BODY_SIZE',
+                          str(100 * 1024 * 1024))
+    logging.basicConfig(level=logging.INFO, stream=open(os.devnull, 'w'))
+    app = _legacy_app() if handler == 'legacy' else _streaming_app()
+
+    with open(path) as f:
+        body = f.read()
+    signature = 'sha1=' + hmac.new(SECRET, body, sha).hexdigest()
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    statuses = []
+    timings = []
+    for _ in range(runs):
+        t0 = time.time()
+        result = app(_environ(body, signature),
+                     lambda status, headers: statuses.append(status))
+        ''.join(result)
+        timings.append(time.time() - t0)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print(json.dumps({
+        'handler': handler,
+        'size_mb': len(body) / 1024.0 / 1024.0,
+        'status': statuses[0],
+        'mean_ms': sum(timings) / len(timings) * 1000,
+        'peak_rss_over_body_mb': (peak_rss - base_rss) / 1024.0,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1,10,50')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], args.child[1], args.runs)
+        return
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for size in args.sizes.split(','):
+            path = os.path.join(tmp_dir, '{0}.json'.format(size))
+            with open(path, 'w') as f:
+                f.write(make_push(int(float(size) * 1024 * 1024)))
+            for handler in ('legacy', 'streaming'):
+                out = subprocess.check_output([
+                    sys.executable, os.path.abspath(__file__),
+                    '--runs', str(args.runs), '--child', handler, path])
+                r = json.loads(out.splitlines()[-1])
+                print('{handler:<10} {size_mb:6.1f} MB  status={status}  '
+                      'mean={mean_ms:8.1f} ms  '
+                      'peak RSS over body={peak_rss_over_body_mb:7.1f} MB'
+                      .format(**r))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
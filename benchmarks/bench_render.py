@@ -0,0 +1,120 @@
+"""Measure how many commit emails per second can be rendered.
+
+Usage: python benchmarks/bench_render.py [--count N]
+
+Compares the old path, which read config from the environment and built an
+envelopes.Envelope, converted to MIME text the way envelopes.SMTP.send()
+does, for every email, with rendering.Renderer using the built-in template
+and a Jinja2 per-repo template.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import envelopes  # noqa
+import rendering  # noqa
+
+
+MSG_INFO = {
+    'repo': 'chapel-lang/chapel',
+    'branch': 'refs/heads/master',
+    'revision': '0123456',
+    'message': u'Merge pull request #1234 from someone/branch\n\n'
+               u'Fix the thing that was broken\n\n' + u'More words. ' * 40,
+    'changed_files': u'\n'.join(u'M compiler/file{0}.cpp'.format(i)
+                                for i in range(50)),
+    'pusher': u'someone',
+    'pusher_email': u'someone <someone@example.com>',
+    'compare_url': u'https://github.com/chapel-lang/chapel/compare/a...b',
+}
+
+JINJA_TEMPLATE = u"""Branch: {{ branch }}
+Revision: {{ revision }}
+Author: {{ pusher }}
+
+{{ message }}
+
+{{ changed_files }}
+
+Compare: {{ compare_url }}
+"""
+
+
+def legacy_render(msg_info):
+    """Old _build_email(), followed by what envelopes.SMTP.send() does."""
+    if 'GITHUB_COMMIT_EMAILER_SEND_FROM_AUTHOR' in os.environ:
+        sender = msg_info['pusher_email']
+    else:
+        sender = os.environ.get('GITHUB_COMMIT_EMAILER_SENDER')
+    recipient = os.environ.get('GITHUB_COMMIT_EMAILER_RECIPIENT')
+    reply_to = os.environ.get('GITHUB_COMMIT_EMAILER_REPLY_TO', None)
+    approved = os.environ.get('GITHUB_COMMIT_EMAILER_APPROVED_HEADER', None)
+    subject = rendering.get_subject(msg_info['repo'], msg_info['message'])
+    body = rendering.DEFAULT_TEMPLATE.format(**msg_info)
+
+    msg = envelopes.Envelope(
+        to_addr=recipient,
+        from_addr=sender,
+        subject=subject,
+        text_body=body
+    )
+    if reply_to is not None:
+        msg.add_header('Reply-To', reply_to)
+    if approved is not None:
+        msg.add_header('Approved', approved)
+    msg.add_header('X-SMTPAPI', json.dumps(
+        {'filters': {'clicktrack': {'settings': {'enable': 0}}}}))
+    return msg.to_mime_message().as_string()
+
+
+def bench(name, render, count):
+    render(MSG_INFO)
+    start = time.time()
+    for _ in range(count):
+        render(MSG_INFO)
+    total = time.time() - start
+    print('{0:<10} n={1} total={2:.3f}s mean={3:.1f}us msgs/s={4:.0f}'.format(
+        name, count, total, total / count * 1e6, count / total))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=20000)
+    args = parser.parse_args()
+
+    os.environ['GITHUB_COMMIT_EMAILER_SENDER'] = 'noreply@example.com'
+    os.environ['GITHUB_COMMIT_EMAILER_RECIPIENT'] = 'commits@example.com'
+    os.environ['GITHUB_COMMIT_EMAILER_REPLY_TO'] = 'dev@example.com'
+
+    template_dir = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(template_dir, 'chapel-lang'))
+        with open(os.path.join(template_dir, 'chapel-lang',
+                               'chapel.txt'), 'w') as f:
+            f.write(JINJA_TEMPLATE)
+
+        config = rendering.load_config()
+        renderer = rendering.Renderer(config)
+        jinja_renderer = rendering.Renderer(
+            config._replace(template_dir=template_dir))
+
+        bench('legacy', legacy_render, args.count)
+        bench('renderer', lambda m: renderer.render(m).data, args.count)
+        bench('jinja2', lambda m: jinja_renderer.render(m).data, args.count)
+    finally:
+        shutil.rmtree(template_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Measure web hook signature verifications per second by body size.
+
+Usage: python benchmarks/bench_signature.py [--sizes 1,16,256,1024,10240]
+
+Sizes are in KB. Compares the old verification, which keyed a new hmac with
+the sha module for every request, with copying the pre-keyed hmac objects
+of signatures.Key, for sha1 and sha256 signatures.
+"""
+
+from __future__ import print_function
+
+import argparse
+import hmac
+import os
+import os.path
+import sys
+import time
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import signatures  # noqa
+
+with warnings.catch_warnings():
+    warnings.simplefilter('ignore', DeprecationWarning)
+    import sha  # noqa
+
+SECRET = 'bench-secret-0123456789abcdef'
+
+
+def legacy_verify(body, signature):
+    mac = hmac.new(SECRET, body, sha)
+    return hmac.compare_digest('sha1=' + mac.hexdigest(), signature)
+
+
+def bench(name, verify, body, signature):
+    assert verify(body, signature)
+    # Run for about half a second.
+    count = 0
+    start = time.time()
+    while time.time() - start < 0.5:
+        for _ in range(10):
+            verify(body, signature)
+        count += 10
+    total = time.time() - start
+    print('{0:<14} size={1:>6} KB  mean={2:9.1f}us  verifications/s={3:.0f}'
+          .format(name, len(body) // 1024, total / count * 1e6,
+                  count / total))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1,16,256,1024,10240')
+    args = parser.parse_args()
+
+    key = signatures.Key(SECRET)
+
+    def cached_verify(algorithm):
+        def verify(body, signature):
+            mac = key.new(algorithm)
+            mac.update(body)
+            return hmac.compare_digest(mac.hexdigest(), signature)
+        return verify
+
+    for size in args.sizes.split(','):
+        body = 'x' * (int(size) * 1024)
+        sha1 = hmac.new(SECRET, body, sha).hexdigest()
+        sha256 = hmac.new(SECRET, body,
+                          signatures.SIGNATURE_HEADERS[0][2]).hexdigest()
+        bench('legacy-sha1', legacy_verify, body, 'sha1=' + sha1)
+        bench('cached-sha1', cached_verify('sha1'), body, sha1)
+        bench('cached-sha256', cached_verify('sha256'), body, sha256)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Measure cost of writing accepted messages to the spool.
+
+Usage: python benchmarks/bench_spool.py [--count N] [--dir DIR]
+
+Reports per-message put() latency with and without fsync. Run it on the
+filesystem the spool will live on, since fsync cost depends on it.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import spool  # noqa
+
+
+MSG_INFO = {
+    'repo': 'chapel-lang/chapel',
+    'branch': 'refs/heads/master',
+    'revision': '0123456',
+    'message': 'Merge pull request #1234 from someone/branch\n\n'
+               'Fix the thing that was broken\n\n' + 'More words. ' * 40,
+    'changed_files': '\n'.join('M compiler/file{0}.cpp'.format(i)
+                               for i in range(50)),
+    'pusher': 'someone',
+    'pusher_email': 'someone <someone@example.com>',
+    'compare_url': 'https://github.com/chapel-lang/chapel/compare/a...b',
+}
+
+
+def _percentile(sorted_values, pct):
+    index = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def bench(directory, count, fsync):
+    path = os.path.join(directory, 'bench-{0}.db'.format(fsync))
+    s = spool.Spool(path, fsync=fsync)
+    timings = []
+    start = time.time()
+    for _ in range(count):
+        t0 = time.time()
+        s.put(MSG_INFO)
+        timings.append(time.time() - t0)
+    total = time.time() - start
+    s.close()
+
+    timings.sort()
+    print('fsync={0:<5} n={1} total={2:.3f}s mean={3:.1f}us '
+          'p50={4:.1f}us p99={5:.1f}us msgs/s={6:.0f}'.format(
+              str(fsync), count, total, total / count * 1e6,
+              _percentile(timings, 50) * 1e6,
+              _percentile(timings, 99) * 1e6,
+              count / total))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=2000)
+    parser.add_argument('--dir', help='directory for spool files '
+                        '(default: new temporary directory)')
+    args = parser.parse_args()
+
+    directory = args.dir or tempfile.mkdtemp()
+    try:
+        for fsync in (True, False):
+            bench(directory, args.count, fsync)
+    finally:
+        if not args.dir:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
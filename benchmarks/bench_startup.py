@@ -0,0 +1,155 @@
+"""Measure cold start time and first request latency of the emailer app.
+
+Usage: python benchmarks/bench_startup.py [--runs 5] [--workers 2]
+           [--no-gunicorn]
+
+For each mode, "lazy" (plain `gunicorn emailer:app`) and "preload"
+(`--config gunicorn_config.py`), reports the median over `runs` fresh
+processes of:
+
+* in-process: time to import emailer, to preload() and init_worker() it
+  when preloading, and to answer the first and second push,
+* under gunicorn: time from starting gunicorn until the first push is
+  answered, and the latency of the push after it.
+
+Pushes are signed, render a Jinja2 template and are sent to a local SMTP
+sink, so every part of the app that is set up on first use is measured.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_load  # noqa
+import smtp_sink  # noqa
+
+MODES = ('lazy', 'preload')
+
+
+def child(mode):
+    """Run in a fresh process: print JSON timings of starting the app in
+    `mode` and answering two pushes."""
+    timings = {}
+    start = time.time()
+    sys.path.insert(0, ROOT)
+    import emailer
+    timings['import'] = time.time() - start
+    if mode == 'preload':
+        start = time.time()
+        emailer.preload()
+        timings['preload'] = time.time() - start
+        start = time.time()
+        emailer.init_worker()
+        timings['init_worker'] = time.time() - start
+
+    client = emailer.app.test_client()
+    for i, name in enumerate(('first_request', 'second_request')):
+        body = bench_load.make_push(1024, i)
+        start = time.time()
+        r = client.post('/commit-email', data=body,
+                        headers=bench_load.push_headers(body))
+        timings[name] = time.time() - start
+        if r.status_code != 200:
+            raise RuntimeError('push failed: {0} {1}'.format(r.status_code,
+                                                             r.data))
+    print(json.dumps(timings))
+
+
+def run_child(mode, env):
+    """Returns timings of child(mode) in a fresh interpreter."""
+    out = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--child', mode],
+        cwd=ROOT, env=env)
+    return json.loads(out.splitlines()[-1])
+
+
+def run_gunicorn(mode, sink, workers, env):
+    """Returns timings of starting gunicorn in `mode` until it answers a
+    push, and of the push after it."""
+    args = ['--config', 'gunicorn_config.py'] if mode == 'preload' else []
+    start = time.time()
+    app = bench_load.App(sink.port, workers, 'sync', env, args=args)
+    try:
+        status = None
+        while status != 200:
+            status, _ = bench_load.post_push(app.port,
+                                             bench_load.make_push(1024, 0))
+            if status is None:
+                time.sleep(0.01)
+        first = time.time() - start
+        status, second = bench_load.post_push(app.port,
+                                              bench_load.make_push(1024, 1))
+    finally:
+        app.stop()
+    return {'first_push': first, 'second_push': second}
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def report(title, runs):
+    print(title)
+    for name in sorted(runs[0]):
+        print('  {0:<16} {1:8.1f} ms'.format(
+            name, _median([r[name] for r in runs]) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--no-gunicorn', action='store_true')
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child)
+        return
+
+    sink = smtp_sink.SMTPSink()
+    sink.start()
+    tmp_dir = tempfile.mkdtemp()
+    with open(os.path.join(tmp_dir, 'default.txt'), 'w') as f:
+        f.write('{{ branch }} {{ revision }} by {{ pusher }}\n\n'
+                '{{ message }}\n\n{{ changed_files }}\n')
+    env = dict(os.environ)
+    env.update({
+        'GITHUB_COMMIT_EMAILER_SENDER': 'sender@example.com',
+        'GITHUB_COMMIT_EMAILER_RECIPIENT': 'recipient@example.com',
+        'GITHUB_COMMIT_EMAILER_SECRET': bench_load.SECRET,
+        'GITHUB_COMMIT_EMAILER_SMTP_HOST': '127.0.0.1',
+        'GITHUB_COMMIT_EMAILER_SMTP_PORT': str(sink.port),
+        'GITHUB_COMMIT_EMAILER_TEMPLATE_DIR': tmp_dir,
+        'ROLLBAR_ACCESS_TOKEN': 'bench-token',
+        'GITHUB_COMMIT_EMAILER_LOG_LEVEL': 'WARNING',
+    })
+    try:
+        for mode in MODES:
+            report('{0} (in-process)'.format(mode),
+                   [run_child(mode, env) for _ in range(args.runs)])
+        if not args.no_gunicorn:
+            for mode in MODES:
+                report('{0} (gunicorn, {1} workers)'.format(
+                    mode, args.workers),
+                    [run_gunicorn(mode, sink, args.workers, env)
+                     for _ in range(args.runs)])
+    finally:
+        sink.shutdown()
+        sink.server_close()
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""Measure delivery throughput of the shared work queue with several nodes.
+
+Usage: python benchmarks/bench_workqueue.py [--jobs 400] [--nodes 1,2,4]
+           [--workers 2] [--latency 0.02] [--kill]
+
+Puts `jobs` jobs on an SQLite work queue, then starts each number of
+`nodes` as separate processes, each with `workers` sender threads, and
+reports the time until every job is done. Sending an email is simulated by
+sleeping `latency` seconds per message, as if waiting for SendGrid.
+
+With --kill, one node is killed (SIGKILL) once a third of the jobs are
+done. Its jobs are sent by the other nodes once their leases expire. Every
+run reports jobs that were never sent, and jobs sent more than once, which
+only happens if a node dies after the email was sent but before the job was
+completed.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import multiprocessing
+import os
+import os.path
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import workqueue  # noqa
+
+LEASE = 2
+
+
+def node(path, out_path, workers, latency):
+    """Run in a child process: send jobs until none are left."""
+    queue = workqueue.SQLiteWorkQueue(path, lease=LEASE, fsync=False)
+    out = open(out_path, 'a', 0)
+
+    def deliver(jobs):
+        time.sleep(latency * len(jobs))
+        out.write(''.join('{0}\n'.format(job.msg_info['n']) for job in jobs))
+        return [None] * len(jobs)
+
+    senders = workqueue.Senders(queue, deliver, workers=workers,
+                                batch_size=5, poll_interval=0.05,
+                                heartbeat=LEASE / 4.0)
+    senders.start()
+    while queue.stats()['queued']:
+        time.sleep(0.05)
+    senders.stop()
+
+
+def run(directory, jobs, nodes, workers, latency, kill):
+    path = os.path.join(directory, 'jobs-{0}.db'.format(nodes))
+    queue = workqueue.SQLiteWorkQueue(path, fsync=False)
+    for i in range(jobs):
+        queue.put({'n': i}, key=str(i))
+
+    out_paths = [os.path.join(directory, 'sent-{0}-{1}.txt'.format(nodes, i))
+                 for i in range(nodes)]
+    start = time.time()
+    procs = [multiprocessing.Process(target=node,
+                                     args=(path, out_paths[i], workers,
+                                           latency))
+             for i in range(nodes)]
+    for proc in procs:
+        proc.start()
+    killed = not kill
+    while any(proc.is_alive() for proc in procs):
+        if not killed and queue.stats()['done'] >= jobs // 3:
+            os.kill(procs[0].pid, signal.SIGKILL)
+            killed = True
+        time.sleep(0.01)
+    elapsed = time.time() - start
+    queue.close()
+
+    sent = collections.Counter()
+    for out_path in out_paths:
+        if os.path.exists(out_path):
+            with open(out_path) as f:
+                sent.update(int(line) for line in f if line.strip())
+    lost = jobs - len(sent)
+    duplicates = sum(count - 1 for count in sent.values())
+    return elapsed, lost, duplicates
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--jobs', type=int, default=400)
+    parser.add_argument('--nodes', default='1,2,4')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--kill', action='store_true')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        base = None
+        for nodes in [int(n) for n in args.nodes.split(',')]:
+            kill = args.kill and nodes > 1
+            elapsed, lost, duplicates = run(directory, args.jobs, nodes,
+                                            args.workers, args.latency, kill)
+            rate = args.jobs / elapsed
+            base = base or rate
+            print('nodes={0} senders={1:<3} {2:.2f}s msgs/s={3:.0f} '
+                  'speedup={4:.2f}x lost={5} duplicates={6}{7}'.format(
+                      nodes, nodes * args.workers, elapsed, rate,
+                      rate / base, lost, duplicates,
+                      ' (one node killed)' if kill else ''))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""Local SMTP server that accepts and discards mail, for load tests.
+
+Usage: python benchmarks/smtp_sink.py [--port 2525] [--latency MS]
+                                      [--fail-rate 0.0]
+
+Each message is delayed by `latency` milliseconds before it is accepted, and
+a `fail-rate` fraction of them is rejected with a temporary (451) error, to
+see how the emailer copes with a slow or flaky SMTP server. Connections are
+handled in threads, so a slow message does not hold up the others.
+"""
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import random
+import SocketServer
+import threading
+import time
+
+
+class Stats(object):
+    """Counts of connections and messages, shared by all handlers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.bytes = 0
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self):
+        with self._lock:
+            return {'connections': self.connections,
+                    'accepted': self.accepted,
+                    'rejected': self.rejected,
+                    'bytes': self.bytes}
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    """Speaks just enough SMTP for smtplib."""
+
+    def handle(self):
+        server = self.server
+        server.stats.add(connections=1)
+        connection = server.next_connection_id()
+        self._reply('220 smtp-sink ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command in ('HELO', 'EHLO'):
+                self._reply('250 smtp-sink')
+            elif command in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self._reply('250 OK')
+            elif command == 'DATA':
+                self._reply('354 End data with <CR><LF>.<CR><LF>')
+                data = self._read_data()
+                if data is None:
+                    return
+                size = len(data)
+                if server.latency:
+                    time.sleep(server.latency)
+                if server.fail_rate and random.random() < server.fail_rate:
+                    server.stats.add(rejected=1)
+                    self._reply('451 Injected failure')
+                else:
+                    server.stats.add(accepted=1, bytes=size)
+                    if server.messages is not None:
+                        server.messages.append((connection, data))
+                    self._reply('250 OK queued')
+            elif command == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:
+                self._reply('502 Command not implemented')
+
+    def _read_data(self):
+        lines = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return None
+            if line in ('.\r\n', '.\n'):
+                return ''.join(lines)
+            lines.append(line)
+
+    def _reply(self, line):
+        self.wfile.write(line + '\r\n')
+
+
+class SMTPSink(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """SMTP server that discards mail after `latency` seconds, rejecting a
+    `fail_rate` fraction of it. Port 0 picks a free port. With `keep` set,
+    accepted messages are kept in `messages`, as (connection number, data)
+    tuples."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, fail_rate=0,
+                 keep=False):
+        SocketServer.TCPServer.__init__(self, (host, port), _Handler)
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.stats = Stats()
+        self.messages = [] if keep else None
+        self._connections = itertools.count(1)
+        self._connections_lock = threading.Lock()
+
+    def next_connection_id(self):
+        """Returns number of a new connection, counting from 1."""
+        with self._connections_lock:
+            return next(self._connections)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """Serve in a background thread."""
+        thread = threading.Thread(target=self.serve_forever,
+                                  name='smtp-sink')
+        thread.daemon = True
+        thread.start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2525)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='milliseconds to wait before accepting mail')
+    parser.add_argument('--fail-rate', type=float, default=0,
+                        help='fraction of messages to reject')
+    args = parser.parse_args()
+
+    sink = SMTPSink(args.host, args.port, args.latency / 1000.0,
+                    args.fail_rate)
+    print('Listening on {0}:{1}'.format(args.host, sink.port))
+    try:
+        sink.serve_forever()
+    except KeyboardInterrupt:
+        print(sink.stats.as_dict())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Summaries of the files changed by a commit, bounded in size."""
+
+import collections
+
+# Lines and bytes kept free for the lines that are added once a summary has
+# to be shortened.
+_RESERVED_LINES = 2
+_RESERVED_BYTES = 200
+
+
+class _Lines(object):
+    """Lines of text, refusing lines once `max_lines` or `max_bytes` (utf-8
+    encoded, with line breaks) would be exceeded."""
+
+    def __init__(self, max_lines, max_bytes):
+        self._max_lines = max_lines
+        self._max_bytes = max_bytes
+        self._size = 0
+        self.lines = []
+
+    def add(self, line):
+        """Add line. Returns False, without adding it, if it does not fit."""
+        size = len(line.encode('utf-8')) + 1
+        if (len(self.lines) >= self._max_lines or
+                self._size + size > self._max_bytes):
+            return False
+        self.lines.append(line)
+        self._size += size
+        return True
+
+
+def summarize(added, removed, modified, max_lines=200, max_bytes=20000,
+              depth=2, stats=None):
+    """Returns changed files as "A path", "R path" and "M path" lines. If
+    `stats` maps paths to (added, removed) line counts, they are appended
+    to the lines of those paths, like "M path (+10 -2)", or "(binary)" if
+    the counts are None.
+
+    If that would take more than `max_lines` lines or `max_bytes` bytes,
+    files are instead grouped by their first `depth` directories, e.g.
+    "M third-party/llvm/… (4,812 files)", followed by totals per change
+    type. Groups that still do not fit are counted in a final line. Runs in
+    time linear in the number of files, and memory bounded by `max_lines`.
+    """
+    kinds = (('A', added), ('R', removed), ('M', modified))
+
+    listing = _Lines(max_lines, max_bytes)
+    if all(listing.add(u'{0} {1}{2}'.format(letter, path,
+                                            _stat(stats, path)))
+           for letter, paths in kinds for path in paths):
+        return u'\n'.join(listing.lines)
+
+    summary = _Lines(max(max_lines - _RESERVED_LINES, 0),
+                     max(max_bytes - _RESERVED_BYTES, 0))
+    full = False
+    omitted = 0
+    totals = []
+    for letter, paths in kinds:
+        groups, total, overflow = _group(paths, depth, max_lines)
+        totals.append(total)
+        omitted += overflow
+        for prefix, (count, path) in groups.iteritems():
+            if count == 1:
+                line = u'{0} {1}'.format(letter, path)
+            else:
+                line = u'{0} {1}/… ({2:,} files)'.format(
+                    letter, prefix, count)
+            full = full or not summary.add(line)
+            if full:
+                omitted += count
+
+    lines = summary.lines
+    if omitted:
+        lines.append(u'… {0:,} more files not shown'.format(omitted))
+    lines.append(u'{0:,} files changed: {1:,} added, {2:,} removed, '
+                 u'{3:,} modified'.format(sum(totals), *totals))
+    return u'\n'.join(lines)
+
+
+def combine(commits):
+    """Returns (added, removed, modified) lists of the net changes of a
+    series of commits, oldest first, each a dict with "added", "removed"
+    and "modified" lists. E.g. a file added by one commit and modified by
+    the next is added, and a file added and then removed is left out."""
+    changes = collections.OrderedDict()
+    for commit in commits:
+        for path in commit['added']:
+            changes[path] = 'M' if changes.get(path) == 'R' else 'A'
+        for path in commit['removed']:
+            if changes.get(path) == 'A':
+                del changes[path]
+            else:
+                changes[path] = 'R'
+        for path in commit['modified']:
+            if changes.get(path) != 'A':
+                changes[path] = 'M'
+    return tuple([path for path, change in changes.iteritems()
+                  if change == letter] for letter in 'ARM')
+
+
+def _stat(stats, path):
+    if not stats or path not in stats:
+        return u''
+    added, removed = stats[path]
+    if added is None:
+        return u' (binary)'
+    return u' (+{0} -{1})'.format(added, removed)
+
+
+def _group(paths, depth, max_groups):
+    """Returns (groups, total, overflow) for paths. Groups map directory
+    prefix to [file count, first path], in the order they were first seen.
+    Files that would start a group beyond `max_groups` are only counted in
+    overflow. Files outside of any directory are groups of their own."""
+    groups = collections.OrderedDict()
+    total = 0
+    overflow = 0
+    for path in paths:
+        total += 1
+        parts = path.split(u'/', depth)
+        prefix = u'/'.join(parts[:min(depth, len(parts) - 1)]) or path
+        group = groups.get(prefix)
+        if group is not None:
+            group[0] += 1
+        elif len(groups) < max_groups:
+            groups[prefix] = [1, path]
+        else:
+            overflow += 1
+    return groups, total, overflow
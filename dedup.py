@@ -0,0 +1,189 @@
+"""Deduplication of github web hook redeliveries."""
+
+import collections
+import sqlite3
+import threading
+import time
+
+
+class LRUCache(object):
+    """In-memory set of keys that expire after `ttl` seconds. Holds at most
+    `max_entries` keys, evicting the least recently added first."""
+
+    def __init__(self, max_entries=10000, ttl=86400):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def contains(self, key):
+        """Returns True if key was added and has not expired."""
+        now = time.time()
+        with self._lock:
+            expires = self._entries.get(key)
+            if expires is None:
+                return False
+            if expires <= now:
+                del self._entries[key]
+                return False
+            return True
+
+    def add(self, key):
+        """Add key. Returns False if it was already present."""
+        now = time.time()
+        with self._lock:
+            expires = self._entries.pop(key, None)
+            if expires is not None and expires > now:
+                self._entries[key] = expires
+                return False
+            self._entries[key] = now + self._ttl
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+            return True
+
+    def discard(self, key):
+        """Remove key, if present."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteStore(object):
+    """Set of expiring keys in an SQLite database, so that all worker
+    processes on a host see the same keys. Same interface as LRUCache."""
+
+    # Expired and excess keys are purged once every this many adds.
+    PURGE_INTERVAL = 500
+
+    def __init__(self, path, max_entries=100000, ttl=86400):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._adds = 0
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS seen ('
+                         'key TEXT PRIMARY KEY, expires REAL NOT NULL)')
+
+    def contains(self, key):
+        """Returns True if key was added and has not expired."""
+        with self._lock:
+            row = self._db.execute('SELECT expires FROM seen WHERE key = ?',
+                                   (key,)).fetchone()
+        return row is not None and row[0] > time.time()
+
+    def add(self, key):
+        """Add key. Returns False if it was already present."""
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._db.execute(
+                    'SELECT expires FROM seen WHERE key = ?',
+                    (key,)).fetchone()
+                added = row is None or row[0] <= now
+                if added:
+                    self._db.execute(
+                        'INSERT OR REPLACE INTO seen (key, expires) '
+                        'VALUES (?, ?)', (key, now + self._ttl))
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+
+            self._adds += 1
+            if self._adds % self.PURGE_INTERVAL == 0:
+                self._purge(now)
+        return added
+
+    def discard(self, key):
+        """Remove key, if present."""
+        with self._lock:
+            self._db.execute('DELETE FROM seen WHERE key = ?', (key,))
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._db.close()
+
+    def _purge(self, now):
+        self._db.execute('DELETE FROM seen WHERE expires <= ?', (now,))
+        self._db.execute(
+            'DELETE FROM seen WHERE key IN (SELECT key FROM seen '
+            'ORDER BY expires DESC LIMIT -1 OFFSET ?)', (self._max_entries,))
+
+
+class DedupCache(object):
+    """Remembers keys of accepted deliveries, in memory and optionally in a
+    store shared with other processes, and counts duplicates found."""
+
+    def __init__(self, local, shared=None):
+        self._local = local
+        self._shared = shared
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def seen(self, key):
+        """Returns True, and counts a hit, if key has been added before. Use
+        this for cheap checks before doing any expensive work."""
+        found = self._local.contains(key)
+        if not found and self._shared is not None:
+            found = self._shared.contains(key)
+            if found:
+                self._local.add(key)
+        if found:
+            self._count(hit=True)
+        return found
+
+    def add(self, *keys):
+        """Atomically record keys of an accepted delivery. Returns False, and
+        counts a hit, if any of them had already been added; otherwise counts
+        a miss. On False, keys that were newly added are removed again."""
+        added = []
+        for key in keys:
+            if not self._add(key):
+                for k in added:
+                    self.discard(k)
+                self._count(hit=True)
+                return False
+            added.append(key)
+        self._count(hit=False)
+        return True
+
+    def discard(self, *keys):
+        """Forget keys, e.g. when the delivery could not be accepted after
+        all, so that github redeliveries are not dropped."""
+        for key in keys:
+            self._local.discard(key)
+            if self._shared is not None:
+                self._shared.discard(key)
+
+    def stats(self):
+        """Returns dict with hit and miss counts and hit rate."""
+        with self._lock:
+            hits, misses = self._hits, self._misses
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': float(hits) / total if total else 0.0,
+        }
+
+    def _add(self, key):
+        if not self._local.add(key):
+            return False
+        if self._shared is not None and not self._shared.add(key):
+            return False
+        return True
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
@@ -0,0 +1,188 @@
+"""Background delivery of commit notification emails."""
+
+import collections
+import fnmatch
+import logging
+import Queue
+import threading
+import time
+
+
+class QueueFull(Exception):
+    """Raised when a message cannot be accepted by the delivery queue."""
+
+
+def branch_priority(patterns):
+    """Returns priority function for FairQueue that puts pushes to branches
+    matching any of the shell-style ref patterns, e.g.
+    "refs/heads/release/*", ahead of all other pushes. Digests are
+    prioritized if any of their branches match."""
+    def priority(msg_info):
+        for branch in msg_info.get('branch', '').split(', '):
+            for pattern in patterns:
+                if fnmatch.fnmatchcase(branch, pattern):
+                    return 0
+        return 1
+    return priority
+
+
+class FairQueue(Queue.Queue):
+    """Queue that hands out messages by priority, lowest first, and takes
+    turns between repos within a priority, so one repo with a burst of
+    pushes does not hold back all others. Messages of the same repo and
+    priority keep their order. Items that are not message info dicts, like
+    stop markers, come out last."""
+
+    def __init__(self, maxsize=0, priority=None):
+        self._priority = priority or (lambda msg_info: 0)
+        Queue.Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        # Per priority, an ordered dict of repo to its messages. The repo
+        # served next is the first one; it moves to the back after a turn.
+        self._levels = {}
+        self._last = collections.deque()
+        self._size = 0
+
+    def _qsize(self, len=len):
+        return self._size
+
+    def _put(self, item):
+        self._size += 1
+        if not isinstance(item, dict):
+            self._last.append(item)
+            return
+        repos = self._levels.setdefault(self._priority(item),
+                                        collections.OrderedDict())
+        repo = item.get('repo')
+        if repo not in repos:
+            repos[repo] = collections.deque()
+        repos[repo].append(item)
+
+    def _get(self):
+        self._size -= 1
+        if not self._levels:
+            return self._last.popleft()
+        level = min(self._levels)
+        repos = self._levels[level]
+        repo, msgs = repos.popitem(last=False)
+        item = msgs.popleft()
+        if msgs:
+            repos[repo] = msgs
+        elif not repos:
+            del self._levels[level]
+        return item
+
+
+class DeliveryQueue(object):
+    """Bounded, in-process queue drained by a pool of sender threads.
+
+    Messages are handed to `send_func` as lists, in the order they were
+    accepted. A sender thread takes every message that is already waiting, up
+    to `batch_size`, so bursts can share one SMTP session; a lone message is
+    never held back waiting for company. When the queue holds `max_depth`
+    messages, `put()` raises QueueFull so the caller can apply backpressure
+    instead of blocking the request.
+
+    If `priority` is given, messages are handed out by priority and in turns
+    between repos, see FairQueue, instead of in order.
+    """
+
+    _STOP = object()
+
+    def __init__(self, send_func, workers=2, max_depth=100, batch_size=1,
+                 priority=None):
+        if workers < 1:
+            raise ValueError('workers must be at least 1.')
+        if batch_size < 1:
+            raise ValueError('batch_size must be at least 1.')
+        self._send_func = send_func
+        self._workers = workers
+        self._batch_size = batch_size
+        if priority is None:
+            self._queue = Queue.Queue(maxsize=max_depth)
+        else:
+            self._queue = FairQueue(maxsize=max_depth, priority=priority)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def start(self):
+        """Start sender threads. Calling more than once is a no-op."""
+        with self._lock:
+            self._start()
+
+    def put(self, msg_info):
+        """Enqueue message without blocking. Raises QueueFull if the queue is
+        at capacity or is shutting down."""
+        with self._lock:
+            if self._closed:
+                raise QueueFull('Delivery queue is shutting down.')
+            self._start()
+            try:
+                self._queue.put_nowait(msg_info)
+            except Queue.Full:
+                raise QueueFull('Delivery queue is full.')
+
+    def qsize(self):
+        """Returns approximate number of messages waiting to be sent."""
+        return self._queue.qsize()
+
+    def shutdown(self, timeout=None):
+        """Stop accepting messages, send everything already accepted, and
+        wait for sender threads to exit. Returns True if all threads exited
+        within `timeout` seconds."""
+        with self._lock:
+            self._closed = True
+            threads = list(self._threads)
+            self._threads = []
+
+        # Stop markers go in behind accepted messages, so the queue is fully
+        # drained before any thread exits.
+        for _ in threads:
+            self._queue.put(self._STOP)
+        deadline = None if timeout is None else time.time() + timeout
+        for t in threads:
+            if deadline is None:
+                t.join()
+            else:
+                t.join(max(0, deadline - time.time()))
+        return not any(t.is_alive() for t in threads)
+
+    def _start(self):
+        if self._threads or self._closed:
+            return
+        for i in range(self._workers):
+            t = threading.Thread(target=self._run,
+                                 name='delivery-{0}'.format(i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            stop = batch[-1] is self._STOP
+            if stop:
+                batch.pop()
+            try:
+                if batch:
+                    self._send_func(batch)
+            except Exception:
+                logging.exception('Failed to deliver queued message(s).')
+            finally:
+                for _ in range(len(batch) + (1 if stop else 0)):
+                    self._queue.task_done()
+            if stop:
+                return
+
+    def _next_batch(self):
+        """Block for one message, then take whatever else is already waiting,
+        up to batch size. A stop marker always ends the batch."""
+        batch = [self._queue.get()]
+        while batch[-1] is not self._STOP and len(batch) < self._batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
@@ -0,0 +1,199 @@
+"""Lines added and removed per file, from local bare mirrors of the repos."""
+
+import collections
+import logging
+import os.path
+import re
+import subprocess
+import threading
+import time
+
+# Repo full names that are safe to use as mirror paths.
+_REPO_RE = re.compile(r'^[\w.-]+/[\w.-]+$')
+
+# Returned by Mirrors._compute() for commits missing from the mirror.
+_MISSING = object()
+
+
+class DiffstatCache(object):
+    """Diffstats by (repo, commit sha). Holds at most `max_entries`, evicting
+    the least recently used first. Commits never change, so entries do not
+    expire."""
+
+    def __init__(self, max_entries=1000):
+        self._max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns diffstat for key, or None if it is not cached."""
+        with self._lock:
+            stats = self._entries.pop(key, None)
+            if stats is None:
+                self.misses += 1
+                return None
+            self._entries[key] = stats
+            self.hits += 1
+            return stats
+
+    def put(self, key, stats):
+        """Cache diffstat for key."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = stats
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Mirrors(object):
+    """Bare git mirrors of repos, at <root>/<owner>/<repo>.git, e.g. made
+    with `git clone --mirror`. Diffstats are computed from them and cached.
+
+    Pushed commits are usually not in the mirror yet, so it is fetched
+    when a commit is missing, one fetch per repo at a time. If the fetch
+    does not finish within the time budget, the mirror is cold: no diffstat
+    is returned, and the fetch goes on in the background so later pushes
+    find it warm.
+    """
+
+    def __init__(self, root, cache=None, git='git'):
+        self._root = root
+        self._cache = cache or DiffstatCache()
+        self._git = git
+        self._lock = threading.Lock()
+        self._fetches = {}
+
+    def diffstat(self, repo, shas, budget):
+        """Returns {path: (added, removed)} lines of commits added up, with
+        None for the counts of binary files. Returns None if the repo has
+        no mirror, a commit is missing from it, or computing the diffstats
+        takes more than `budget` seconds."""
+        path = self._mirror_path(repo)
+        if path is None:
+            return None
+
+        deadline = time.time() + budget
+        total = {}
+        for sha in shas:
+            stats = self._cache.get((repo, sha))
+            if stats is None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logging.info('No time left for diffstat of %s %s.',
+                                 repo, sha)
+                    return None
+                stats = self._compute(path, repo, sha, remaining)
+                if stats is _MISSING:
+                    fetch = self._fetch(path, repo)
+                    fetch.join(max(0, deadline - time.time()))
+                    if fetch.is_alive():
+                        logging.info('Mirror of %s is cold.', repo)
+                        return None
+                    stats = self._compute(path, repo, sha,
+                                          deadline - time.time())
+                if stats is None or stats is _MISSING:
+                    return None
+                self._cache.put((repo, sha), stats)
+            for name, (added, removed) in stats.iteritems():
+                if name in total:
+                    added, removed = _add(total[name], (added, removed))
+                total[name] = (added, removed)
+        return total
+
+    def _mirror_path(self, repo):
+        if not repo or not _REPO_RE.match(repo) or '..' in repo:
+            return None
+        path = os.path.join(self._root, repo + '.git')
+        if not os.path.isdir(path):
+            return None
+        return path
+
+    def _compute(self, path, repo, sha, timeout):
+        """Returns diffstat of commit, against its first parent for merges,
+        _MISSING if it is not in the mirror, or None if git fails or takes
+        more than `timeout` seconds."""
+        if not re.match(r'^[0-9a-f]{4,40}$', sha) or timeout <= 0:
+            return None
+        try:
+            proc = subprocess.Popen(
+                [self._git, '--git-dir', path, 'log', '-1', '--format=',
+                 '--numstat', '--no-renames', '-m', '--first-parent', '-z',
+                 sha],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            logging.error('Failed to run git: %s', e)
+            return None
+        timer = threading.Timer(timeout, _kill, [proc])
+        timer.start()
+        try:
+            out, err = proc.communicate()
+        finally:
+            timer.cancel()
+
+        if proc.returncode < 0:
+            logging.warn('Diffstat of %s %s timed out.', repo, sha)
+            return None
+        if proc.returncode != 0:
+            logging.info('Commit %s not in mirror of %s: %s', sha, repo,
+                         err.strip())
+            return _MISSING
+        return parse_numstat(out)
+
+    def _fetch(self, path, repo):
+        """Returns thread fetching the mirror, starting one unless the
+        mirror is already being fetched."""
+        with self._lock:
+            fetch = self._fetches.get(repo)
+            if fetch is not None:
+                return fetch
+
+            def run():
+                try:
+                    subprocess.call([self._git, '--git-dir', path, 'fetch',
+                                     '--quiet', '--prune', 'origin'])
+                except OSError:
+                    logging.exception('Failed to fetch mirror of %s.', repo)
+                finally:
+                    with self._lock:
+                        del self._fetches[repo]
+
+            fetch = self._fetches[repo] = threading.Thread(
+                target=run, name='mirror-fetch')
+            fetch.daemon = True
+            fetch.start()
+            return fetch
+
+
+def parse_numstat(out):
+    """Returns {path: (added, removed)} from `git log --numstat -z`
+    output."""
+    stats = {}
+    for record in out.split('\0'):
+        record = record.lstrip('\n')
+        if not record:
+            continue
+        added, removed, path = record.split('\t', 2)
+        if added == '-':
+            stats[path.decode('utf-8', 'replace')] = (None, None)
+        else:
+            stats[path.decode('utf-8', 'replace')] = (int(added),
+                                                      int(removed))
+    return stats
+
+
+def _add(a, b):
+    if a[0] is None or b[0] is None:
+        return None, None
+    return a[0] + b[0], a[1] + b[1]
+
+
+def _kill(proc):
+    try:
+        proc.kill()
+    except OSError:
+        pass
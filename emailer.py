@@ -1,29 +1,141 @@
-import envelopes
-import envelopes.connstack
+import atexit
+import batching
+import changes
+import collections
+import dedup
+import delivery
+import diffstat
+import fastpath
 from flask import Flask
 import flask
 import hmac
-import json
 import logging
+import logs
+import metrics
+import offload
 import os
 import os.path
-import rollbar
-import rollbar.contrib.flask
-import sha
+import payload
+import ratelimit
+import rendering
+import settings
+import signal
+import signatures
+import smtp_pool
+import spool
+import threading
+import time
+import workqueue
 
 app = Flask(__name__)
 
-logging.basicConfig(level=logging.INFO)
+_log_handler = logs.configure()
+if _log_handler is not None:
+    atexit.register(_log_handler.close)
+
+_delivery_queue = None
+_delivery_queue_lock = threading.Lock()
+_digest_buffer = None
+_smtp_pool = None
+_smtp_pool_lock = threading.Lock()
+_spool = None
+_spool_lock = threading.Lock()
+_dedup_cache = None
+_dedup_cache_lock = threading.Lock()
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+_mirrors = None
+_mirrors_lock = threading.Lock()
+_renderer = None
+_renderer_lock = threading.Lock()
+_secret_registry = None
+_secret_registry_lock = threading.Lock()
+_metrics = None
+_metrics_lock = threading.Lock()
+_settings = None
+_settings_lock = threading.Lock()
+_work_queue = None
+_work_queue_lock = threading.Lock()
+_senders = None
+_digest_rules = []
+_work_priority = None
+_rollbar_initialized = False
+
+# Histogram of time spent in each stage of handling a push.
+STAGE_SECONDS = 'github_email_stage_seconds'
+
+# Github event types counted under their own name. The event header is not
+# authenticated, so others are counted as "other" rather than letting any
+# client add labels.
+GITHUB_EVENTS = frozenset([
+    'check_run', 'check_suite', 'commit_comment', 'create', 'delete',
+    'deployment', 'deployment_status', 'fork', 'gollum', 'issue_comment',
+    'issues', 'label', 'member', 'milestone', 'ping', 'public',
+    'pull_request', 'pull_request_review', 'pull_request_review_comment',
+    'push', 'release', 'repository', 'star', 'status', 'watch',
+    'workflow_job', 'workflow_run',
+])
+
+
+def preload():
+    """Parse config, compile templates and import optional modules up front.
+    Meant to be called in the gunicorn master when serving with --preload
+    (see gunicorn_config.py), so forked workers share the result
+    copy-on-write instead of each paying for it on its first web hook."""
+    import envelopes  # noqa
+    import rollbar.contrib.flask  # noqa
+
+    _get_settings()
+    _get_renderer().preload()
+    try:
+        _get_secret_registry()
+    except ValueError:
+        # Already logged; web hooks are answered with errors, as without
+        # preloading, until a secret is configured.
+        pass
+
+
+def reload():
+    """Parse config and compile templates again. Meant to be called in the
+    gunicorn master on SIGHUP (see gunicorn_config.py), before it forks the
+    workers that replace the old ones, so they do not start from the config
+    the master was booted with."""
+    _reload_config(signal.SIGHUP, None)
+    preload()
+
+
+def init_worker():
+    """Set up the resources of a worker process before it serves its first
+    web hook: rollbar, the log writer, one SMTP session, and the delivery
+    and spool retry threads if configured. Connections and threads do not
+    survive fork, so this is called in each worker, after gevent monkey
+    patching if serving with gevent."""
+    # gunicorn resets signal handlers of forked workers.
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, _reload_config)
+    if _log_handler is not None:
+        _log_handler.start()
+    init_rollbar()
+    _get_metrics()
+    _get_delivery_queue()
+    _get_spool()
+    _get_work_queue()
+    _get_smtp_pool().warm()
 
 
-@app.before_first_request
 def init_rollbar():
-    """Configure rollbar to capture exceptions."""
+    """Configure rollbar to capture exceptions, unless already done by
+    init_worker()."""
+    global _rollbar_initialized
     if app.config.get('TESTING', False):
         logging.warn(
             'Skipping rollbar init because TESTING flag is set on flask app.')
         return
+    if _rollbar_initialized:
+        return
 
+    import rollbar
+    import rollbar.contrib.flask
     rollbar.init(
         # throw KeyError if env var is not set.
         os.environ['ROLLBAR_ACCESS_TOKEN'],
@@ -34,171 +146,833 @@ def init_rollbar():
     )
     flask.got_request_exception.connect(
         rollbar.contrib.flask.report_exception, app)
+    _rollbar_initialized = True
+
+
+app.before_first_request(init_rollbar)
+
+
+@app.route('/')
+def index():
+    """Redirect to chapel homepage."""
+    return flask.redirect('http://chapel-lang.org/', code=301)
+
+
+@app.route('/metrics')
+def metrics_text():
+    """Return metrics of all worker processes in Prometheus text format."""
+    return flask.Response(metrics.render(_get_metrics().collect()),
+                          mimetype='text/plain; version=0.0.4')
 
 
 @app.before_request
 def app_before_request():
-    envelopes.connstack.push_connection(
-        envelopes.SendGridSMTP(
-            login=os.environ.get('SENDGRID_USERNAME'),
-            password=os.environ.get('SENDGRID_PASSWORD'))
-    )
+    """Record when the request started."""
+    flask.g.request_start = time.time()
 
 
 @app.after_request
 def app_after_request(response):
-    envelopes.connstack.pop_connection()
+    """Record time taken to answer the request."""
+    start = getattr(flask.g, 'request_start', None)
+    if start is not None:
+        _get_metrics().observe(
+            'github_email_request_seconds', time.time() - start,
+            endpoint=flask.request.endpoint or 'none',
+            status=response.status_code)
     return response
 
 
-@app.route('/')
-def index():
-    """Redirect to chapel homepage."""
-    return flask.redirect('http://chapel-lang.org/', code=301)
-
-
 @app.route('/commit-email', methods=['POST'])
 def commit_email():
     """Receive web hook from github and generate email."""
+    delivery_id = flask.request.headers.get('x-github-delivery')
+    with logs.context(delivery_id=delivery_id):
+        return _commit_email(delivery_id)
+
+
+def _commit_email(delivery_id):
+    stats = _get_metrics()
 
     # Only look at push events. Ignore the rest.
     event = flask.request.headers['x-github-event']
-    logging.info('Received "{0}" event from github.'.format(event))
+    logging.info('Received "%s" event from github.', event)
+    stats.inc('github_email_events_received_total',
+              event=_event_label(event))
     if event != 'push':
-        logging.info('Skipping "{0}" event.'.format(event))
+        logging.info('Skipping "%s" event.', event)
+        _skip('not_push')
         return 'nope'
 
-    # Verify signature.
-    secret = _get_secret()
+    # Drop redeliveries before doing any expensive work.
+    dedup_cache = _get_dedup_cache()
+    if (dedup_cache is not None and delivery_id and
+            dedup_cache.seen('delivery:' + delivery_id)):
+        logging.info('Skipping duplicate delivery %s. Dedup stats: %s',
+                     delivery_id, dedup_cache.stats())
+        stats.inc('github_email_dedup_hits_total')
+        _skip('duplicate_delivery')
+        return 'nope'
 
-    gh_signature = flask.request.headers.get('x-hub-signature', '')
-    if not _valid_signature(gh_signature, flask.request.data, secret):
+    # Verify signature before parsing the body. Unless the secret depends on
+    # the repo, it is computed while the body is read.
+    registry = _get_secret_registry()
+    gh_signature = signatures.get_signature(flask.request.headers)
+    macs = []
+    if gh_signature is not None and not registry.per_repo:
+        macs = registry.macs(gh_signature.algorithm)
+    max_size = _max_body_size()
+    try:
+        with stats.timer(STAGE_SECONDS, stage='read_body'):
+            body = payload.read_body(flask.request.stream,
+                                     flask.request.content_length, max_size,
+                                     macs=macs)
+    except payload.PayloadTooLarge as e:
+        logging.warn('%s Skipping request.', e)
+        _skip('too_large')
+        return 'nope', 413
+
+    # Hashing and parsing large bodies is handed off to a thread when
+    # serving with gevent, so other requests are not stalled meanwhile.
+    per_repo = gh_signature is not None and registry.per_repo
+    with stats.timer(STAGE_SECONDS, stage='verify_signature'):
+        if per_repo:
+            signed_repo, macs = offload.call(len(body), _repo_macs, registry,
+                                             gh_signature.algorithm, body)
+        signature_ok = _signature_matches(gh_signature, macs)
+    if not signature_ok:
         logging.warn('Invalid signature, skipping request.')
+        _skip('bad_signature')
         return 'nope'
 
-    json_dict = flask.request.get_json()
-    logging.info('json body: {0}'.format(json_dict))
+    try:
+        with stats.timer(STAGE_SECONDS, stage='parse'):
+            json_dict = offload.call(len(body), payload.parse_push, body,
+                                     _get_settings().max_commits)
+    except (ValueError, KeyError, TypeError) as e:
+        logging.warn('Malformed push payload (%r), skipping request.', e)
+        _skip('malformed')
+        return 'nope', 400
+    del body
 
     if json_dict['deleted']:
         logging.info('Branch was deleted, skipping email.')
+        _skip('deleted_branch')
         return 'nope'
 
-    added = '\n'.join(map(lambda f: 'A {0}'.format(f),
-                          json_dict['head_commit']['added']))
-    removed = '\n'.join(map(lambda f: 'R {0}'.format(f),
-                            json_dict['head_commit']['removed']))
-    modified = '\n'.join(map(lambda f: 'M {0}'.format(f),
-                             json_dict['head_commit']['modified']))
-    changes = '\n'.join(filter(lambda i: bool(i), [added, removed, modified]))
+    # The secret was picked by the first repo name in the body, which the
+    # parser may not have kept, e.g. if the body has more than one.
+    if per_repo and json_dict['repository']['full_name'] != signed_repo:
+        logging.warn('Push for %s was verified with the secret of %s, '
+                     'skipping request.',
+                     json_dict['repository']['full_name'], signed_repo)
+        _skip('bad_signature')
+        return 'nope'
+
+    with stats.timer(STAGE_SECONDS, stage='summarize'):
+        msg_info = _get_msg_info(json_dict)
+    if delivery_id:
+        msg_info['delivery_id'] = delivery_id
+    logging.info('Push of %s to %s %s by %s.', msg_info['revision'],
+                 msg_info['repo'], msg_info['branch'], msg_info['pusher'])
+
+    push_key = 'push:{0}:{1}:{2}'.format(
+        msg_info['repo'], msg_info['branch'], json_dict['head_commit']['id'])
+    dedup_keys = []
+    if dedup_cache is not None:
+        if delivery_id:
+            dedup_keys.append('delivery:' + delivery_id)
+        dedup_keys.append(push_key)
+        if not dedup_cache.add(*dedup_keys):
+            logging.info('Skipping duplicate push of %s to %s. Dedup '
+                         'stats: %s', msg_info['revision'],
+                         msg_info['branch'], dedup_cache.stats())
+            stats.inc('github_email_dedup_hits_total')
+            _skip('duplicate_push')
+            return 'nope'
+        stats.inc('github_email_dedup_misses_total')
+        # Carried along, so they can be forgotten if sending fails for good.
+        msg_info['dedup_keys'] = dedup_keys
+
+    # If the push is not accepted after all, forget it so github can
+    # redeliver it.
+    try:
+        with stats.timer(STAGE_SECONDS, stage='dispatch'):
+            return _dispatch(msg_info, push_key)
+    except delivery.QueueFull:
+        if dedup_keys:
+            dedup_cache.discard(*dedup_keys)
+        logging.warn('Delivery queue is full, rejecting request.')
+        _skip('queue_full')
+        return 'busy', 503
+    except ratelimit.RateLimited as e:
+        if dedup_keys:
+            dedup_cache.discard(*dedup_keys)
+        logging.warn('%s Rejecting request.', e)
+        _skip('rate_limited')
+        return 'busy', 503
+    except Exception:
+        if dedup_keys:
+            dedup_cache.discard(*dedup_keys)
+        raise
+
+
+def _repo_macs(registry, algorithm, body):
+    """Returns the repo the push in body claims to be for, and hmac objects
+    for its secrets, updated with body."""
+    repo = payload.scan_repo(body)
+    macs = registry.macs(algorithm, repo)
+    for mac in macs:
+        mac.update(body)
+    return repo, macs
+
+
+def _skip(reason):
+    """Count web hook that is not emailed, by reason."""
+    _get_metrics().inc('github_email_events_skipped_total', reason=reason)
+
+
+def _max_body_size():
+    """Returns largest web hook body accepted, in bytes."""
+    return _get_settings().max_body_size
+
+
+def _fast_reject(event, reason):
+    """Count and log web hook rejected before reaching flask."""
+    logging.info('Skipping "%s" event (%s).', event, reason)
+    _get_metrics().inc('github_email_events_received_total',
+                       event=_event_label(event))
+    _skip(reason)
+
+
+def _event_label(event):
+    """Returns metric label of github event type: the type if known, and
+    "other" otherwise."""
+    return event if event in GITHUB_EVENTS else 'other'
+
+
+def _get_msg_info(json_dict):
+    """Returns message info for email from push event. If the push has the
+    "commits" list (see GITHUB_COMMIT_EMAILER_MAX_COMMITS) with more than
+    one commit, the email covers all of them; otherwise just the head
+    commit."""
+    repo = json_dict['repository']['full_name']
+    head_commit = json_dict['head_commit']
+    commits = json_dict.get('commits') or []
+    if len(commits) > 1:
+        added, removed, modified = changes.combine(commits)
+    else:
+        commits = [head_commit]
+        added = head_commit['added']
+        removed = head_commit['removed']
+        modified = head_commit['modified']
+
+    config = _get_settings()
+    changed_files = changes.summarize(
+        added, removed, modified,
+        max_lines=config.max_changed_files,
+        max_bytes=config.max_changed_files_size,
+        stats=_get_diffstat(repo, [c['id'] for c in commits]))
 
     pusher_email = '{0} <{1}>'.format(json_dict['pusher']['name'],
                                       json_dict['pusher']['email'])
 
     msg_info = {
-        'repo': json_dict['repository']['full_name'],
+        'repo': repo,
         'branch': json_dict['ref'],
-        'revision': json_dict['head_commit']['id'][:7],
-        'message': json_dict['head_commit']['message'],
-        'changed_files': changes,
+        'revision': head_commit['id'][:7],
+        'message': head_commit['message'],
+        'changed_files': changed_files,
         'pusher': json_dict['pusher']['name'],
         'pusher_email': pusher_email,
         'compare_url': json_dict['compare'],
     }
-    _send_email(msg_info)
-
-    return 'yep'
-
-
-def _get_secret():
-    """Returns secret from environment. Raises ValueError if not set
-    in environment."""
-    if 'GITHUB_COMMIT_EMAILER_SECRET' not in os.environ:
-        logging.error('No secret configured in environment.')
-        raise ValueError('No secret configured in environment.')
-    return os.environ.get('GITHUB_COMMIT_EMAILER_SECRET')
+    if len(commits) > 1:
+        msg_info['subject'] = rendering.get_subject(
+            repo, head_commit['message'])
+        msg_info['message'] = _commits_message(
+            commits, json_dict.get('omitted_commits', 0))
+    return msg_info
+
+
+def _commits_message(commits, omitted):
+    """Returns message listing each commit of a push, after the number of
+    older commits that were omitted, if any."""
+    messages = []
+    if omitted:
+        messages.append(u'\u2026 {0:,} earlier commits not shown'.format(
+            omitted))
+    for c in commits:
+        messages.append(u'{0} by {1}:\n\n{2}'.format(
+            c['id'][:7], c['author'], c['message']).rstrip())
+    return u'\n\n'.join(messages)
+
+
+def _get_diffstat(repo, shas):
+    """Returns {path: (added, removed)} lines of commits from the repo's
+    mirror, or None if mirrors are not configured or the diffstat cannot be
+    computed in time."""
+    mirrors = _get_mirrors()
+    if mirrors is None:
+        return None
+    return mirrors.diffstat(repo, shas,
+                            budget=_get_settings().diffstat_budget)
+
+
+def _dispatch(msg_info, key=None):
+    """Send email for accepted push, or hand it off to be sent in the
+    background. Returns response for the web hook. Raises
+    delivery.QueueFull if the push cannot be accepted right now. `key`
+    identifies the push in the shared work queue, if configured."""
+    work_queue = _get_work_queue()
+    if work_queue is not None:
+        return _enqueue_work(work_queue, msg_info, key)
+
+    queue = _get_delivery_queue()
+    msg_spool = _get_spool()
+    if msg_spool is not None:
+        # Store message before acknowledging the web hook, so it is retried
+        # if sending fails or this process dies.
+        hold = 0
+        if _digest_buffer is not None:
+            hold = _digest_buffer.window_for(msg_info['repo']) or 0
+        msg_info['spool_ids'] = [msg_spool.put(msg_info, hold=hold)]
+
+    if queue is None:
+        if msg_spool is None:
+            _send_email(msg_info)
+        elif not _deliver_spooled([msg_info]):
+            return 'yep', 202
+        return 'yep'
+
+    if _digest_buffer is not None and _digest_buffer.add(msg_info):
+        logging.info('Holding push to %s for digest.', msg_info['repo'])
+        return 'yep', 202
+
+    try:
+        queue.put(msg_info)
+    except delivery.QueueFull:
+        if msg_spool is None:
+            raise
+        logging.warn('Delivery queue is full, leaving message in spool.')
+        msg_spool.release(msg_info['spool_ids'])
+    return 'yep', 202
+
+
+def _enqueue_work(work_queue, msg_info, key):
+    """Put push on the shared work queue, held for the digest window of its
+    repo, if any. Returns response for the web hook."""
+    window = batching.window_for(_digest_rules, msg_info['repo'])
+    group = None
+    if window is not None:
+        group = batching.digest_group(msg_info)
+    job_id = work_queue.put(
+        msg_info, key=key, delay=window or 0, group=group,
+        priority=_work_priority(msg_info) if _work_priority else 0,
+        repo=msg_info['repo'])
+    if job_id is None:
+        logging.info('Skipping push of %s to %s, already in the work queue.',
+                     msg_info['revision'], msg_info['branch'])
+        _skip('duplicate_push')
+        return 'nope'
+    if _senders is not None:
+        _senders.wake()
+    return 'yep', 202
+
+
+def _new_smtp():
+    """Returns new (not yet connected) SendGrid SMTP connection, or plain
+    SMTP connection to GITHUB_COMMIT_EMAILER_SMTP_HOST if set, e.g. a local
+    sink for load tests."""
+    import envelopes
+
+    host = os.environ.get('GITHUB_COMMIT_EMAILER_SMTP_HOST')
+    if host:
+        return envelopes.SMTP(
+            host=host,
+            port=int(os.environ.get('GITHUB_COMMIT_EMAILER_SMTP_PORT', 25)),
+            timeout=30)
+    return envelopes.SendGridSMTP(
+        login=os.environ.get('SENDGRID_USERNAME'),
+        password=os.environ.get('SENDGRID_PASSWORD'))
+
+
+def _get_smtp_pool():
+    """Returns the process-wide SMTP connection pool, creating it on first
+    use."""
+    global _smtp_pool
+    with _smtp_pool_lock:
+        if _smtp_pool is None:
+            _smtp_pool = smtp_pool.SMTPPool(
+                _new_smtp,
+                max_size=int(os.environ.get(
+                    'GITHUB_COMMIT_EMAILER_SMTP_POOL_SIZE', 2)),
+                idle_timeout=float(os.environ.get(
+                    'GITHUB_COMMIT_EMAILER_SMTP_IDLE_TIMEOUT', 60)),
+                max_age=float(os.environ.get(
+                    'GITHUB_COMMIT_EMAILER_SMTP_MAX_AGE', 300)),
+                metrics=_get_metrics())
+        return _smtp_pool
+
+
+def _get_metrics():
+    """Returns the process-wide metrics, creating them on first use. If
+    GITHUB_COMMIT_EMAILER_METRICS_DIR is set, snapshots of the metrics of
+    each worker process are written there, so they can be added up."""
+    global _metrics
+    stats = _metrics
+    if stats is None:
+        with _metrics_lock:
+            if _metrics is None:
+                snapshot_dir = os.environ.get(
+                    'GITHUB_COMMIT_EMAILER_METRICS_DIR')
+                _metrics = metrics.Metrics(snapshot_dir)
+                if snapshot_dir:
+                    atexit.register(_metrics.stop)
+            stats = _metrics
+    return stats
+
+
+def _get_delivery_queue():
+    """Returns the process-wide delivery queue, creating it on first use.
+    Returns None when background delivery is not configured, in which case
+    emails are sent before responding to the web hook.
+
+    The digest buffer is created along with the queue, since held pushes can
+    only be sent in the background."""
+    global _delivery_queue, _digest_buffer
+    workers = _get_settings().send_workers
+    if workers <= 0:
+        return None
+
+    with _delivery_queue_lock:
+        if _delivery_queue is None:
+            max_depth = int(os.environ.get(
+                'GITHUB_COMMIT_EMAILER_QUEUE_SIZE', 100))
+            batch_size = int(os.environ.get(
+                'GITHUB_COMMIT_EMAILER_BATCH_SIZE', 10))
+            rules = _parse_digest_rules()
+            if rules:
+                _digest_buffer = batching.DigestBuffer(_enqueue_digest, rules)
+            _delivery_queue = delivery.DeliveryQueue(
+                _deliver, workers=workers, max_depth=max_depth,
+                batch_size=batch_size, priority=_parse_branch_priority())
+            atexit.register(_drain_delivery_queue)
+        return _delivery_queue
+
+
+def _parse_branch_priority():
+    """Returns priority function for pushes from env config."""
+    priority_branches = os.environ.get(
+        'GITHUB_COMMIT_EMAILER_PRIORITY_BRANCHES',
+        'refs/heads/master,refs/heads/release/*')
+    return delivery.branch_priority(
+        [p.strip() for p in priority_branches.split(',') if p.strip()])
+
+
+def _parse_digest_rules():
+    """Returns digest rules from env config."""
+    return batching.parse_digest_rules(
+        os.environ.get('GITHUB_COMMIT_EMAILER_DIGEST_REPOS', ''),
+        default_window=float(os.environ.get(
+            'GITHUB_COMMIT_EMAILER_DIGEST_WINDOW', 60)))
+
+
+def _get_work_queue():
+    """Returns the process-wide handle on the work queue shared with other
+    nodes, creating it on first use, along with sender threads if send
+    workers are configured. Returns None when no work queue is configured.
+    """
+    global _work_queue, _senders, _digest_rules, _work_priority
+    config = _get_settings()
+    if not config.work_queue:
+        return None
+
+    with _work_queue_lock:
+        if _work_queue is None:
+            lease = float(os.environ.get(
+                'GITHUB_COMMIT_EMAILER_WORK_QUEUE_LEASE', 60))
+            _digest_rules = _parse_digest_rules()
+            _work_priority = _parse_branch_priority()
+            _work_queue = workqueue.open_queue(
+                config.work_queue,
+                lease=lease,
+                max_attempts=int(os.environ.get(
+                    'GITHUB_COMMIT_EMAILER_MAX_ATTEMPTS', 8)),
+                retention=float(os.environ.get(
+                    'GITHUB_COMMIT_EMAILER_WORK_QUEUE_RETENTION', 86400)))
+            if config.send_workers > 0:
+                _senders = workqueue.Senders(
+                    _work_queue, _deliver_jobs,
+                    workers=config.send_workers,
+                    batch_size=int(os.environ.get(
+                        'GITHUB_COMMIT_EMAILER_BATCH_SIZE', 10)),
+                    heartbeat=lease / 3)
+                _senders.start()
+                atexit.register(_stop_senders)
+        return _work_queue
+
+
+def _get_spool():
+    """Returns the process-wide message spool, creating it and starting its
+    retry scheduler on first use. Returns None when no spool is
+    configured."""
+    global _spool
+    path = _get_settings().spool_path
+    if not path:
+        return None
+
+    with _spool_lock:
+        if _spool is None:
+            lease = float(os.environ.get(
+                'GITHUB_COMMIT_EMAILER_SPOOL_LEASE', 60))
+            _spool = spool.Spool(
+                path,
+                dead_letter_dir=os.environ.get(
+                    'GITHUB_COMMIT_EMAILER_DEAD_LETTER_DIR'),
+                max_attempts=int(os.environ.get(
+                    'GITHUB_COMMIT_EMAILER_MAX_ATTEMPTS', 8)),
+                lease=lease)
+            scheduler = spool.RetryScheduler(
+                _spool, _deliver,
+                interval=float(os.environ.get(
+                    'GITHUB_COMMIT_EMAILER_RETRY_INTERVAL', 10)),
+                heartbeat=lease / 3)
+            scheduler.start()
+            atexit.register(scheduler.stop, 5)
+        return _spool
+
+
+def _get_dedup_cache():
+    """Returns the process-wide cache of accepted deliveries, creating it on
+    first use. Returns None when deduplication is not configured."""
+    global _dedup_cache
+    ttl = _get_settings().dedup_ttl
+    if ttl <= 0:
+        return None
+
+    with _dedup_cache_lock:
+        if _dedup_cache is None:
+            max_entries = int(os.environ.get(
+                'GITHUB_COMMIT_EMAILER_DEDUP_SIZE', 10000))
+            shared = None
+            path = os.environ.get('GITHUB_COMMIT_EMAILER_DEDUP_PATH')
+            if path:
+                shared = dedup.SQLiteStore(path, max_entries=max_entries,
+                                           ttl=ttl)
+            _dedup_cache = dedup.DedupCache(
+                dedup.LRUCache(max_entries=max_entries, ttl=ttl), shared)
+        return _dedup_cache
+
+
+def _get_rate_limiter():
+    """Returns the process-wide limiter of outgoing emails, creating it on
+    first use. Returns None when no rate limit is configured."""
+    global _rate_limiter
+    # Limits are configured per minute.
+    config = _get_settings()
+    rate = config.rate_limit
+    recipient_rate = config.recipient_rate_limit
+    if rate <= 0 and recipient_rate <= 0:
+        return None
+
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            path = os.environ.get('GITHUB_COMMIT_EMAILER_RATE_LIMIT_PATH')
+            if path:
+                buckets = ratelimit.SQLiteBuckets(path)
+            else:
+                buckets = ratelimit.MemoryBuckets()
+            _rate_limiter = ratelimit.RateLimiter(
+                buckets,
+                rate=max(0, rate) / 60,
+                burst=int(os.environ.get(
+                    'GITHUB_COMMIT_EMAILER_RATE_BURST', 10)),
+                recipient_rate=max(0, recipient_rate) / 60,
+                recipient_burst=int(os.environ.get(
+                    'GITHUB_COMMIT_EMAILER_RECIPIENT_RATE_BURST', 5)))
+        return _rate_limiter
+
+
+def _get_mirrors():
+    """Returns the process-wide git mirrors to compute diffstats with,
+    creating them on first use. Returns None when no mirror dir is
+    configured."""
+    global _mirrors
+    root = _get_settings().mirror_dir
+    if not root:
+        return None
+
+    with _mirrors_lock:
+        if _mirrors is None:
+            _mirrors = diffstat.Mirrors(root, diffstat.DiffstatCache(
+                max_entries=int(os.environ.get(
+                    'GITHUB_COMMIT_EMAILER_DIFFSTAT_CACHE_SIZE', 1000))))
+        return _mirrors
+
+
+def _throttle(msgs, max_wait=None):
+    """Wait until the rate limits, if any, allow sending msgs. Raises
+    ratelimit.RateLimited if that would take more than `max_wait`
+    seconds."""
+    limiter = _get_rate_limiter()
+    if limiter is None:
+        return
+    with _get_metrics().timer(STAGE_SECONDS, stage='rate_limit'):
+        for msg in msgs:
+            limiter.acquire(msg.to_addrs, max_wait=max_wait)
+
+
+def _enqueue_digest(msg_info):
+    """Queue digest email, or send it right away if the queue is full."""
+    try:
+        _delivery_queue.put(msg_info)
+    except delivery.QueueFull:
+        if _get_spool() is None:
+            _deliver([msg_info])
+        else:
+            _deliver_spooled([msg_info])
+
+
+def _deliver_spooled(msg_infos):
+    """Send spooled messages from a thread that must not wait long for the
+    rate limits, like a web hook's. If they do not allow sending within
+    GITHUB_COMMIT_EMAILER_RATE_LIMIT_WAIT seconds, the messages are left in
+    the spool for the retry scheduler. Returns False in that case."""
+    try:
+        _deliver(msg_infos, max_wait=_get_settings().rate_limit_wait)
+    except ratelimit.RateLimited as e:
+        logging.warn('%s Leaving message in spool.', e)
+        _get_spool().release(
+            [i for msg_info in msg_infos
+             for i in msg_info.get('spool_ids', [])])
+        return False
+    return True
+
+
+def _stop_senders():
+    """Finish sending claimed jobs before the process exits. Jobs not yet
+    claimed are left to the senders of other nodes."""
+    timeout = float(os.environ.get(
+        'GITHUB_COMMIT_EMAILER_DRAIN_TIMEOUT', 25))
+    if not _senders.stop(timeout=timeout):
+        logging.error('Senders did not finish within %ss, their jobs will be '
+                      'retried once their leases expire.', timeout)
+
+
+def _drain_delivery_queue():
+    """Send all accepted messages before the process exits."""
+    if _delivery_queue is None:
+        return
+    if _digest_buffer is not None:
+        _digest_buffer.flush_all()
+    timeout = float(os.environ.get(
+        'GITHUB_COMMIT_EMAILER_DRAIN_TIMEOUT', 25))
+    logging.info('Draining %d queued message(s).', _delivery_queue.qsize())
+    if not _delivery_queue.shutdown(timeout=timeout):
+        logging.error('Delivery queue did not drain within %ss.', timeout)
+    if _smtp_pool is not None:
+        logging.info('SMTP pool stats: %s', _smtp_pool.stats())
+
+
+def _deliver_jobs(jobs):
+    """Send jobs claimed from the work queue. Jobs held for a digest are
+    merged with the other jobs of their group. Returns list with the error
+    of each job, or None for each job that was sent."""
+    merged = collections.OrderedDict()
+    for job in jobs:
+        merged.setdefault(job.group or ('job', job.id), []).append(job)
+    msg_infos = []
+    for group_jobs in merged.values():
+        if len(group_jobs) == 1:
+            msg_infos.append(group_jobs[0].msg_info)
+        else:
+            msg_infos.append(batching.make_digest(
+                [job.msg_info for job in group_jobs]))
+
+    errors = {}
+    for group_jobs, error in zip(merged.values(), _deliver(msg_infos)):
+        for job in group_jobs:
+            errors[job.id] = error
+    return [errors[job.id] for job in jobs]
+
+
+def _deliver(msg_infos, max_wait=None):
+    """Send batch of emails over one SMTP session. Failures are reported per
+    message, so one bad message does not keep the rest of the batch from
+    being sent. Spooled messages are acked once sent, or scheduled for
+    retry, also if the batch could not be sent at all, e.g. because no SMTP
+    connection became available in time. Returns list with the error of
+    each message, or None for each message that was sent. Raises
+    ratelimit.RateLimited, before sending anything, if the rate limits do
+    not allow sending within `max_wait` seconds."""
+    msg_spool = _get_spool()
+    results = [None] * len(msg_infos)
+    built = []
+    for i, msg_info in enumerate(msg_infos):
+        try:
+            with logs.context(delivery_id=msg_info.get('delivery_id')):
+                built.append((i, msg_info, _build_email(msg_info)))
+        except Exception as e:
+            _report_exc_info()
+            logging.exception('Failed to build email for %s.',
+                              msg_info.get('repo'))
+            _get_metrics().inc('github_email_emails_failed_total')
+            results[i] = e
+            _fail(msg_spool, msg_info, e)
+
+    msgs = [msg for _, _, msg in built]
+    try:
+        _throttle(msgs, max_wait=max_wait)
+        logging.info('Sending %d email(s) for deliveries %s.', len(msgs),
+                     ', '.join(m.get('delivery_id', '-') for _, m, _ in built))
+        errors = _get_smtp_pool().send_many(msgs)
+    except ratelimit.RateLimited:
+        raise
+    except Exception as e:
+        errors = [e] * len(built)
+    stats = _get_metrics()
+    for (i, msg_info, msg), error in zip(built, errors):
+        results[i] = error
+        if error is None:
+            stats.inc('github_email_emails_sent_total')
+            if msg_spool is not None:
+                msg_spool.ack(msg_info.get('spool_ids', []))
+            continue
+        stats.inc('github_email_emails_failed_total')
+        _report_exc_info((type(error), error, None))
+        with logs.context(delivery_id=msg_info.get('delivery_id')):
+            logging.error('Failed to send email %s: %r', msg, error)
+        _fail(msg_spool, msg_info, error)
+    return results
+
+
+def _fail(msg_spool, msg_info, error):
+    """Schedule retry of a message that failed to send, if it is spooled.
+    Once it will not be retried, forget the deliveries it was sent for, so
+    that github redeliveries of them are accepted."""
+    if msg_spool is not None:
+        if not msg_spool.fail(msg_info.get('spool_ids', []), error):
+            return
+    dedup_keys = msg_info.get('dedup_keys')
+    dedup_cache = _get_dedup_cache()
+    if dedup_keys and dedup_cache is not None:
+        dedup_cache.discard(*dedup_keys)
+
+
+def _get_secret_registry():
+    """Returns process-wide web hook secret registry, creating it from env
+    config on first use, or after SIGHUP. Raises ValueError if no secret is
+    configured."""
+    global _secret_registry
+    registry = _secret_registry
+    if registry is None:
+        with _secret_registry_lock:
+            if _secret_registry is None:
+                _secret_registry = signatures.load_registry()
+            registry = _secret_registry
+    return registry
 
 
 def _send_email(msg_info):
-    """Create and send commit notification email."""
-    sender = _get_sender(msg_info['pusher_email'])
-    recipient = os.environ.get('GITHUB_COMMIT_EMAILER_RECIPIENT')
-
-    if sender is None or recipient is None:
-        logging.error('sender and recipient config vars must be set.')
-        raise ValueError('sender and recipient config vars must be set.')
-
-    reply_to = os.environ.get('GITHUB_COMMIT_EMAILER_REPLY_TO', None)
-    approved = os.environ.get('GITHUB_COMMIT_EMAILER_APPROVED_HEADER', None)
-    subject = _get_subject(msg_info['repo'], msg_info['message'])
-
-    body = """Branch: {branch}
-Revision: {revision}
-Author: {pusher}
-
-Log Message:
-------------
-{message}
-
-Modified Files:
----------------
-{changed_files}
-
-Compare: {compare_url}
-""".format(**msg_info)
-
-    msg = envelopes.Envelope(
-        to_addr=recipient,
-        from_addr=sender,
-        subject=subject,
-        text_body=body
-    )
-
-    if reply_to is not None:
-        msg.add_header('Reply-To', reply_to)
-    if approved is not None:
-        msg.add_header('Approved', approved)
-
-    # Disable SendGrid click tracking.
-    send_grid_disable_click_tracking = json.dumps(
-        {'filters': {'clicktrack': {'settings': {'enable': 0}}}})
-    msg.add_header('X-SMTPAPI', send_grid_disable_click_tracking)
-
-    smtp = envelopes.connstack.get_current_connection()
-    logging.info('Sending email: {0}'.format(msg))
-    smtp.send(msg)
-
-
-def _get_sender(pusher_email):
-    """Returns "From" address based on env config and default from."""
-    use_author = 'GITHUB_COMMIT_EMAILER_SEND_FROM_AUTHOR' in os.environ
-    if use_author:
-        sender = pusher_email
-    else:
-        sender = os.environ.get('GITHUB_COMMIT_EMAILER_SENDER')
-    return sender
-
-
-def _get_subject(repo, message):
-    """Returns subject line from repo name and commit message."""
-    message_lines = message.splitlines()
-
-    # For github merge commit messages, the first line is "Merged pull request
-    # #blah ...", followed by two line breaks. The third line is where the
-    # author's commit message starts. So, if a third line is available, use
-    # it. Otherwise, just use the first line.
-    if len(message_lines) >= 3:
-        subject_msg = message_lines[2]
+    """Create and send commit notification email. Raises
+    ratelimit.RateLimited if a rate limit does not allow sending it within
+    GITHUB_COMMIT_EMAILER_RATE_LIMIT_WAIT seconds."""
+    stats = _get_metrics()
+    with logs.context(delivery_id=msg_info.get('delivery_id')):
+        try:
+            msg = _build_email(msg_info)
+            _throttle([msg], max_wait=_get_settings().rate_limit_wait)
+            logging.info('Sending email: %s', msg)
+            _get_smtp_pool().send(msg)
+        except ratelimit.RateLimited:
+            raise
+        except Exception:
+            stats.inc('github_email_emails_failed_total')
+            raise
+    stats.inc('github_email_emails_sent_total')
+
+
+def _build_email(msg_info):
+    """Returns commit notification email for message info."""
+    try:
+        with _get_metrics().timer(STAGE_SECONDS, stage='render'):
+            return _get_renderer().render(msg_info)
+    except ValueError as e:
+        logging.error(str(e))
+        raise
+
+
+def _get_renderer():
+    """Returns process-wide email renderer, creating it from env config and
+    templates on first use, or after SIGHUP."""
+    global _renderer
+    renderer = _renderer
+    if renderer is None:
+        with _renderer_lock:
+            if _renderer is None:
+                _renderer = rendering.Renderer(rendering.load_config())
+            renderer = _renderer
+    return renderer
+
+
+def _get_settings():
+    """Returns process-wide settings read while handling web hooks, parsing
+    them from env config on first use, or after SIGHUP."""
+    global _settings
+    config = _settings
+    if config is None:
+        with _settings_lock:
+            if _settings is None:
+                _settings = settings.load_settings()
+            config = _settings
+    return config
+
+
+def _report_exc_info(exc_info=None):
+    """Report exception, the one being handled by default, to rollbar."""
+    import rollbar
+
+    if exc_info is None:
+        rollbar.report_exc_info()
     else:
-        subject_msg = message_lines[0]
-    subject_msg = subject_msg[:50]
-    subject = '[{0}] {1}'.format(repo, subject_msg)
-    return subject
-
-
-def _valid_signature(gh_signature, body, secret):
-    """Returns True if GitHub signature is valid. False, otherwise."""
-    if isinstance(gh_signature, unicode):
-        gh_signature = str(gh_signature)
-    expected_hmac = hmac.new(secret, body, sha)
-    expected_signature = 'sha1=' + expected_hmac.hexdigest()
-    return hmac.compare_digest(expected_signature, gh_signature)
+        rollbar.report_exc_info(exc_info)
+
+
+def _reload_config(signum, frame):
+    """Signal handler that makes the next request and email reload settings,
+    secrets, email config and templates."""
+    global _renderer, _secret_registry, _settings
+    logging.info('Reloading settings, secrets, email config and templates.')
+    _renderer = None
+    _secret_registry = None
+    _settings = None
+
+
+if hasattr(signal, 'SIGHUP'):
+    signal.signal(signal.SIGHUP, _reload_config)
+
+
+def _signature_matches(gh_signature, expected_macs):
+    """Returns True if GitHub signature matches any of the hmac objects that
+    have been fed the request body. False, otherwise."""
+    if gh_signature is None:
+        return False
+    matched = False
+    for mac in expected_macs:
+        # Compare with every secret, so timing does not tell which matched.
+        if hmac.compare_digest(mac.hexdigest(), gh_signature.hexdigest):
+            matched = True
+    return matched
+
+
+# Answer events that are not emailed, and bodies that are too large, before
+# flask sets up the request.
+app.wsgi_app = fastpath.FastPath(
+    app.wsgi_app,
+    paths=[rule.rule for rule in app.url_map.iter_rules()],
+    hook_path='/commit-email',
+    events=[e.strip() for e in os.environ.get(
+        'GITHUB_COMMIT_EMAILER_EVENTS', 'push').split(',') if e.strip()],
+    max_body_size=_max_body_size,
+    on_reject=_fast_reject)
@@ -0,0 +1,68 @@
+"""WSGI middleware that answers web hooks the app would ignore anyway."""
+
+NOT_FOUND_BODY = (
+    '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">\n'
+    '<title>404 Not Found</title>\n'
+    '<h1>Not Found</h1>\n'
+    '<p>The requested URL was not found on the server.  If you entered the '
+    'URL manually please check your spelling and try again.</p>\n')
+
+
+class FastPath(object):
+    """Wraps WSGI `app`, answering requests that do not need it from the
+    path and headers alone, without reading the body:
+
+    * paths that are not in `paths` get a 404,
+    * POSTs to `hook_path` of events not in `events` get "nope", like the
+      app answers them,
+    * POSTs to `hook_path` with a content length over `max_body_size()`
+      bytes get a 413.
+
+    `on_reject(event, reason)` is called for each rejected web hook, with
+    reason "not_push" or "too_large". Everything else, including web hooks
+    without an event header, goes to the app.
+    """
+
+    def __init__(self, app, paths, hook_path, events=('push',),
+                 max_body_size=None, on_reject=None):
+        self._app = app
+        self._paths = frozenset(paths)
+        self._hook_path = hook_path
+        self._events = frozenset(events)
+        self._max_body_size = max_body_size
+        self._on_reject = on_reject
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO') or '/'
+        if path not in self._paths:
+            return _respond(start_response, '404 NOT FOUND', NOT_FOUND_BODY)
+        if path != self._hook_path or environ['REQUEST_METHOD'] != 'POST':
+            return self._app(environ, start_response)
+
+        event = environ.get('HTTP_X_GITHUB_EVENT')
+        if event is None:
+            return self._app(environ, start_response)
+        if event not in self._events:
+            self._reject(event, 'not_push')
+            return _respond(start_response, '200 OK', 'nope')
+
+        if self._max_body_size is not None:
+            try:
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                length = 0
+            if length > self._max_body_size():
+                self._reject(event, 'too_large')
+                return _respond(start_response, '413 REQUEST ENTITY TOO LARGE',
+                                'nope')
+        return self._app(environ, start_response)
+
+    def _reject(self, event, reason):
+        if self._on_reject is not None:
+            self._on_reject(event, reason)
+
+
+def _respond(start_response, status, body):
+    start_response(status, [('Content-Type', 'text/html; charset=utf-8'),
+                            ('Content-Length', str(len(body)))])
+    return [body]
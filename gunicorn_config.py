@@ -0,0 +1,31 @@
+"""gunicorn settings for serving emailer:app with a preloaded app.
+
+    gunicorn emailer:app --config gunicorn_config.py --log-file=-
+
+The app is imported, and its config and templates parsed, once in the
+master. Forked workers share that copy-on-write, then set up their own
+connections and threads before serving their first web hook. SIGHUP to the
+master reloads the config there and replaces the workers.
+"""
+
+preload_app = True
+
+
+def on_starting(server):
+    """Parse config in the master, before workers are forked."""
+    import emailer
+    emailer.preload()
+
+
+def on_reload(server):
+    """Parse config again in the master on SIGHUP, before the workers are
+    replaced by ones forked from it."""
+    import emailer
+    emailer.reload()
+
+
+def post_worker_init(worker):
+    """Set up connections and threads of each worker, once it has loaded
+    the app."""
+    import emailer
+    emailer.init_worker()
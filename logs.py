@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""Non-blocking, redacted, optionally JSON structured logging.
+
+Records are put on a bounded queue by the thread that logs them and
+formatted and written by a background thread, so requests never wait for
+stderr (or papertrail behind it), and messages logged with arguments, like
+logging.info('Push of %s.', revision), are only formatted by that thread.
+Arguments must therefore not be changed after they are logged.
+"""
+
+import contextlib
+import datetime
+import json
+import logging
+import os
+import Queue
+import random
+import re
+import sys
+import threading
+
+# Matches email addresses, keeping the domain.
+_EMAIL_RE = re.compile(r'[\w.+-]+@([\w-]+(?:\.[\w-]+)+)')
+
+# Redact names that are not fields, but what to redact in message text.
+REDACT_EMAILS = 'emails'
+
+DEFAULT_REDACT = (REDACT_EMAILS, 'pusher_email', 'from_addr', 'to_addrs')
+
+_context = threading.local()
+
+
+@contextlib.contextmanager
+def context(**fields):
+    """Context manager that adds fields, e.g. the delivery id of the web hook
+    being handled, to every record logged by this thread within it. Fields
+    that are None are left out."""
+    old = getattr(_context, 'fields', {})
+    _context.fields = dict(old)
+    _context.fields.update(
+        (name, value) for name, value in fields.items() if value is not None)
+    try:
+        yield
+    finally:
+        _context.fields = old
+
+
+def current_context():
+    """Returns fields of the innermost context of this thread."""
+    return getattr(_context, 'fields', {})
+
+
+class Redactor(object):
+    """Redacts fields named in `redact`, masks email addresses in text if
+    REDACT_EMAILS is in `redact`, and caps text at `max_length`
+    characters."""
+
+    def __init__(self, redact=DEFAULT_REDACT, max_length=2000):
+        self._fields = frozenset(redact) - set([REDACT_EMAILS])
+        self._emails = REDACT_EMAILS in redact
+        self._max_length = max_length
+
+    def text(self, value):
+        """Returns text masked and capped."""
+        if not isinstance(value, basestring):
+            value = str(value)
+        if self._emails:
+            value = _EMAIL_RE.sub(r'***@\1', value)
+        if self._max_length and len(value) > self._max_length:
+            value = u'{0}… ({1:,} more characters)'.format(
+                value[:self._max_length], len(value) - self._max_length)
+        return value
+
+    def fields(self, fields):
+        """Returns copy of fields dict with redacted values replaced."""
+        result = {}
+        for name, value in fields.iteritems():
+            if name in self._fields:
+                result[name] = '[redacted]'
+            elif isinstance(value, (int, long, float, bool)) or value is None:
+                result[name] = value
+            else:
+                result[name] = self.text(value)
+        return result
+
+
+class TextFormatter(logging.Formatter):
+    """Same format as logging.basicConfig(), with the message and context
+    fields redacted."""
+
+    def __init__(self, redactor):
+        logging.Formatter.__init__(self, logging.BASIC_FORMAT)
+        self._redactor = redactor
+
+    def format(self, record):
+        record.message = self._redactor.text(record.getMessage())
+        text = self._fmt % record.__dict__
+        fields = self._redactor.fields(getattr(record, 'context', {}))
+        if fields:
+            text += ' ' + ' '.join('{0}={1}'.format(k, v)
+                                   for k, v in sorted(fields.items()))
+        if record.exc_text:
+            text += '\n' + record.exc_text
+        return text
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as one JSON object per line, with the context fields
+    of the record and any dict passed as extra={'fields': ...}."""
+
+    def __init__(self, redactor):
+        logging.Formatter.__init__(self)
+        self._redactor = redactor
+
+    def format(self, record):
+        data = {}
+        data.update(getattr(record, 'context', {}))
+        data.update(getattr(record, 'fields', None) or {})
+        data = self._redactor.fields(data)
+        data.update({
+            'time': datetime.datetime.utcfromtimestamp(
+                record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': self._redactor.text(record.getMessage()),
+            'pid': record.process,
+            'thread': record.threadName,
+        })
+        if record.exc_text:
+            data['exc'] = self._redactor.text(record.exc_text)
+        return json.dumps(data, sort_keys=True)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a `rate` fraction of records below INFO, and all others."""
+
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self._rate = rate
+
+    def filter(self, record):
+        if record.levelno >= logging.INFO or self._rate >= 1:
+            return True
+        return random.random() < self._rate
+
+
+class QueueHandler(logging.Handler):
+    """Hands records to a background thread that writes them with
+    `handler`. When `max_size` records are waiting, new ones are dropped
+    and counted rather than blocking the caller. The thread is started on
+    first use in each process, so it also works in forked workers."""
+
+    def __init__(self, handler, max_size=10000):
+        logging.Handler.__init__(self)
+        self._handler = handler
+        self._max_size = max_size
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            # Tracebacks reference frames of the caller, so they are
+            # formatted here; everything else is left to the writer.
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+                record.exc_info = None
+            record.context = current_context()
+            self.start()
+            try:
+                self._queue.put_nowait(record)
+            except Queue.Full:
+                self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        """Write every waiting record and stop the writer thread."""
+        with self._start_lock:
+            if self._thread is not None and self._pid == os.getpid():
+                self._queue.put(None)
+                self._thread.join()
+            self._thread = None
+            self._pid = None
+        self._handler.close()
+        logging.Handler.close(self)
+
+    def start(self):
+        """Start the writer thread of this process, unless running. Called
+        on first use, but can be called up front in a fresh process."""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue.Queue(maxsize=self._max_size)
+            self._thread = threading.Thread(target=self._run,
+                                            args=(self._queue,),
+                                            name='log-writer')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self, queue):
+        while True:
+            record = queue.get()
+            if record is not None:
+                try:
+                    self._handler.handle(record)
+                except Exception:
+                    self._handler.handleError(record)
+            if self.dropped and (record is None or queue.empty()):
+                dropped, self.dropped = self.dropped, 0
+                self._handler.handle(logging.makeLogRecord({
+                    'name': 'logs', 'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'msg': 'Dropped %d log records, queue was full.',
+                    'args': (dropped,)}))
+            if record is None:
+                return
+
+
+def configure(environ=None, stream=None):
+    """Send log records of the root logger through a QueueHandler, unless it
+    already has handlers, like logging.basicConfig(). Configured in
+    `environ`, which defaults to os.environ. Returns the handler, or None.
+    """
+    if environ is None:
+        environ = os.environ
+    root = logging.getLogger()
+    if root.handlers:
+        return None
+
+    redactor = Redactor(
+        redact=[name.strip() for name in environ.get(
+            'GITHUB_COMMIT_EMAILER_LOG_REDACT',
+            ','.join(DEFAULT_REDACT)).split(',') if name.strip()],
+        max_length=int(environ.get('GITHUB_COMMIT_EMAILER_LOG_MAX_LENGTH',
+                                   2000)))
+    writer = logging.StreamHandler(stream or sys.stderr)
+    if environ.get('GITHUB_COMMIT_EMAILER_LOG_FORMAT') == 'json':
+        writer.setFormatter(JSONFormatter(redactor))
+    else:
+        writer.setFormatter(TextFormatter(redactor))
+
+    handler = QueueHandler(writer)
+    handler.addFilter(SamplingFilter(float(environ.get(
+        'GITHUB_COMMIT_EMAILER_LOG_DEBUG_SAMPLE', 1))))
+    root.addHandler(handler)
+    root.setLevel(environ.get('GITHUB_COMMIT_EMAILER_LOG_LEVEL', 'INFO'))
+    return handler
@@ -0,0 +1,331 @@
+"""Counters and latency histograms, exported in Prometheus text format."""
+
+import contextlib
+import errno
+import fcntl
+import glob
+import json
+import logging
+import os
+import os.path
+import tempfile
+import threading
+import time
+import uuid
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, 30.0)
+
+# Quantiles estimated from the histogram buckets.
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Snapshot holding the added up metrics of processes that have exited.
+EXITED = 'exited.json'
+
+# Help text of each known metric, by name.
+COUNTERS = {
+    'github_email_events_received_total':
+        'Web hook events received, by github event type.',
+    'github_email_events_skipped_total':
+        'Web hook events not emailed, by reason.',
+    'github_email_emails_sent_total': 'Emails sent.',
+    'github_email_emails_failed_total': 'Emails that failed to send.',
+    'github_email_dedup_hits_total':
+        'Deliveries found to be duplicates of accepted ones.',
+    'github_email_dedup_misses_total':
+        'Deliveries checked for duplicates and accepted as new.',
+}
+HISTOGRAMS = {
+    'github_email_request_seconds':
+        'Time to answer HTTP requests, by endpoint and status.',
+    'github_email_stage_seconds':
+        'Time spent in each stage of handling a push and sending its email.',
+}
+
+
+class Metrics(object):
+    """Counters and histograms of one process.
+
+    If `snapshot_dir` is set, a snapshot of them is written there as
+    <pid>-<random>.json every `interval` seconds, and collect() adds up the
+    snapshots of all processes, e.g. all gunicorn workers. Snapshots of
+    processes that have exited are added up into one file, so totals do not
+    go backwards, and a new process with the same pid does not replace them.
+    """
+
+    def __init__(self, snapshot_dir=None, interval=5):
+        self._snapshot_dir = snapshot_dir
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._thread = None
+        self._stopped = threading.Event()
+        self._name = None
+        self._name_pid = None
+
+    def inc(self, name, value=1, **labels):
+        """Add value to counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._start()
+
+    def observe(self, name, seconds, **labels):
+        """Record duration in histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        i = 0
+        while i < len(BUCKETS) and seconds > BUCKETS[i]:
+            i += 1
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * (len(BUCKETS) + 1),
+                                                0.0]
+            hist[0][i] += 1
+            hist[1] += seconds
+        self._start()
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Context manager that records the time spent in it in
+        histogram."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def snapshot(self):
+        """Returns JSON serializable copy of this process's metrics."""
+        with self._lock:
+            counters = [[name, dict(labels), value]
+                        for (name, labels), value in self._counters.items()]
+            histograms = [[name, dict(labels), list(hist[0]), hist[1]]
+                          for (name, labels), hist in
+                          self._histograms.items()]
+        return {'counters': counters, 'histograms': histograms}
+
+    def write_snapshot(self):
+        """Write snapshot to the snapshot dir, if set, atomically."""
+        if not self._snapshot_dir:
+            return
+        if not os.path.isdir(self._snapshot_dir):
+            os.makedirs(self._snapshot_dir)
+        self._write(self._snapshot_path(), self.snapshot())
+
+    def collect(self):
+        """Returns snapshot of this process's metrics added up with the
+        snapshots of all other processes in the snapshot dir. Snapshots of
+        processes that have exited are first added up into one."""
+        snapshots = [self.snapshot()]
+        if self._snapshot_dir:
+            if not os.path.isdir(self._snapshot_dir):
+                os.makedirs(self._snapshot_dir)
+            own = self._snapshot_path()
+            with open(os.path.join(self._snapshot_dir, '.lock'), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self._fold_exited(own)
+                for path in glob.glob(os.path.join(self._snapshot_dir,
+                                                   '*.json')):
+                    if path != own:
+                        snapshot = _read(path)
+                        if snapshot is not None:
+                            snapshots.append(snapshot)
+        return merge(snapshots)
+
+    def stop(self):
+        """Stop writing snapshots, after writing a final one."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write_snapshot()
+
+    def _snapshot_path(self):
+        """Returns path of this process's snapshot. The name is chosen anew
+        in forked processes."""
+        pid = os.getpid()
+        if self._name_pid != pid:
+            self._name = '{0}-{1}.json'.format(pid, uuid.uuid4().hex[:8])
+            self._name_pid = pid
+        return os.path.join(self._snapshot_dir, self._name)
+
+    def _fold_exited(self, own):
+        """Add the snapshots of processes that have exited to the exited
+        snapshot, and remove them. Called with the snapshot dir locked."""
+        paths = [path for path in glob.glob(os.path.join(self._snapshot_dir,
+                                                         '*-*.json'))
+                 if path != own and not _alive(_pid(path))]
+        if not paths:
+            return
+        exited_path = os.path.join(self._snapshot_dir, EXITED)
+        snapshots = []
+        if os.path.exists(exited_path):
+            snapshot = _read(exited_path)
+            if snapshot is None:
+                # Keep the exited processes' own snapshots rather than
+                # losing their totals.
+                return
+            snapshots.append(snapshot)
+        snapshots.extend(s for s in map(_read, paths) if s is not None)
+        self._write(exited_path, merge(snapshots))
+        for path in paths:
+            os.unlink(path)
+
+    def _write(self, path, snapshot):
+        """Write snapshot to path atomically."""
+        fd, tmp_path = tempfile.mkstemp(dir=self._snapshot_dir,
+                                        suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(snapshot, f)
+            os.rename(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def _start(self):
+        """Start writing snapshots in the background, once."""
+        if self._thread is not None or not self._snapshot_dir:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='metrics-snapshots')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self.write_snapshot()
+            except Exception:
+                logging.exception('Failed to write metrics snapshot.')
+
+
+def _read(path):
+    """Returns snapshot read from path, or None if it cannot be read."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        logging.warn('Skipping metrics snapshot %s: %s', path, e)
+        return None
+
+
+def _pid(path):
+    """Returns pid of the process that wrote snapshot at path."""
+    return int(os.path.basename(path).split('-', 1)[0])
+
+
+def _alive(pid):
+    """Returns True if process pid exists."""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def merge(snapshots):
+    """Returns snapshot with counters and histograms of snapshots added
+    up."""
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(sorted(labels.items())))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, buckets, total in snapshot['histograms']:
+            key = (name, tuple(sorted(labels.items())))
+            hist = histograms.get(key)
+            if hist is None:
+                histograms[key] = [list(buckets), total]
+            else:
+                hist[0] = [a + b for a, b in zip(hist[0], buckets)]
+                hist[1] += total
+    return {
+        'counters': [[name, dict(labels), value]
+                     for (name, labels), value in sorted(counters.items())],
+        'histograms': [[name, dict(labels), buckets, total]
+                       for (name, labels), (buckets, total) in
+                       sorted(histograms.items())],
+    }
+
+
+def quantile(q, buckets):
+    """Returns estimate of quantile q from histogram bucket counts, by
+    linear interpolation within the bucket it falls in, like Prometheus'
+    histogram_quantile(). Returns None for empty histograms."""
+    count = sum(buckets)
+    if not count:
+        return None
+    rank = q * count
+    seen = 0
+    for i, n in enumerate(buckets):
+        if n and seen + n >= rank:
+            if i == len(BUCKETS):
+                return BUCKETS[-1]
+            lower = BUCKETS[i - 1] if i else 0.0
+            return lower + (BUCKETS[i] - lower) * (rank - seen) / n
+        seen += n
+    return BUCKETS[-1]
+
+
+def render(snapshot):
+    """Returns snapshot in Prometheus text exposition format. Each histogram
+    is followed by a gauge with the estimated p50, p95 and p99."""
+    lines = []
+    by_name = {}
+    for name, labels, value in snapshot['counters']:
+        by_name.setdefault(name, []).append((labels, value))
+    for name in sorted(by_name):
+        lines.append('# HELP {0} {1}'.format(name, COUNTERS.get(name, '')))
+        lines.append('# TYPE {0} counter'.format(name))
+        for labels, value in by_name[name]:
+            lines.append('{0}{1} {2}'.format(name, _labels(labels), value))
+
+    by_name = {}
+    for name, labels, buckets, total in snapshot['histograms']:
+        by_name.setdefault(name, []).append((labels, buckets, total))
+    for name in sorted(by_name):
+        lines.append('# HELP {0} {1}'.format(name, HISTOGRAMS.get(name, '')))
+        lines.append('# TYPE {0} histogram'.format(name))
+        for labels, buckets, total in by_name[name]:
+            cumulative = 0
+            for bound, n in zip(BUCKETS + ('+Inf',), buckets):
+                cumulative += n
+                lines.append('{0}_bucket{1} {2}'.format(
+                    name, _labels(labels, le=bound), cumulative))
+            lines.append('{0}_sum{1} {2!r}'.format(name, _labels(labels),
+                                                   total))
+            lines.append('{0}_count{1} {2}'.format(name, _labels(labels),
+                                                   cumulative))
+
+        gauge = name + '_quantile'
+        lines.append('# HELP {0} Estimated quantiles of {1}.'.format(
+            gauge, name))
+        lines.append('# TYPE {0} gauge'.format(gauge))
+        for labels, buckets, total in by_name[name]:
+            for q in QUANTILES:
+                value = quantile(q, buckets)
+                if value is not None:
+                    lines.append('{0}{1} {2!r}'.format(
+                        gauge, _labels(labels, quantile=q), value))
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{0}="{1}"'.format(k, _escape(v)) for k, v in sorted(labels.items())
+    ) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
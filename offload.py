@@ -0,0 +1,32 @@
+"""Running CPU bound work off the event loop when serving with gevent.
+
+Under gunicorn's gevent worker (`gunicorn -k gevent emailer:app`), sockets
+are cooperative, so a worker process serves many web hooks at once and
+SMTP sends do not block it. Hashing or parsing a large body, however, holds
+the event loop and stalls every other request of the process for as long as
+it takes. Such work is handed to gevent's thread pool instead.
+"""
+
+try:
+    import gevent
+    import gevent.monkey
+except ImportError:
+    gevent = None
+
+# Smallest body, in bytes, worth the cost of a trip to the thread pool.
+MIN_SIZE = 256 * 1024
+
+
+def green():
+    """True if this process serves requests in gevent greenlets."""
+    return gevent is not None and gevent.monkey.is_module_patched('socket')
+
+
+def call(size, func, *args):
+    """Returns func(*args), which does work proportional to `size` bytes.
+    When serving with gevent and size is at least MIN_SIZE, func runs in
+    the thread pool while the event loop serves other requests. Exceptions
+    raised by func are raised here either way."""
+    if size < MIN_SIZE or not green():
+        return func(*args)
+    return gevent.get_hub().threadpool.apply(func, args)
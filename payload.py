@@ -0,0 +1,208 @@
+"""Reading and trimming github web hook payloads."""
+
+import cStringIO
+import json
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Size of reads from the request body stream.
+CHUNK_SIZE = 64 * 1024
+
+# Fields of the push event that are needed to build the email, by ijson
+# prefix. Values are the path of the field in the trimmed push event.
+_PUSH_FIELDS = {
+    'deleted': ('deleted',),
+    'ref': ('ref',),
+    'compare': ('compare',),
+    'repository.full_name': ('repository', 'full_name'),
+    'pusher.name': ('pusher', 'name'),
+    'pusher.email': ('pusher', 'email'),
+    'head_commit.id': ('head_commit', 'id'),
+    'head_commit.message': ('head_commit', 'message'),
+}
+_PUSH_LIST_FIELDS = {
+    'head_commit.added.item': 'added',
+    'head_commit.removed.item': 'removed',
+    'head_commit.modified.item': 'modified',
+}
+
+# Fields of each item of the "commits" list that are kept, if asked to, by
+# ijson prefix.
+_COMMIT_FIELDS = {
+    'commits.item.id': 'id',
+    'commits.item.message': 'message',
+    'commits.item.author.name': 'author',
+}
+_COMMIT_LIST_FIELDS = {
+    'commits.item.added.item': 'added',
+    'commits.item.removed.item': 'removed',
+    'commits.item.modified.item': 'modified',
+}
+
+
+class PayloadTooLarge(Exception):
+    """Raised when a request body is larger than allowed."""
+
+
+def read_body(stream, content_length, max_size, macs=()):
+    """Read request body from stream in chunks and return it. Each chunk is
+    fed to the hmac objects in `macs` as it is read, so the signature can be
+    checked without another pass over the body.
+
+    Raises PayloadTooLarge without reading anything if `content_length` is
+    over `max_size`, and stops reading as soon as more than `max_size` bytes
+    have been read, in case the content length was not given or was wrong.
+    """
+    if content_length is not None and content_length > max_size:
+        raise PayloadTooLarge(
+            'Body of {0} bytes is over limit of {1} bytes.'.format(
+                content_length, max_size))
+
+    chunks = []
+    size = 0
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_size:
+            raise PayloadTooLarge(
+                'Body is over limit of {0} bytes.'.format(max_size))
+        for mac in macs:
+            mac.update(chunk)
+        chunks.append(chunk)
+    return ''.join(chunks)
+
+
+def parse_push(body, max_commits=0):
+    """Returns push event parsed from JSON body, trimmed to the fields needed
+    to build the email. Raises ValueError if body is not JSON, and KeyError
+    or TypeError if it is not a push event. See trim_push() for
+    `max_commits`.
+
+    If ijson is installed, the body is parsed incrementally and only the
+    needed fields are ever built, which keeps memory use close to the size
+    of the body even for pushes with thousands of commits or files.
+    Otherwise the whole payload is parsed with the json module and then
+    trimmed.
+    """
+    if ijson is None:
+        return trim_push(json.loads(body), max_commits)
+    try:
+        return trim_push(_scan_push(body, max_commits), max_commits)
+    except ijson.JSONError as e:
+        raise ValueError('Invalid JSON: {0}'.format(e))
+
+
+def scan_repo(body):
+    """Returns full name of the repo a push body claims to be for, or None if
+    it cannot be found. Use this only to pick the secret to verify the body
+    with. With ijson, parsing stops as soon as the name is found."""
+    try:
+        if ijson is None:
+            return json.loads(body)['repository']['full_name']
+        for prefix, event, value in ijson.parse(cStringIO.StringIO(body)):
+            if prefix == 'repository.full_name':
+                return value
+    except Exception:
+        pass
+    return None
+
+
+def _scan_push(body, max_commits=0):
+    """Returns push event with only the needed fields, built from ijson
+    parser events. Only the last `max_commits` items of the "commits" list,
+    the newest ones, are kept; older ones are replaced by None as newer ones
+    are read, so they are only counted."""
+    push = {
+        'repository': {},
+        'pusher': {},
+        'head_commit': {'added': [], 'removed': [], 'modified': []},
+    }
+    commits = []
+    if max_commits:
+        push['commits'] = commits
+    events = iter(ijson.parse(cStringIO.StringIO(body)))
+    if next(events)[1] != 'start_map':
+        raise TypeError('Push payload is not a JSON object.')
+
+    for prefix, event, value in events:
+        if prefix in _PUSH_FIELDS:
+            if event in ('start_map', 'start_array'):
+                raise TypeError('Unexpected value for {0}.'.format(prefix))
+            path = _PUSH_FIELDS[prefix]
+            target = push
+            for key in path[:-1]:
+                target = target[key]
+            target[path[-1]] = value
+        elif prefix in _PUSH_LIST_FIELDS and event == 'string':
+            push['head_commit'][_PUSH_LIST_FIELDS[prefix]].append(value)
+        elif prefix == 'head_commit' and event == 'null':
+            push['head_commit'] = None
+        elif not max_commits or not prefix.startswith('commits.item'):
+            continue
+        elif prefix == 'commits.item' and event == 'start_map':
+            commits.append({'added': [], 'removed': [], 'modified': []})
+            if len(commits) > max_commits:
+                commits[-max_commits - 1] = None
+        elif prefix in _COMMIT_FIELDS and event not in ('start_map',
+                                                        'end_map'):
+            commits[-1][_COMMIT_FIELDS[prefix]] = value
+        elif prefix in _COMMIT_LIST_FIELDS and event == 'string':
+            commits[-1][_COMMIT_LIST_FIELDS[prefix]].append(value)
+    return push
+
+
+def trim_push(json_dict, max_commits=0):
+    """Returns copy of push event with only the fields needed to build the
+    email, so the rest of a large payload can be freed right away.
+
+    The "commits" list is dropped, unless `max_commits` is set. Then it is
+    kept with at most that many of the newest commits, which github lists
+    last, each with its id, message, author name and changed files, and
+    "omitted_commits" counts the older ones."""
+    if json_dict['deleted']:
+        return {'deleted': True}
+
+    head_commit = json_dict['head_commit']
+    push = {
+        'deleted': False,
+        'ref': json_dict['ref'],
+        'compare': json_dict['compare'],
+        'repository': {
+            'full_name': json_dict['repository']['full_name'],
+        },
+        'pusher': {
+            'name': json_dict['pusher']['name'],
+            'email': json_dict['pusher']['email'],
+        },
+        'head_commit': {
+            'id': head_commit['id'],
+            'message': head_commit['message'],
+            'added': head_commit['added'],
+            'removed': head_commit['removed'],
+            'modified': head_commit['modified'],
+        },
+    }
+    if max_commits:
+        commits = json_dict.get('commits') or []
+        push['commits'] = [_trim_commit(c) for c in commits[-max_commits:]]
+        push['omitted_commits'] = max(0, len(commits) - max_commits)
+    return push
+
+
+def _trim_commit(commit):
+    author = commit.get('author')
+    if isinstance(author, dict):
+        author = author.get('name')
+    return {
+        'id': commit['id'],
+        'message': commit.get('message', ''),
+        'author': author,
+        'added': commit.get('added', []),
+        'removed': commit.get('removed', []),
+        'modified': commit.get('modified', []),
+    }
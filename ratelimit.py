@@ -0,0 +1,155 @@
+"""Token bucket rate limits for outgoing email, globally and per recipient."""
+
+import sqlite3
+import threading
+import time
+
+
+class RateLimited(Exception):
+    """Raised when an email cannot be sent within the allowed wait."""
+
+
+def _refill(tokens, updated, rate, burst, now):
+    return min(burst, tokens + max(0.0, now - updated) * rate)
+
+
+def _take(buckets, limits, now):
+    """Take a token from each bucket in `limits`, a list of (key, rate,
+    burst), if all of them have one. `buckets` maps key to (tokens,
+    updated). Returns (wait, changed) where wait is 0 and changed holds the
+    new bucket states if tokens were taken, or wait is the seconds until all
+    buckets have a token."""
+    wait = 0.0
+    changed = {}
+    for key, rate, burst in limits:
+        tokens, updated = buckets.get(key, (burst, now))
+        tokens = _refill(tokens, updated, rate, burst, now)
+        if tokens < 1:
+            wait = max(wait, (1 - tokens) / rate)
+        changed[key] = (tokens - 1, now)
+    if wait:
+        return wait, {}
+    return 0.0, changed
+
+
+class MemoryBuckets(object):
+    """Token buckets of this process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def take(self, limits, now=None):
+        """Atomically take a token from each of `limits`, a list of (key,
+        rate, burst), if all have one. Returns 0 if taken, or seconds to
+        wait before trying again."""
+        now = time.time() if now is None else now
+        with self._lock:
+            wait, changed = _take(self._buckets, limits, now)
+            self._buckets.update(changed)
+        return wait
+
+
+class SQLiteBuckets(object):
+    """Token buckets in an SQLite database, so that all worker processes on
+    a host share the same limits. Same interface as MemoryBuckets."""
+
+    # Full buckets are purged once every this many takes.
+    PURGE_INTERVAL = 500
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._takes = 0
+        self._max_fill_time = 0.0
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS buckets ('
+                         'key TEXT PRIMARY KEY, tokens REAL NOT NULL, '
+                         'updated REAL NOT NULL)')
+
+    def take(self, limits, now=None):
+        """Atomically take a token from each of `limits`, a list of (key,
+        rate, burst), if all have one. Returns 0 if taken, or seconds to
+        wait before trying again."""
+        now = time.time() if now is None else now
+        keys = [key for key, _, _ in limits]
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                buckets = dict(
+                    (key, (tokens, updated)) for key, tokens, updated in
+                    self._db.execute(
+                        'SELECT key, tokens, updated FROM buckets WHERE '
+                        'key IN ({0})'.format(','.join('?' * len(keys))),
+                        keys))
+                wait, changed = _take(buckets, limits, now)
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO buckets (key, tokens, updated) '
+                    'VALUES (?, ?, ?)',
+                    [(key, tokens, updated)
+                     for key, (tokens, updated) in changed.items()])
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+
+            self._max_fill_time = max(
+                [self._max_fill_time] +
+                [burst / rate for _, rate, burst in limits])
+            self._takes += 1
+            if self._takes % self.PURGE_INTERVAL == 0:
+                # Buckets that have had time to fill up are the same as
+                # missing ones.
+                self._db.execute('DELETE FROM buckets WHERE updated < ?',
+                                 (now - self._max_fill_time,))
+        return wait
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._db.close()
+
+
+class RateLimiter(object):
+    """Limits emails to `rate` per second overall, with bursts of up to
+    `burst`, and to `recipient_rate` per second, with bursts of up to
+    `recipient_burst`, for each recipient address. A rate of 0 means no
+    limit."""
+
+    def __init__(self, buckets, rate=0, burst=1, recipient_rate=0,
+                 recipient_burst=1):
+        self._buckets = buckets
+        self._rate = rate
+        self._burst = max(1, burst)
+        self._recipient_rate = recipient_rate
+        self._recipient_burst = max(1, recipient_burst)
+
+    def try_acquire(self, recipients):
+        """Take a token for sending one email to recipients. Returns 0 if
+        it may be sent now, or seconds to wait before trying again."""
+        limits = []
+        if self._rate:
+            limits.append(('global', self._rate, self._burst))
+        if self._recipient_rate:
+            for addr in sorted(set(a.lower() for a in recipients)):
+                limits.append(('rcpt:' + addr, self._recipient_rate,
+                               self._recipient_burst))
+        if not limits:
+            return 0.0
+        return self._buckets.take(limits)
+
+    def acquire(self, recipients, max_wait=None):
+        """Wait until one email may be sent to recipients. Raises
+        RateLimited if that would take more than `max_wait` seconds."""
+        deadline = None if max_wait is None else time.time() + max_wait
+        while True:
+            wait = self.try_acquire(recipients)
+            if not wait:
+                return
+            if deadline is not None and time.time() + wait > deadline:
+                raise RateLimited(
+                    'Rate limit for {0} exceeded.'.format(
+                        ', '.join(recipients)))
+            time.sleep(wait)
@@ -0,0 +1,314 @@
+"""Rendering of commit notification emails to MIME bytes."""
+
+import base64
+import collections
+import email.header
+import email.utils
+import json
+import os
+import routing
+import threading
+
+# Body of the email, used for repos without a template of their own.
+DEFAULT_TEMPLATE = u"""Branch: {branch}
+Revision: {revision}
+Author: {pusher}
+
+Log Message:
+------------
+{message}
+
+Modified Files:
+---------------
+{changed_files}
+
+Compare: {compare_url}
+"""
+
+# Disables SendGrid click tracking.
+SENDGRID_HEADER = json.dumps(
+    {'filters': {'clicktrack': {'settings': {'enable': 0}}}})
+
+# Longest line allowed by SMTP without encoding the body.
+_MAX_LINE_LENGTH = 998
+
+Config = collections.namedtuple('Config', [
+    'sender',
+    'send_from_author',
+    'recipient',
+    'reply_to',
+    'approved',
+    'template_dir',
+    'routes_path',
+])
+
+
+def load_config(environ=None):
+    """Returns Config read from `environ`, which defaults to os.environ."""
+    if environ is None:
+        environ = os.environ
+    return Config(
+        sender=environ.get('GITHUB_COMMIT_EMAILER_SENDER'),
+        send_from_author='GITHUB_COMMIT_EMAILER_SEND_FROM_AUTHOR' in environ,
+        recipient=environ.get('GITHUB_COMMIT_EMAILER_RECIPIENT'),
+        reply_to=environ.get('GITHUB_COMMIT_EMAILER_REPLY_TO'),
+        approved=environ.get('GITHUB_COMMIT_EMAILER_APPROVED_HEADER'),
+        template_dir=environ.get('GITHUB_COMMIT_EMAILER_TEMPLATE_DIR'),
+        routes_path=environ.get('GITHUB_COMMIT_EMAILER_ROUTES'),
+    )
+
+
+class Message(object):
+    """Rendered email. `data` holds the complete message, headers and body,
+    ready to be passed to smtplib."""
+
+    __slots__ = ('from_addr', 'to_addrs', 'subject', 'headers', 'data')
+
+    def __init__(self, from_addr, to_addrs, subject, headers, data):
+        self.from_addr = from_addr
+        self.to_addrs = to_addrs
+        self.subject = subject
+        self.headers = headers
+        self.data = data
+
+    def __repr__(self):
+        return '<Message from="{0}" to="{1}" subject="{2}">'.format(
+            self.from_addr, ', '.join(self.to_addrs),
+            _to_str(self.subject))
+
+
+class FormatTemplate(object):
+    """Template rendered with str.format, with the message info as keyword
+    arguments."""
+
+    def __init__(self, source):
+        self._source = source
+
+    def render(self, msg_info):
+        return self._source.format(**msg_info)
+
+
+class JinjaTemplate(object):
+    """Compiled Jinja2 template, rendered with the message info as
+    context."""
+
+    def __init__(self, template):
+        self._template = template
+
+    def render(self, msg_info):
+        return self._template.render(msg_info)
+
+
+class TemplateSet(object):
+    """Per-repo body templates. For repo "owner/name", the Jinja2 template
+    "owner/name.txt" in `template_dir` is used if it exists, then
+    "default.txt", then `default`. Each template is compiled the first time
+    it is used, or by preload(), and kept until the set is thrown away.
+    Jinja2 is only imported if there is a template dir."""
+
+    def __init__(self, template_dir=None, default=None):
+        self._default = default or FormatTemplate(DEFAULT_TEMPLATE)
+        self._templates = {}
+        self._lock = threading.Lock()
+        self._env = None
+        if template_dir:
+            import jinja2
+            self._env = jinja2.Environment(
+                loader=jinja2.FileSystemLoader(template_dir),
+                autoescape=False,
+                auto_reload=False,
+                keep_trailing_newline=True,
+                undefined=jinja2.StrictUndefined)
+
+    def get(self, repo):
+        """Returns template for repo."""
+        template = self._templates.get(repo)
+        if template is None:
+            with self._lock:
+                template = self._templates.get(repo)
+                if template is None:
+                    template = self._load(repo)
+                    self._templates[repo] = template
+        return template
+
+    def preload(self):
+        """Compile every template in the template dir now."""
+        if self._env is None:
+            return
+        for name in self._env.list_templates(extensions=['txt']):
+            self.get(name[:-len('.txt')])
+
+    def _load(self, repo):
+        if self._env is None:
+            return self._default
+        import jinja2
+        try:
+            return JinjaTemplate(self._env.select_template(
+                [u'{0}.txt'.format(repo), u'default.txt']))
+        except jinja2.TemplatesNotFound:
+            return self._default
+
+
+class Renderer(object):
+    """Renders message infos to Messages. Headers that are the same for
+    every message to a route are encoded once, up front."""
+
+    def __init__(self, config, templates=None, routes=None):
+        self._config = config
+        self._templates = templates or TemplateSet(config.template_dir)
+        if routes is None and config.routes_path:
+            routes = routing.load_routes(config.routes_path)
+        self._routes = routes
+        self._default = _Headers(config)
+        self._routed = {}
+
+    def preload(self):
+        """Compile templates and encode headers of every route now, rather
+        than when first used."""
+        self._templates.preload()
+        if self._routes is not None:
+            for route in self._routes.routes():
+                self._route_headers(route)
+
+    def render(self, msg_info):
+        """Returns Message for message info. Raises ValueError if sender or
+        recipient are not configured."""
+        headers = self._headers_for(msg_info)
+        if headers.send_from_author:
+            sender = _encode_address(msg_info['pusher_email'])
+        else:
+            sender = headers.sender
+        if sender is None or not headers.to_addrs:
+            raise ValueError('sender and recipient config vars must be set.')
+        from_addr, from_header = sender
+
+        subject = msg_info.get('subject') or get_subject(
+            msg_info['repo'], msg_info['message'])
+        body = self._templates.get(msg_info['repo']).render(msg_info)
+        body_headers, body = _encode_body(body)
+
+        data = ''.join([
+            'From: ', from_header, '\n',
+            headers.block,
+            'Subject: ', _encode_header(subject), '\n',
+            body_headers,
+            '\n',
+            body,
+        ])
+        return Message(from_addr, headers.to_addrs, subject,
+                       headers.headers, data)
+
+    def _headers_for(self, msg_info):
+        """Returns _Headers of the route for the message's repo and branch,
+        creating them the first time the route is used."""
+        route = None
+        if self._routes is not None:
+            route = self._routes.lookup(msg_info['repo'], msg_info['branch'])
+        if route is None:
+            return self._default
+        return self._route_headers(route)
+
+    def _route_headers(self, route):
+        headers = self._routed.get(route)
+        if headers is None:
+            overrides = dict((k, v) for k, v in route._asdict().items()
+                             if v is not None)
+            if 'sender' in overrides:
+                overrides['send_from_author'] = False
+            headers = _Headers(self._config._replace(**overrides))
+            self._routed[route] = headers
+        return headers
+
+
+class _Headers(object):
+    """Encoded headers that do not depend on the message, for a config."""
+
+    def __init__(self, config):
+        recipient = config.recipient
+        if recipient is None:
+            self.to_addrs = []
+        elif isinstance(recipient, tuple):
+            self.to_addrs = list(recipient)
+        else:
+            self.to_addrs = [recipient]
+
+        headers = []
+        if self.to_addrs:
+            headers.append(('To', ', '.join(self.to_addrs)))
+        if config.reply_to is not None:
+            headers.append(('Reply-To', config.reply_to))
+        if config.approved is not None:
+            headers.append(('Approved', config.approved))
+        headers.append(('X-SMTPAPI', SENDGRID_HEADER))
+        self.headers = dict(headers)
+        self.block = ''.join(
+            '{0}: {1}\n'.format(k, _encode_header(v)) for k, v in headers)
+
+        self.send_from_author = config.send_from_author
+        self.sender = None
+        if not config.send_from_author and config.sender is not None:
+            self.sender = _encode_address(config.sender)
+
+
+def get_subject(repo, message):
+    """Returns subject line from repo name and commit message."""
+    message_lines = message.splitlines()
+
+    # For github merge commit messages, the first line is "Merged pull request
+    # #blah ...", followed by two line breaks. The third line is where the
+    # author's commit message starts. So, if a third line is available, use
+    # it. Otherwise, just use the first line.
+    if len(message_lines) >= 3:
+        subject_msg = message_lines[2]
+    else:
+        subject_msg = message_lines[0]
+    subject_msg = subject_msg[:50]
+    subject = u'[{0}] {1}'.format(repo, subject_msg)
+    return subject
+
+
+def _to_str(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _is_ascii(value):
+    try:
+        if isinstance(value, unicode):
+            value.encode('ascii')
+        else:
+            value.decode('ascii')
+    except UnicodeError:
+        return False
+    return True
+
+
+def _encode_header(value):
+    """Returns header value as str, RFC 2047 encoded if not ascii."""
+    if _is_ascii(value):
+        return str(value)
+    return email.header.Header(_to_str(value), 'utf-8').encode()
+
+
+def _encode_address(value):
+    """Returns (address, header value) for an address like "Name <addr>"."""
+    name, addr = email.utils.parseaddr(_to_str(value))
+    if not _is_ascii(name):
+        name = email.header.Header(name, 'utf-8').encode()
+    return addr, email.utils.formataddr((name, addr))
+
+
+def _encode_body(body):
+    """Returns (MIME headers, encoded body) for text body. Bodies that are
+    ascii with short enough lines are sent as is, others base64 encoded."""
+    body = _to_str(body)
+    if _is_ascii(body) and all(len(line) <= _MAX_LINE_LENGTH
+                               for line in body.split('\n')):
+        encoding = '7bit'
+    else:
+        encoding = 'base64'
+        body = base64.encodestring(body)
+    return ('MIME-Version: 1.0\n'
+            'Content-Type: text/plain; charset="utf-8"\n'
+            'Content-Transfer-Encoding: {0}\n'.format(encoding)), body
@@ -0,0 +1,292 @@
+"""Replay exported github web hook deliveries, e.g. after an outage.
+
+Usage: python replay.py [--concurrency 8] [--processes 1]
+           [--checkpoint replay.done] [--dry-run DIR] [--report FILE]
+           SOURCE [SOURCE ...]
+
+Each SOURCE is a JSONL file with one delivery per line, or a directory with
+one delivery per file. A delivery is either a bare push event payload, or a
+delivery as exported from github's API, with "guid", "event" and
+"request": {"payload": ...}. Deliveries go through the same steps as web
+hooks, parsing the push, building its message info and sending the email
+with the app's env config, except that signatures are not checked.
+
+Deliveries are handled by `concurrency` threads in each of `processes`
+processes, and each process keeps up to `concurrency` SMTP connections open,
+overriding GITHUB_COMMIT_EMAILER_SMTP_POOL_SIZE. The outcome of each one is
+written as a JSON line to the report (default: stdout), and a summary to
+stderr. With --checkpoint, deliveries that were sent or skipped are recorded
+in that file, and left out when the command is run again, so an interrupted
+replay can be resumed. Failed deliveries are retried by the next run. With
+--dry-run, emails are rendered to files in DIR instead of being sent.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import os.path
+import re
+import sys
+import threading
+import time
+
+import emailer
+import payload
+
+# A delivery read from a source. `location` is the file, and line for JSONL
+# files, it was read from.
+Delivery = collections.namedtuple('Delivery', ['location', 'text'])
+
+SENT = 'sent'
+RENDERED = 'rendered'
+SKIPPED = 'skipped'
+DONE_BEFORE = 'done_before'
+FAILED = 'failed'
+
+_UNSAFE_RE = re.compile(r'[^\w.-]+')
+
+
+def read_deliveries(path):
+    """Yields Deliveries of a JSONL file, or of the files of a directory in
+    name order, without reading more than one at a time."""
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            full_path = os.path.join(path, name)
+            if name.startswith('.') or not os.path.isfile(full_path):
+                continue
+            with open(full_path) as f:
+                yield Delivery(full_path, f.read())
+        return
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                yield Delivery('{0}:{1}'.format(path, number), line)
+
+
+class Checkpoint(object):
+    """Append-only file of the keys of deliveries that are done. Keys added
+    by other processes after it was opened are not seen."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self._done.update(line.strip() for line in f if line.strip())
+        self._file = open(path, 'a')
+
+    def __contains__(self, key):
+        return key in self._done
+
+    def add(self, key):
+        with self._lock:
+            self._done.add(key)
+            self._file.write(key + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def replay_one(delivery, dry_run_dir=None, done=()):
+    """Send, or render to `dry_run_dir`, the email of one delivery, unless
+    its key is in `done`. Returns (key, outcome, detail). Keys are the same
+    ones web hooks are deduplicated by: the delivery's guid if it has one,
+    else the repo, branch and head commit of the push."""
+    key = delivery.location
+    try:
+        guid, event, push = _unwrap(json.loads(delivery.text))
+        if guid is not None:
+            key = 'delivery:' + guid
+            if key in done:
+                return key, DONE_BEFORE, None
+        if event != 'push':
+            return key, SKIPPED, 'not_push'
+
+        json_dict = payload.trim_push(push,
+                                      emailer._get_settings().max_commits)
+        if json_dict['deleted']:
+            return key, SKIPPED, 'deleted_branch'
+        msg_info = emailer._get_msg_info(json_dict)
+        if guid is not None:
+            msg_info['delivery_id'] = guid
+        else:
+            key = 'push:{0}:{1}:{2}'.format(
+                msg_info['repo'], msg_info['branch'],
+                json_dict['head_commit']['id'])
+            if key in done:
+                return key, DONE_BEFORE, None
+
+        if dry_run_dir is None:
+            emailer._send_email(msg_info)
+            return key, SENT, None
+        path = os.path.join(dry_run_dir, _UNSAFE_RE.sub('_', key) + '.eml')
+        with open(path, 'w') as f:
+            f.write(emailer._build_email(msg_info).data)
+        return key, RENDERED, path
+    except Exception as e:
+        return key, FAILED, repr(e)
+
+
+def _unwrap(data):
+    """Returns (guid, event, payload) of exported delivery, or of bare push
+    payload."""
+    if 'request' not in data:
+        return None, 'push', data
+    push = data['request']['payload']
+    if isinstance(push, basestring):
+        push = json.loads(push)
+    return data.get('guid') or None, data.get('event', 'push'), push
+
+
+class Replayer(object):
+    """Replays deliveries in `concurrency` threads, writing the outcome of
+    each to `report` and recording done ones in `checkpoint`, if given."""
+
+    def __init__(self, concurrency=8, checkpoint=None, dry_run_dir=None,
+                 report=None):
+        self._concurrency = concurrency
+        self._checkpoint = checkpoint
+        self._dry_run_dir = dry_run_dir
+        self._report = report or sys.stdout
+        self._lock = threading.Lock()
+        self._counts = collections.Counter()
+
+    def run(self, deliveries):
+        """Replay deliveries, an iterable that is consumed as threads become
+        free. Returns Counter of outcomes."""
+        deliveries = iter(deliveries)
+        threads = [threading.Thread(target=self._run, args=(deliveries,),
+                                    name='replay-{0}'.format(i))
+                   for i in range(self._concurrency)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            # Join with a timeout, so that Ctrl-C interrupts the wait.
+            while t.is_alive():
+                t.join(1)
+        return self._counts
+
+    def _run(self, deliveries):
+        while True:
+            with self._lock:
+                delivery = next(deliveries, None)
+            if delivery is None:
+                return
+            start = time.time()
+            key, outcome, detail = replay_one(delivery, self._dry_run_dir,
+                                              self._checkpoint or ())
+            record = {
+                'key': key,
+                'location': delivery.location,
+                'outcome': outcome,
+                'seconds': round(time.time() - start, 4),
+            }
+            if detail is not None:
+                record['detail'] = detail
+            line = json.dumps(record, sort_keys=True) + '\n'
+            with self._lock:
+                self._counts[outcome] += 1
+                self._report.write(line)
+                self._report.flush()
+            if self._checkpoint is not None and outcome in (SENT, SKIPPED):
+                self._checkpoint.add(key)
+
+
+def _shard(deliveries, index, count):
+    """Yields every `count`th delivery, starting with the `index`th."""
+    for i, delivery in enumerate(deliveries):
+        if i % count == index:
+            yield delivery
+
+
+def _all_deliveries(sources):
+    for source in sources:
+        for delivery in read_deliveries(source):
+            yield delivery
+
+
+def run(sources, concurrency=8, processes=1, checkpoint_path=None,
+        dry_run_dir=None, report_path=None):
+    """Replay deliveries of all sources. Returns Counter of outcomes."""
+    if processes <= 1:
+        return _run_shard((sources, 0, 1, concurrency, checkpoint_path,
+                           dry_run_dir, report_path))
+    pool = multiprocessing.Pool(processes)
+    try:
+        # A timeout on get() lets Ctrl-C through on Python 2.
+        results = pool.map_async(_run_shard, [
+            (sources, i, processes, concurrency, checkpoint_path,
+             dry_run_dir, report_path) for i in range(processes)]).get(
+                 365 * 86400)
+    finally:
+        pool.close()
+        pool.join()
+    return sum((collections.Counter(r) for r in results),
+               collections.Counter())
+
+
+def _run_shard(args):
+    (sources, index, count, concurrency, checkpoint_path, dry_run_dir,
+     report_path) = args
+    # Give each thread a connection of its own, rather than have most of them
+    # wait for one of the app's few, and fail once they have waited too long.
+    os.environ['GITHUB_COMMIT_EMAILER_SMTP_POOL_SIZE'] = str(concurrency)
+    checkpoint = Checkpoint(checkpoint_path) if checkpoint_path else None
+    report = open(report_path, 'a') if report_path else None
+    try:
+        return Replayer(concurrency, checkpoint, dry_run_dir, report).run(
+            _shard(_all_deliveries(sources), index, count))
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+        if report is not None:
+            report.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('sources', nargs='+', metavar='SOURCE',
+                        help='JSONL file, or directory of delivery files')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='threads per process (default: 8)')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='processes (default: 1)')
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help='record done deliveries here, and skip those '
+                        'already recorded')
+    parser.add_argument('--dry-run', metavar='DIR',
+                        help='render emails to files in DIR instead of '
+                        'sending them')
+    parser.add_argument('--report', metavar='FILE',
+                        help='append outcome of each delivery here '
+                        '(default: stdout)')
+    parser.add_argument('--log-level', default='WARNING',
+                        help='log level of the app (default: WARNING)')
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(args.log_level)
+    if args.dry_run and not os.path.isdir(args.dry_run):
+        os.makedirs(args.dry_run)
+    start = time.time()
+    counts = run(args.sources, concurrency=args.concurrency,
+                 processes=args.processes, checkpoint_path=args.checkpoint,
+                 dry_run_dir=args.dry_run, report_path=args.report)
+    elapsed = time.time() - start
+    total = sum(counts.values())
+    print('Replayed {0} deliveries in {1:.1f}s ({2:.0f}/s): {3}'.format(
+        total, elapsed, total / elapsed if elapsed else 0,
+        ', '.join('{0}={1}'.format(k, v) for k, v in sorted(counts.items()))),
+        file=sys.stderr)
+    return 1 if counts[FAILED] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+"""Routing of commit emails to recipients by repo and branch."""
+
+import collections
+import json
+import re
+
+Route = collections.namedtuple('Route', [
+    'recipient',
+    'sender',
+    'reply_to',
+    'approved',
+])
+
+# Python 2.7 regexes can have at most 100 groups, so pattern rules are
+# combined into several regexes of at most this many groups.
+_MAX_GROUPS = 99
+
+
+def load_routes(path):
+    """Returns RoutingTable with rules from JSON file at path."""
+    with open(path) as f:
+        return RoutingTable(json.load(f))
+
+
+class RoutingTable(object):
+    """Maps repo full names and branch refs to Routes.
+
+    Each rule is a dict with a "repo", an optional "branch" and the route
+    fields to use for matching pushes. "repo" and "branch" are exact names,
+    shell-style patterns using "*" and "?", or regexes prefixed with "re:"
+    (without backreferences, since groups are renumbered when combined).
+    Rules with an exact repo name are found with a dict lookup and take
+    precedence over the others. Pattern rules are compiled into a few
+    combined regexes. Within each kind, the first matching rule wins.
+    """
+
+    def __init__(self, rules):
+        self._exact = {}
+        self._routes = []
+        patterns = []
+        for i, rule in enumerate(rules):
+            repo, branch, route = _parse_rule(i, rule)
+            self._routes.append(route)
+            if _is_exact(repo):
+                self._exact.setdefault(repo, []).append(
+                    (_compile_branch(i, branch), route))
+            else:
+                patterns.append((i, '(?:{0})\x00(?:{1})\\Z'.format(
+                    _to_regex(repo), _to_regex(branch or '*')), route))
+        self._matchers = _combine(patterns)
+
+    def routes(self):
+        """Returns Routes of all rules, in order."""
+        return list(self._routes)
+
+    def lookup(self, repo, branch):
+        """Returns Route of first rule matching repo and branch, or None."""
+        for branch_re, route in self._exact.get(repo, ()):
+            if branch_re is None or branch_re.match(branch):
+                return route
+
+        key = u'{0}\x00{1}'.format(repo, branch)
+        for regex, routes in self._matchers:
+            m = regex.match(key)
+            if m is not None:
+                return routes[m.lastindex]
+        return None
+
+
+def _parse_rule(i, rule):
+    """Returns (repo, branch, Route) for rule number i."""
+    if not isinstance(rule, dict) or 'repo' not in rule:
+        raise ValueError('Route {0} must be an object with a "repo".'.format(
+            i))
+    unknown = set(rule) - set(Route._fields) - set(['repo', 'branch'])
+    if unknown:
+        raise ValueError('Route {0} has unknown fields: {1}'.format(
+            i, ', '.join(sorted(unknown))))
+    recipient = rule.get('recipient')
+    if isinstance(recipient, list):
+        recipient = tuple(recipient)
+    route = Route(recipient=recipient,
+                  sender=rule.get('sender'),
+                  reply_to=rule.get('reply_to'),
+                  approved=rule.get('approved'))
+    return rule['repo'], rule.get('branch'), route
+
+
+def _is_exact(spec):
+    return not spec.startswith('re:') and '*' not in spec and '?' not in spec
+
+
+def _to_regex(spec):
+    """Returns regex for exact name, shell-style pattern or "re:" regex."""
+    if spec.startswith('re:'):
+        return spec[3:]
+    return ''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c)
+                   for c in spec)
+
+
+def _compile_branch(i, branch):
+    if branch is None:
+        return None
+    return _compile(i, '(?:{0})\\Z'.format(_to_regex(branch)))
+
+
+def _compile(i, pattern):
+    try:
+        return re.compile(pattern)
+    except (re.error, AssertionError) as e:
+        raise ValueError('Route {0} has invalid pattern: {1}'.format(i, e))
+
+
+def _combine(patterns):
+    """Returns list of (regex, routes by group number) that together match
+    the (rule number, pattern, route) tuples, in order."""
+    matchers = []
+    parts = []
+    routes = {}
+    groups = 0
+    for i, pattern, route in patterns:
+        size = _compile(i, pattern).groups + 1
+        if size > _MAX_GROUPS:
+            raise ValueError('Route {0} has too many groups.'.format(i))
+        if groups + size > _MAX_GROUPS:
+            matchers.append((re.compile('|'.join(parts)), routes))
+            parts, routes, groups = [], {}, 0
+        parts.append('({0})'.format(pattern))
+        routes[groups + 1] = route
+        groups += size
+    if parts:
+        matchers.append((re.compile('|'.join(parts)), routes))
+    return matchers
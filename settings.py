@@ -0,0 +1,50 @@
+"""Settings read while handling web hooks, parsed once from env config."""
+
+import collections
+import os
+
+Settings = collections.namedtuple('Settings', [
+    'max_body_size',
+    'max_commits',
+    'max_changed_files',
+    'max_changed_files_size',
+    'mirror_dir',
+    'diffstat_budget',
+    'send_workers',
+    'spool_path',
+    'dedup_ttl',
+    'rate_limit',
+    'recipient_rate_limit',
+    'rate_limit_wait',
+    'work_queue',
+])
+
+
+def load_settings(environ=None):
+    """Returns Settings read from `environ`, which defaults to os.environ.
+    Raises ValueError if a number is malformed."""
+    if environ is None:
+        environ = os.environ
+    return Settings(
+        max_body_size=int(environ.get(
+            'GITHUB_COMMIT_EMAILER_MAX_BODY_SIZE', 25 * 1024 * 1024)),
+        max_commits=int(environ.get('GITHUB_COMMIT_EMAILER_MAX_COMMITS', 0)),
+        max_changed_files=int(environ.get(
+            'GITHUB_COMMIT_EMAILER_MAX_CHANGED_FILES', 200)),
+        max_changed_files_size=int(environ.get(
+            'GITHUB_COMMIT_EMAILER_MAX_CHANGED_FILES_SIZE', 20000)),
+        mirror_dir=environ.get('GITHUB_COMMIT_EMAILER_MIRROR_DIR') or None,
+        diffstat_budget=float(environ.get(
+            'GITHUB_COMMIT_EMAILER_DIFFSTAT_BUDGET', 2)),
+        send_workers=int(environ.get(
+            'GITHUB_COMMIT_EMAILER_SEND_WORKERS', 0)),
+        spool_path=environ.get('GITHUB_COMMIT_EMAILER_SPOOL_PATH') or None,
+        dedup_ttl=float(environ.get('GITHUB_COMMIT_EMAILER_DEDUP_TTL', 0)),
+        # Rate limits are configured per minute.
+        rate_limit=float(environ.get('GITHUB_COMMIT_EMAILER_RATE_LIMIT', 0)),
+        recipient_rate_limit=float(environ.get(
+            'GITHUB_COMMIT_EMAILER_RECIPIENT_RATE_LIMIT', 0)),
+        rate_limit_wait=float(environ.get(
+            'GITHUB_COMMIT_EMAILER_RATE_LIMIT_WAIT', 10)),
+        work_queue=environ.get('GITHUB_COMMIT_EMAILER_WORK_QUEUE') or None,
+    )
@@ -0,0 +1,124 @@
+"""Web hook secrets, per repo or organization, and github signatures."""
+
+import calendar
+import collections
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+
+# Digests github signs web hooks with, by signature header, most preferred
+# first.
+SIGNATURE_HEADERS = (
+    ('x-hub-signature-256', 'sha256', hashlib.sha256),
+    ('x-hub-signature', 'sha1', hashlib.sha1),
+)
+
+Signature = collections.namedtuple('Signature', ['algorithm', 'hexdigest'])
+
+
+def get_signature(headers):
+    """Returns Signature from the strongest signature header present in
+    request headers, or None if there is none."""
+    for header, algorithm, _ in SIGNATURE_HEADERS:
+        value = headers.get(header)
+        if not value:
+            continue
+        prefix = algorithm + '='
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        if not value.startswith(prefix):
+            return None
+        return Signature(algorithm, value[len(prefix):])
+    return None
+
+
+class Key(object):
+    """Web hook secret. Keeps an hmac object keyed with the secret for each
+    digest, which is copied for each request so the key is only hashed
+    once."""
+
+    def __init__(self, secret, expires=None):
+        if isinstance(secret, unicode):
+            secret = secret.encode('utf-8')
+        self.expires = expires
+        self._macs = dict(
+            (algorithm, hmac.new(secret, digestmod=digestmod))
+            for _, algorithm, digestmod in SIGNATURE_HEADERS)
+
+    def new(self, algorithm):
+        """Returns new hmac object for algorithm, keyed with the secret."""
+        return self._macs[algorithm].copy()
+
+
+class SecretRegistry(object):
+    """Web hook secrets by repo full name or organization, with a default
+    for everything else. Each name may have several secrets, e.g. the new
+    and the old one while rotating it, each valid until it expires."""
+
+    def __init__(self, default=(), secrets=None):
+        self._default = list(default)
+        self._secrets = secrets or {}
+
+    @property
+    def per_repo(self):
+        """True if the secret depends on the repo of the push."""
+        return bool(self._secrets)
+
+    def macs(self, algorithm, repo=None):
+        """Returns new hmac objects for algorithm, one for each unexpired
+        secret of repo, its organization, or the default, in that order of
+        preference."""
+        keys = None
+        if repo:
+            keys = self._secrets.get(repo)
+            if keys is None:
+                keys = self._secrets.get(repo.split('/', 1)[0])
+        if keys is None:
+            keys = self._default
+        now = time.time()
+        return [key.new(algorithm) for key in keys
+                if key.expires is None or key.expires > now]
+
+
+def load_registry(environ=None):
+    """Returns SecretRegistry configured in `environ`, which defaults to
+    os.environ. Raises ValueError if no secret is configured at all."""
+    if environ is None:
+        environ = os.environ
+    default = [Key(environ[name]) for name in (
+        'GITHUB_COMMIT_EMAILER_SECRET', 'GITHUB_COMMIT_EMAILER_OLD_SECRET')
+        if environ.get(name)]
+
+    secrets = {}
+    path = environ.get('GITHUB_COMMIT_EMAILER_SECRETS')
+    if path:
+        with open(path) as f:
+            for name, entries in json.load(f).items():
+                if not isinstance(entries, list):
+                    entries = [entries]
+                secrets[name] = [_parse_key(name, e) for e in entries]
+
+    if not default and not secrets:
+        logging.error('No secret configured in environment.')
+        raise ValueError('No secret configured in environment.')
+    return SecretRegistry(default, secrets)
+
+
+def _parse_key(name, entry):
+    """Returns Key for a secrets file entry, which is either the secret or
+    an object with "secret" and an optional "expires" UTC time, like
+    "2016-01-31T00:00:00Z"."""
+    if not isinstance(entry, dict):
+        return Key(entry)
+    expires = entry.get('expires')
+    if expires is not None:
+        try:
+            expires = calendar.timegm(
+                time.strptime(expires, '%Y-%m-%dT%H:%M:%SZ'))
+        except ValueError:
+            raise ValueError('Invalid expires time for {0}: {1}'.format(
+                name, expires))
+    return Key(entry['secret'], expires)
@@ -0,0 +1,287 @@
+"""Process-wide pool of long-lived SMTP connections."""
+
+import collections
+import contextlib
+import logging
+import rendering
+import smtplib
+import socket
+import threading
+import time
+
+# Errors that mean the connection is unusable, rather than that the server
+# rejected the message.
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, socket.error)
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available in time."""
+
+
+class _Waiter(object):
+    """Caller waiting for a connection slot, woken when one is handed to
+    it."""
+
+    def __init__(self, lock):
+        self.cond = threading.Condition(lock)
+        self.granted = False
+
+
+class _PooledConnection(object):
+
+    def __init__(self, smtp, now):
+        self.smtp = smtp
+        self.created = now
+        self.last_used = now
+
+
+class SMTPPool(object):
+    """Pool of authenticated SMTP sessions shared by all threads of a process.
+
+    `factory` returns a new envelopes.SMTP instance. Connections are reused
+    until they have been idle for `idle_timeout` seconds or are older than
+    `max_age` seconds. Connections idle for longer than `check_interval`
+    seconds are checked with NOOP before being handed out. If `metrics` is
+    given, time spent connecting and sending is recorded in it.
+
+    Each connection is used by one caller at a time, from checkout until it
+    is returned, so concurrent requests, in threads or greenlets, never
+    share a session. When all `max_size` connections are checked out,
+    callers wait in line and are handed returned connections in the order
+    they arrived, so under many concurrent requests none waits much longer
+    than the others.
+    """
+
+    def __init__(self, factory, max_size=2, idle_timeout=60, max_age=300,
+                 check_interval=5, checkout_timeout=30, metrics=None):
+        self._factory = factory
+        self._metrics = metrics
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._max_age = max_age
+        self._check_interval = check_interval
+        self._checkout_timeout = checkout_timeout
+
+        self._lock = threading.Lock()
+        self._idle = []
+        self._checked_out = 0
+        self._waiters = collections.deque()
+        self._stats = {
+            'checkouts': 0,
+            'handshakes': 0,
+            'handshakes_avoided': 0,
+            'discarded': 0,
+            'checkout_wait_seconds': 0.0,
+            'checkout_wait_max_seconds': 0.0,
+        }
+
+    def stats(self):
+        """Returns copy of pool counters."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+            stats['checked_out'] = self._checked_out
+            stats['waiting'] = len(self._waiters)
+        return stats
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Context manager that checks out a connection and returns it to the
+        pool afterwards. Connections that raised a connection error are
+        closed instead of being returned."""
+        conn = self._checkout()
+        try:
+            yield conn.smtp
+        except CONNECTION_ERRORS:
+            self._discard(conn)
+            raise
+        except Exception:
+            self._checkin(conn)
+            raise
+        else:
+            self._checkin(conn)
+
+    def warm(self):
+        """Open a connection ahead of the first send, so the first email of a
+        fresh process does not wait for the SMTP handshake. Failures are
+        logged and left for the first send to retry."""
+        try:
+            with self.connection() as smtp:
+                if smtp._conn is None:
+                    with self._timer('smtp_connect'):
+                        smtp._connect()
+        except Exception as e:
+            logging.warn('Could not open SMTP connection ahead of time '
+                         '(%s).', e)
+
+    def send(self, envelope):
+        """Send envelope, or rendered message, on a pooled connection. If the
+        connection turns out to be dead, send again once on a fresh
+        connection."""
+        try:
+            with self.connection() as smtp:
+                return self._send(smtp, envelope)
+        except CONNECTION_ERRORS as e:
+            logging.warn('SMTP connection failed (%s), reconnecting.', e)
+        with self.connection() as smtp:
+            return self._send(smtp, envelope)
+
+    def send_many(self, envelopes):
+        """Send envelopes in one SMTP session. Returns a list holding, for
+        each envelope, the error that prevented it from being sent or None.
+        If the connection dies part way through, the unsent envelopes are
+        sent once more on a fresh connection."""
+        errors = [None] * len(envelopes)
+        pending = range(len(envelopes))
+        for attempt in (1, 2):
+            done = 0
+            try:
+                with self.connection() as smtp:
+                    for i in pending:
+                        try:
+                            self._send(smtp, envelopes[i])
+                        except CONNECTION_ERRORS:
+                            raise
+                        except Exception as e:
+                            errors[i] = e
+                        done += 1
+                return errors
+            except CONNECTION_ERRORS as e:
+                pending = pending[done:]
+                if attempt == 2:
+                    for i in pending:
+                        errors[i] = e
+                    return errors
+                logging.warn('SMTP connection failed (%s), reconnecting.', e)
+
+    def _send(self, smtp, envelope):
+        """Send envelope, or rendered message, on envelopes SMTP
+        connection."""
+        if not isinstance(envelope, rendering.Message):
+            return smtp.send(envelope)
+        # Rendered messages skip envelopes' MIME building and the NOOP it
+        # sends before every message; the pool already checks idle
+        # connections.
+        if smtp._conn is None:
+            with self._timer('smtp_connect'):
+                smtp._connect()
+        with self._timer('smtp_send'):
+            return smtp._conn.sendmail(envelope.from_addr, envelope.to_addrs,
+                                       envelope.data)
+
+    def _timer(self, stage):
+        if self._metrics is None:
+            return _null_timer()
+        return self._metrics.timer('github_email_stage_seconds', stage=stage)
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            _quit(conn.smtp)
+
+    def _checkout(self):
+        start = time.time()
+        with self._lock:
+            if self._checked_out < self._max_size and not self._waiters:
+                self._checked_out += 1
+            else:
+                self._wait_for_slot(start)
+            waited = time.time() - start
+            self._stats['checkouts'] += 1
+            self._stats['checkout_wait_seconds'] += waited
+            self._stats['checkout_wait_max_seconds'] = max(
+                waited, self._stats['checkout_wait_max_seconds'])
+
+        # Health checks talk to the server, so do them outside of the lock.
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                break
+            if self._usable(conn):
+                with self._lock:
+                    self._stats['handshakes_avoided'] += 1
+                return conn
+            with self._lock:
+                self._stats['discarded'] += 1
+            _quit(conn.smtp)
+
+        try:
+            smtp = self._factory()
+        except Exception:
+            with self._lock:
+                self._release_slot()
+            raise
+        with self._lock:
+            self._stats['handshakes'] += 1
+        return _PooledConnection(smtp, time.time())
+
+    def _wait_for_slot(self, start):
+        """Wait in line, holding self._lock, until the slot of a returned
+        connection is handed to this caller. Raises PoolTimeout if that
+        takes longer than the checkout timeout."""
+        waiter = _Waiter(self._lock)
+        self._waiters.append(waiter)
+        while not waiter.granted:
+            remaining = start + self._checkout_timeout - time.time()
+            if remaining <= 0:
+                self._waiters.remove(waiter)
+                raise PoolTimeout(
+                    'No SMTP connection available after {0}s.'.format(
+                        self._checkout_timeout))
+            waiter.cond.wait(remaining)
+
+    def _release_slot(self):
+        """Hand slot of a returned connection to the caller that has waited
+        longest, if any. Called holding self._lock."""
+        if self._waiters:
+            waiter = self._waiters.popleft()
+            waiter.granted = True
+            waiter.cond.notify()
+        else:
+            self._checked_out -= 1
+
+    def _usable(self, conn):
+        now = time.time()
+        if now - conn.created > self._max_age:
+            return False
+        idle = now - conn.last_used
+        if idle > self._idle_timeout:
+            return False
+        if idle > self._check_interval:
+            try:
+                return conn.smtp.is_connected
+            except CONNECTION_ERRORS:
+                return False
+        return True
+
+    def _checkin(self, conn):
+        conn.last_used = time.time()
+        with self._lock:
+            self._idle.append(conn)
+            self._release_slot()
+
+    def _discard(self, conn):
+        with self._lock:
+            self._stats['discarded'] += 1
+            self._release_slot()
+        _quit(conn.smtp)
+
+
+@contextlib.contextmanager
+def _null_timer():
+    yield
+
+
+def _quit(smtp):
+    """Close envelopes SMTP connection, ignoring errors."""
+    # envelopes.SMTP does not provide a way to close its connection.
+    conn = getattr(smtp, '_conn', None)
+    if conn is None:
+        return
+    try:
+        conn.quit()
+    except Exception:
+        pass
@@ -0,0 +1,286 @@
+"""Durable on-disk spool for outbound emails, with retries."""
+
+import json
+import logging
+import os
+import os.path
+import random
+import sqlite3
+import threading
+import time
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    body TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    last_error TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_next_attempt ON messages (next_attempt);
+"""
+
+
+class Spool(object):
+    """SQLite (WAL mode) backed store of messages that have been accepted but
+    not yet sent.
+
+    Each worker process opens its own Spool on the same file. A message is
+    only ever handed to one process at a time: putting or claiming a message
+    leases it for `lease` seconds by moving its next attempt time into the
+    future. The Spool keeps track of the messages leased through it until
+    they are acked, failed or released, and extend() renews all of their
+    leases, e.g. while they wait in a queue or for a rate limit. If the
+    process dies before acking or failing a message, the lease expires and
+    the message is claimed again.
+
+    With `fsync` set (the default), every put is flushed to disk before it
+    returns, so accepted messages survive power loss as well as crashes.
+    """
+
+    def __init__(self, path, dead_letter_dir=None, max_attempts=8,
+                 base_delay=30, max_delay=3600, lease=60, fsync=True):
+        self._path = path
+        self._dead_letter_dir = dead_letter_dir or path + '.dead'
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._lease = lease
+        self._lock = threading.Lock()
+        self._leased = set()
+
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous={0}'.format(
+            'FULL' if fsync else 'NORMAL'))
+        self._db.executescript(_SCHEMA)
+
+    def put(self, msg_info, hold=0):
+        """Store message and return its spool id. The message is leased to
+        the caller, which should ack() or fail() it once it has tried to send
+        it. `hold` extends the lease for callers that deliberately wait
+        before sending."""
+        now = time.time()
+        body = json.dumps(_without_spool_ids(msg_info))
+        with self._lock:
+            cursor = self._db.execute(
+                'INSERT INTO messages (body, next_attempt, created) '
+                'VALUES (?, ?, ?)', (body, now + hold + self._lease, now))
+            self._leased.add(cursor.lastrowid)
+        return cursor.lastrowid
+
+    def claim(self, limit=10):
+        """Lease up to `limit` messages that are due, and return them as
+        message infos. Each has "spool_ids" set to a list with its id."""
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._db.execute(
+                    'SELECT id, body FROM messages WHERE next_attempt <= ? '
+                    'ORDER BY next_attempt, id LIMIT ?',
+                    (now, limit)).fetchall()
+                self._db.executemany(
+                    'UPDATE messages SET next_attempt = ? WHERE id = ?',
+                    [(now + self._lease, row[0]) for row in rows])
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            self._leased.update(row[0] for row in rows)
+
+        msg_infos = []
+        for spool_id, body in rows:
+            msg_info = json.loads(body)
+            msg_info['spool_ids'] = [spool_id]
+            msg_infos.append(msg_info)
+        return msg_infos
+
+    def ack(self, spool_ids):
+        """Remove sent messages from the spool."""
+        with self._lock:
+            self._db.executemany('DELETE FROM messages WHERE id = ?',
+                                 [(i,) for i in spool_ids])
+            self._leased.difference_update(spool_ids)
+
+    def release(self, spool_ids):
+        """Give up lease on messages so they are retried right away."""
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                'UPDATE messages SET next_attempt = ? WHERE id = ?',
+                [(now, i) for i in spool_ids])
+            self._leased.difference_update(spool_ids)
+
+    def held(self, spool_ids):
+        """Returns the ids of messages that this process still holds a lease
+        on, i.e. that have not been acked, released or failed."""
+        with self._lock:
+            return [i for i in spool_ids if i in self._leased]
+
+    def extend(self):
+        """Renew the leases of all messages put or claimed through this
+        Spool that have not been acked, failed or released yet. Leases held
+        for longer, see put(), are kept. Returns number of messages."""
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                'UPDATE messages SET next_attempt = MAX(next_attempt, ?) '
+                'WHERE id = ?', [(now + self._lease, i) for i in self._leased])
+            return len(self._leased)
+
+    def fail(self, spool_ids, error):
+        """Record failed attempt to send messages. Schedules a retry with
+        exponential backoff and jitter, or moves the message to the dead
+        letter directory once it has used up its attempts. Returns list of
+        the ids of messages that were moved there."""
+        error = repr(error)
+        dead = []
+        for spool_id in spool_ids:
+            with self._lock:
+                self._leased.discard(spool_id)
+                row = self._db.execute(
+                    'SELECT body, attempts, created FROM messages '
+                    'WHERE id = ?', (spool_id,)).fetchone()
+                if row is None:
+                    continue
+                body, attempts, created = row
+                attempts += 1
+                if attempts < self._max_attempts:
+                    self._db.execute(
+                        'UPDATE messages SET attempts = ?, next_attempt = ?, '
+                        'last_error = ? WHERE id = ?',
+                        (attempts, time.time() + self.backoff(attempts),
+                         error, spool_id))
+                    continue
+                self._dead_letter(spool_id, body, attempts, created, error)
+                self._db.execute('DELETE FROM messages WHERE id = ?',
+                                 (spool_id,))
+                dead.append(spool_id)
+        return dead
+
+    def backoff(self, attempts):
+        """Returns seconds to wait before retrying after `attempts` failed
+        attempts."""
+        delay = min(self._max_delay, self._base_delay * 2 ** (attempts - 1))
+        return random.uniform(delay / 2.0, delay)
+
+    def pending(self):
+        """Returns number of messages in the spool."""
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM messages').fetchone()[0]
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._db.close()
+
+    def _dead_letter(self, spool_id, body, attempts, created, error):
+        if not os.path.isdir(self._dead_letter_dir):
+            os.makedirs(self._dead_letter_dir)
+        path = os.path.join(self._dead_letter_dir, '{0}.json'.format(spool_id))
+        with open(path + '.tmp', 'w') as f:
+            json.dump({
+                'msg_info': json.loads(body),
+                'attempts': attempts,
+                'created': created,
+                'last_error': error,
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+        logging.error('Giving up on spooled message %s after %d attempts, '
+                      'moved to %s', spool_id, attempts, path)
+
+
+def _without_spool_ids(msg_info):
+    if 'spool_ids' not in msg_info:
+        return msg_info
+    msg_info = dict(msg_info)
+    del msg_info['spool_ids']
+    return msg_info
+
+
+class RetryScheduler(object):
+    """Background thread that sends spooled messages that are due, and one
+    that extends the leases of the messages this process holds every
+    `heartbeat` seconds, so they are not claimed by another process while
+    they are still on their way.
+
+    Messages left over from a previous process, e.g. after a crash, are
+    picked up by the first poll once their lease has expired, so the spool
+    is replayed on startup.
+    """
+
+    def __init__(self, spool, deliver_func, interval=10, batch_size=10,
+                 heartbeat=20):
+        self._spool = spool
+        self._deliver_func = deliver_func
+        self._interval = interval
+        self._batch_size = batch_size
+        self._heartbeat = heartbeat
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """Start polling the spool, and extending leases. Calling more than
+        once is a no-op."""
+        if self._threads:
+            return
+        self._threads = [
+            threading.Thread(target=self._run, name='spool-retry'),
+            threading.Thread(target=self._run_heartbeat,
+                             name='spool-heartbeat'),
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self, timeout=None):
+        """Stop polling and wait for the current retry batch to finish."""
+        self._stop.set()
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None
+                        else max(0, deadline - time.time()))
+
+    def run_once(self):
+        """Deliver due messages. Returns number of messages delivered. If
+        delivering a batch raises, its messages that are still held are
+        failed, so they are retried later rather than kept leased by the
+        heartbeat."""
+        count = 0
+        while not self._stop.is_set():
+            msg_infos = self._spool.claim(self._batch_size)
+            if not msg_infos:
+                break
+            logging.info('Retrying %d spooled message(s).', len(msg_infos))
+            try:
+                self._deliver_func(msg_infos)
+            except Exception as e:
+                logging.exception('Failed to deliver spooled messages.')
+                self._spool.fail(self._spool.held(
+                    [i for msg_info in msg_infos
+                     for i in msg_info['spool_ids']]), e)
+                continue
+            count += len(msg_infos)
+        return count
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                logging.exception('Failed to retry spooled messages.')
+            self._stop.wait(self._interval)
+
+    def _run_heartbeat(self):
+        while not self._stop.wait(self._heartbeat):
+            try:
+                self._spool.extend()
+            except Exception:
+                logging.exception('Failed to extend leases of spooled '
+                                  'messages.')
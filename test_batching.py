@@ -0,0 +1,182 @@
+import email
+import mock
+import unittest
+
+import batching
+import rendering
+
+
+class BatchingTests(unittest.TestCase):
+
+    def setUp(self):
+        """Setup message info for a couple of pushes."""
+        super(BatchingTests, self).setUp()
+        self.push1 = {
+            'repo': 'TESTING/test',
+            'branch': 'refs/heads/master',
+            'revision': 'aaaaaaa',
+            'message': 'First TEST commit.',
+            'changed_files': 'M README\nA new.txt',
+            'pusher': 'TESTING-bot',
+            'pusher_email': 'TESTING-bot <bot@example.com>',
+            'compare_url': 'http://TEST.fake/1',
+        }
+        self.push2 = {
+            'repo': 'TESTING/test',
+            'branch': 'refs/heads/dev',
+            'revision': 'bbbbbbb',
+            'message': 'Second TEST commit.',
+            'changed_files': 'M README\nR old.txt',
+            'pusher': 'TESTING-human',
+            'pusher_email': 'TESTING-human <human@example.com>',
+            'compare_url': 'http://TEST.fake/2',
+        }
+
+    def test_parse_digest_rules(self):
+        """Verify digest rules are parsed with default and explicit
+        windows."""
+        rules = batching.parse_digest_rules(
+            'org/bot=30, org/docs-*,,', default_window=5)
+        self.assertEqual([('org/bot', 30.0), ('org/docs-*', 5.0)], rules)
+
+    def test_make_digest__single(self):
+        """Verify single message is not changed."""
+        self.assertIs(self.push1, batching.make_digest([self.push1]))
+
+    def test_make_digest(self):
+        """Verify digest merges fields of every push."""
+        digest = batching.make_digest([self.push1, self.push2])
+        self.assertEqual('TESTING/test', digest['repo'])
+        self.assertEqual(
+            '[TESTING/test] 2 pushes to refs/heads/master, refs/heads/dev',
+            digest['subject'])
+        self.assertEqual('refs/heads/master, refs/heads/dev',
+                         digest['branch'])
+        self.assertEqual('aaaaaaa, bbbbbbb', digest['revision'])
+        self.assertEqual('M README\nA new.txt\nR old.txt',
+                         digest['changed_files'])
+        self.assertEqual('TESTING-bot, TESTING-human', digest['pusher'])
+        self.assertEqual(self.push1['pusher_email'], digest['pusher_email'])
+        self.assertEqual('http://TEST.fake/1\nhttp://TEST.fake/2',
+                         digest['compare_url'])
+        self.assertIn('First TEST commit.', digest['message'])
+        self.assertIn('bbbbbbb on refs/heads/dev by TESTING-human:',
+                      digest['message'])
+
+    def test_make_digest__unicode(self):
+        """Verify digest of pushes with non-ASCII messages and pushers can
+        be built and rendered."""
+        push1 = dict(self.push1, message=u'F\xfcrst TEST commit.',
+                     pusher=u'TESTING-b\xf6t')
+        push2 = dict(self.push2, branch=u'refs/heads/d\xe9v')
+        digest = batching.make_digest([push1, push2])
+        self.assertIn(u'aaaaaaa on refs/heads/master by TESTING-b\xf6t:\n\n'
+                      u'F\xfcrst TEST commit.', digest['message'])
+        self.assertIn(u'refs/heads/d\xe9v', digest['subject'])
+        renderer = rendering.Renderer(rendering.Config(
+            sender='noreply@fake.fake', send_from_author=False,
+            recipient='recip@fake.fake', reply_to=None, approved=None,
+            template_dir=None, routes_path=None))
+        msg = email.message_from_string(renderer.render(digest).data)
+        self.assertIn(u'F\xfcrst TEST commit.',
+                      msg.get_payload(decode=True).decode('utf-8'))
+
+    def test_make_digest__delivery_ids(self):
+        """Verify delivery ids of the pushes are carried over."""
+        digest = batching.make_digest([
+            dict(self.push1, delivery_id='d1'), self.push2,
+            dict(self.push2, delivery_id='d2')])
+        self.assertEqual('d1,d2', digest['delivery_id'])
+        self.assertNotIn(
+            'delivery_id', batching.make_digest([self.push1, self.push2]))
+
+    def test_make_digest__dedup_keys(self):
+        """Verify dedup keys of the pushes are carried over."""
+        digest = batching.make_digest([
+            dict(self.push1, dedup_keys=['d1', 'p1']), self.push2,
+            dict(self.push2, dedup_keys=['p2'])])
+        self.assertEqual(['d1', 'p1', 'p2'], digest['dedup_keys'])
+
+    def test_make_digest__long_subject(self):
+        """Verify digest subject is truncated like commit subjects."""
+        pushes = [dict(self.push1, branch='refs/heads/{0}'.format(i))
+                  for i in range(20)]
+        digest = batching.make_digest(pushes)
+        self.assertEqual(len('[TESTING/test] ') + 50, len(digest['subject']))
+
+    def test_window_for(self):
+        """Verify first matching rule determines digest window."""
+        buf = batching.DigestBuffer(
+            mock.Mock(), [('org/bot', 30), ('org/*', 60)])
+        self.assertEqual(30, buf.window_for('org/bot'))
+        self.assertEqual(60, buf.window_for('org/other'))
+        self.assertIsNone(buf.window_for('elsewhere/bot'))
+
+    def test_add__not_digested(self):
+        """Verify push to repo without rule is not held."""
+        flush = mock.Mock()
+        buf = batching.DigestBuffer(flush, [('other/*', 60)])
+        self.assertFalse(buf.add(self.push1))
+        buf.flush_all()
+        self.assertEqual(0, flush.call_count)
+
+    @mock.patch('threading.Timer')
+    def test_add__flush_after_window(self, mock_timer):
+        """Verify held pushes are sent as one digest when window expires."""
+        flush = mock.Mock()
+        buf = batching.DigestBuffer(flush, [('TESTING/*', 30)])
+        push2 = dict(self.push2, branch='refs/heads/master')
+        self.assertTrue(buf.add(self.push1))
+        self.assertTrue(buf.add(push2))
+        mock_timer.assert_called_once_with(
+            30, buf.flush, args=('TESTING/test:refs/heads/master',))
+        self.assertEqual(0, flush.call_count)
+
+        buf.flush('TESTING/test:refs/heads/master')
+        flush.assert_called_once_with(
+            batching.make_digest([self.push1, push2]))
+        mock_timer.return_value.cancel.assert_called_once_with()
+
+    @mock.patch('threading.Timer')
+    def test_add__per_branch(self, mock_timer):
+        """Verify pushes to different branches are digested separately, so
+        each digest can be routed by its branch."""
+        flush = mock.Mock()
+        buf = batching.DigestBuffer(flush, [('TESTING/*', 30)])
+        buf.add(self.push1)
+        buf.add(self.push2)
+        buf.add(dict(self.push1, revision='ccccccc'))
+        buf.flush_all()
+        digests = [c[0][0] for c in flush.call_args_list]
+        self.assertEqual(
+            ['refs/heads/master', 'refs/heads/dev'],
+            sorted([d['branch'] for d in digests], reverse=True))
+        self.assertIn(
+            {'TESTING/test:refs/heads/master', 'TESTING/test:refs/heads/dev'},
+            [{c[1]['args'][0] for c in mock_timer.call_args_list}])
+
+    @mock.patch('threading.Timer')
+    def test_add__max_messages(self, mock_timer):
+        """Verify digest is sent early when max messages are held."""
+        flush = mock.Mock()
+        buf = batching.DigestBuffer(flush, [('TESTING/*', 30)],
+                                    max_messages=2)
+        buf.add(self.push1)
+        buf.add(dict(self.push2, branch='refs/heads/master'))
+        self.assertEqual(1, flush.call_count)
+        buf.flush_all()
+        self.assertEqual(1, flush.call_count)
+
+    @mock.patch('threading.Timer')
+    def test_flush_all(self, mock_timer):
+        """Verify flush_all sends a digest per repo and branch."""
+        flush = mock.Mock()
+        buf = batching.DigestBuffer(flush, [('*', 30)])
+        buf.add(self.push1)
+        buf.add(dict(self.push2, repo='TESTING/other'))
+        buf.flush_all()
+        self.assertEqual(2, flush.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import changes
+
+
+class SummarizeTests(unittest.TestCase):
+
+    def test_summarize(self):
+        """Verify every file is listed when within budget."""
+        actual = changes.summarize(['index.html'], ['a.out', 'gen'],
+                                   ['README.md'])
+        self.assertEqual(u'A index.html\nR a.out\nR gen\nM README.md', actual)
+
+    def test_summarize__empty(self):
+        """Verify no lines when no files changed."""
+        self.assertEqual(u'', changes.summarize([], [], []))
+
+    def test_summarize__collapsed(self):
+        """Verify files are grouped by directory when over budget."""
+        modified = ['third-party/llvm/lib/f{0}.cpp'.format(i)
+                    for i in range(4812)]
+        actual = changes.summarize(['README.md'], [],
+                                   modified + ['compiler/main.cpp'])
+        self.assertEqual(
+            u'A README.md\n'
+            u'M third-party/llvm/… (4,812 files)\n'
+            u'M compiler/main.cpp\n'
+            u'4,814 files changed: 1 added, 0 removed, 4,813 modified',
+            actual)
+
+    def test_summarize__depth(self):
+        """Verify files are grouped by the given number of directories."""
+        modified = ['a/b/c/{0}'.format(i) for i in range(5)]
+        actual = changes.summarize([], [], modified, max_lines=3, depth=1)
+        self.assertEqual(
+            u'M a/… (5 files)\n'
+            u'5 files changed: 0 added, 0 removed, 5 modified', actual)
+
+    def test_summarize__max_lines(self):
+        """Verify groups beyond the line budget are counted."""
+        added = ['dir{0}/sub/file'.format(i) for i in range(100)]
+        actual = changes.summarize(added, [], [], max_lines=5)
+        lines = actual.splitlines()
+        self.assertEqual(5, len(lines))
+        self.assertEqual(u'A dir2/sub/file', lines[2])
+        self.assertEqual(u'… 97 more files not shown', lines[3])
+        self.assertEqual(
+            u'100 files changed: 100 added, 0 removed, 0 modified', lines[4])
+
+    def test_summarize__max_bytes(self):
+        """Verify summary stays within the byte budget."""
+        added = ['{0}/{1}'.format(i, 'x' * 100) for i in range(1000)]
+        actual = changes.summarize(added, [], [], max_bytes=1000)
+        self.assertTrue(len(actual.encode('utf-8')) <= 1000)
+        self.assertIn(u'more files not shown', actual)
+
+    def test_summarize__max_groups(self):
+        """Verify files beyond the group limit are counted, not kept."""
+        removed = ['file{0}'.format(i) for i in range(1000)]
+        actual = changes.summarize([], removed, [], max_lines=10)
+        self.assertIn(u'… 992 more files not shown', actual)
+        self.assertIn(u'1,000 removed', actual)
+
+    def test_summarize__unicode(self):
+        """Verify non-ascii paths are counted in bytes."""
+        added = [u'd\xe9j\xe0/vu']
+        self.assertEqual(u'A d\xe9j\xe0/vu',
+                         changes.summarize(added, [], [], max_bytes=12))
+        self.assertIn(u'1 added', changes.summarize(added, [], [],
+                                                    max_bytes=11))
+
+    def test_summarize__stats(self):
+        """Verify line counts are shown for listed files."""
+        self.assertEqual(
+            u'A a (+3 -0)\nR r\nM m (binary)',
+            changes.summarize(['a'], ['r'], ['m'],
+                              stats={'a': (3, 0), 'm': (None, None)}))
+
+    def test_combine(self):
+        """Verify net changes of commits."""
+        commits = [
+            {'added': ['a', 'b', 'c'], 'removed': ['r'], 'modified': ['m']},
+            {'added': ['r'], 'removed': ['b', 'm'], 'modified': ['a']},
+            {'added': [], 'removed': [], 'modified': ['c', 'x']},
+        ]
+        self.assertEqual((['a', 'c'], ['m'], ['r', 'x']),
+                         changes.combine(commits))
+
+
+if __name__ == '__main__':
+    unittest.main()
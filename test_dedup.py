@@ -0,0 +1,148 @@
+import mock
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import dedup
+
+
+class LRUCacheTests(unittest.TestCase):
+
+    def test_add(self):
+        """Verify add returns False for keys already present."""
+        cache = dedup.LRUCache()
+        self.assertFalse(cache.contains('a'))
+        self.assertTrue(cache.add('a'))
+        self.assertTrue(cache.contains('a'))
+        self.assertFalse(cache.add('a'))
+
+    def test_max_entries(self):
+        """Verify oldest keys are evicted beyond max entries."""
+        cache = dedup.LRUCache(max_entries=2)
+        for key in 'abc':
+            cache.add(key)
+        self.assertEqual(2, len(cache))
+        self.assertFalse(cache.contains('a'))
+        self.assertTrue(cache.contains('c'))
+
+    @mock.patch('time.time')
+    def test_ttl(self, mock_time):
+        """Verify keys expire after ttl."""
+        cache = dedup.LRUCache(ttl=10)
+        mock_time.return_value = 1000
+        cache.add('a')
+        mock_time.return_value = 1009
+        self.assertTrue(cache.contains('a'))
+        mock_time.return_value = 1010
+        self.assertFalse(cache.contains('a'))
+        self.assertTrue(cache.add('a'))
+
+    def test_discard(self):
+        """Verify discarded keys can be added again."""
+        cache = dedup.LRUCache()
+        cache.add('a')
+        cache.discard('a')
+        cache.discard('never-added')
+        self.assertTrue(cache.add('a'))
+
+
+class SQLiteStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        """Setup store in a temporary directory."""
+        super(SQLiteStoreTests, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'dedup.db')
+        self.store = dedup.SQLiteStore(self.path, max_entries=3, ttl=10)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmp_dir)
+        super(SQLiteStoreTests, self).tearDown()
+
+    def test_add__shared(self):
+        """Verify keys added by one store are seen by another on the same
+        file."""
+        other = dedup.SQLiteStore(self.path)
+        self.assertTrue(self.store.add('a'))
+        self.assertTrue(other.contains('a'))
+        self.assertFalse(other.add('a'))
+        other.discard('a')
+        self.assertFalse(self.store.contains('a'))
+        other.close()
+
+    @mock.patch('time.time')
+    def test_ttl(self, mock_time):
+        """Verify keys expire after ttl."""
+        mock_time.return_value = 1000
+        self.store.add('a')
+        mock_time.return_value = 1010
+        self.assertFalse(self.store.contains('a'))
+        self.assertTrue(self.store.add('a'))
+
+    def test_purge(self):
+        """Verify store is trimmed to max entries."""
+        self.store.PURGE_INTERVAL = 5
+        for key in 'abcde':
+            self.store.add(key)
+        count = self.store._db.execute(
+            'SELECT COUNT(*) FROM seen').fetchone()[0]
+        self.assertEqual(3, count)
+        self.assertTrue(self.store.contains('e'))
+
+
+class DedupCacheTests(unittest.TestCase):
+
+    def test_seen(self):
+        """Verify seen counts hits for keys that were added."""
+        cache = dedup.DedupCache(dedup.LRUCache())
+        self.assertFalse(cache.seen('a'))
+        self.assertTrue(cache.add('a'))
+        self.assertTrue(cache.seen('a'))
+        self.assertEqual({'hits': 1, 'misses': 1, 'hit_rate': 0.5},
+                         cache.stats())
+
+    def test_seen__shared(self):
+        """Verify keys found in shared store are cached locally."""
+        shared = mock.Mock()
+        shared.contains.return_value = True
+        local = dedup.LRUCache()
+        cache = dedup.DedupCache(local, shared)
+        self.assertTrue(cache.seen('a'))
+        self.assertTrue(local.contains('a'))
+
+    def test_add__any_duplicate(self):
+        """Verify add fails if any key was added before, without keeping the
+        other keys."""
+        cache = dedup.DedupCache(dedup.LRUCache())
+        cache.add('push')
+        self.assertFalse(cache.add('delivery', 'push'))
+        self.assertFalse(cache.seen('delivery'))
+        self.assertEqual(1, cache.stats()['hits'])
+
+    def test_add__shared_duplicate(self):
+        """Verify add fails if another process added the key."""
+        shared = mock.Mock()
+        shared.add.return_value = False
+        cache = dedup.DedupCache(dedup.LRUCache(), shared)
+        self.assertFalse(cache.add('a'))
+
+    def test_discard(self):
+        """Verify discard forgets keys locally and in shared store."""
+        shared = mock.Mock()
+        shared.contains.return_value = False
+        cache = dedup.DedupCache(dedup.LRUCache(), shared)
+        cache.add('a', 'b')
+        cache.discard('a', 'b')
+        self.assertFalse(cache.seen('a'))
+        shared.discard.assert_has_calls([mock.call('a'), mock.call('b')])
+
+    def test_stats__empty(self):
+        """Verify hit rate is zero before any deliveries."""
+        cache = dedup.DedupCache(dedup.LRUCache())
+        self.assertEqual(0.0, cache.stats()['hit_rate'])
+
+
+if __name__ == '__main__':
+    unittest.main()
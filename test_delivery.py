@@ -0,0 +1,169 @@
+import mock
+import threading
+import unittest
+
+import delivery
+
+
+@mock.patch('logging.exception', new=mock.Mock())
+class DeliveryQueueTests(unittest.TestCase):
+
+    def test_init__no_workers(self):
+        """Verify ValueError when worker count is less than one."""
+        self.assertRaises(ValueError,
+                          delivery.DeliveryQueue, mock.Mock(), workers=0)
+
+    def test_put__sends(self):
+        """Verify queued messages are passed to send function."""
+        sent = []
+        q = delivery.DeliveryQueue(sent.extend, workers=2)
+        for i in range(10):
+            q.put({'id': i})
+        self.assertTrue(q.shutdown(timeout=5))
+        self.assertEqual(range(10), sorted(m['id'] for m in sent))
+
+    def test_put__full(self):
+        """Verify QueueFull when queue is at capacity."""
+        release = threading.Event()
+        started = threading.Event()
+
+        def send(msg_infos):
+            started.set()
+            release.wait()
+
+        q = delivery.DeliveryQueue(send, workers=1, max_depth=1)
+        q.put({'id': 0})
+        started.wait(5)
+        q.put({'id': 1})
+        self.assertRaises(delivery.QueueFull, q.put, {'id': 2})
+        release.set()
+        self.assertTrue(q.shutdown(timeout=5))
+
+    def test_put__after_shutdown(self):
+        """Verify QueueFull when queue has been shut down."""
+        q = delivery.DeliveryQueue(mock.Mock(), workers=1)
+        q.shutdown(timeout=5)
+        self.assertRaises(delivery.QueueFull, q.put, {'id': 0})
+
+    def test_shutdown__drains(self):
+        """Verify shutdown sends every accepted message before returning."""
+        release = threading.Event()
+        sent = []
+
+        def send(msg_infos):
+            release.wait()
+            sent.extend(msg_infos)
+
+        q = delivery.DeliveryQueue(send, workers=1, max_depth=10)
+        for i in range(5):
+            q.put({'id': i})
+        release.set()
+        self.assertTrue(q.shutdown(timeout=5))
+        self.assertEqual([0, 1, 2, 3, 4], [m['id'] for m in sent])
+        self.assertEqual(0, q.qsize())
+
+    def test_send_error__keeps_running(self):
+        """Verify a failed send does not stop the sender thread."""
+        sent = []
+
+        def send(msg_infos):
+            if msg_infos[0]['id'] == 0:
+                raise ValueError('boom')
+            sent.extend(msg_infos)
+
+        q = delivery.DeliveryQueue(send, workers=1)
+        q.put({'id': 0})
+        q.put({'id': 1})
+        self.assertTrue(q.shutdown(timeout=5))
+        self.assertEqual([{'id': 1}], sent)
+
+    def test_init__bad_batch_size(self):
+        """Verify ValueError when batch size is less than one."""
+        self.assertRaises(ValueError, delivery.DeliveryQueue, mock.Mock(),
+                          workers=1, batch_size=0)
+
+    def test_batch(self):
+        """Verify waiting messages are sent together, up to batch size."""
+        release = threading.Event()
+        started = threading.Event()
+        batches = []
+
+        def send(msg_infos):
+            started.set()
+            release.wait()
+            batches.append([m['id'] for m in msg_infos])
+
+        q = delivery.DeliveryQueue(send, workers=1, max_depth=10,
+                                   batch_size=3)
+        q.put({'id': 0})
+        started.wait(5)
+        for i in range(1, 6):
+            q.put({'id': i})
+        release.set()
+        self.assertTrue(q.shutdown(timeout=5))
+        self.assertEqual([[0], [1, 2, 3], [4, 5]], batches)
+
+    def test_priority(self):
+        """Verify waiting messages are sent by priority when given."""
+        release = threading.Event()
+        started = threading.Event()
+        sent = []
+
+        def send(msg_infos):
+            started.set()
+            release.wait()
+            sent.extend(m['id'] for m in msg_infos)
+
+        q = delivery.DeliveryQueue(send, workers=1, max_depth=10,
+                                   priority=lambda m: m['id'] % 2)
+        q.put({'id': 0})
+        started.wait(5)
+        for i in range(1, 5):
+            q.put({'id': i})
+        release.set()
+        self.assertTrue(q.shutdown(timeout=5))
+        self.assertEqual([0, 2, 4, 1, 3], sent)
+
+
+class FairQueueTests(unittest.TestCase):
+
+    def drain(self, q):
+        items = []
+        while not q.empty():
+            items.append(q.get_nowait())
+        return items
+
+    def test_turns(self):
+        """Verify repos take turns, keeping the order of each repo's
+        messages, and stop markers come out last."""
+        q = delivery.FairQueue()
+        stop = object()
+        for repo, i in [('a', 0), ('a', 1), ('a', 2), ('b', 3), ('c', 4),
+                        ('b', 5)]:
+            q.put({'repo': repo, 'id': i})
+        q.put(stop)
+        q.put({'repo': 'a', 'id': 6})
+        self.assertEqual(8, q.qsize())
+        items = self.drain(q)
+        self.assertIs(stop, items.pop())
+        self.assertEqual([0, 3, 4, 1, 5, 2, 6], [m['id'] for m in items])
+
+    def test_priority(self):
+        """Verify higher priority messages come out first."""
+        q = delivery.FairQueue(
+            priority=delivery.branch_priority(['refs/heads/release/*']))
+        q.put({'repo': 'a', 'branch': 'refs/heads/feature', 'id': 0})
+        q.put({'repo': 'a', 'branch': 'refs/heads/release/1.0', 'id': 1})
+        q.put({'repo': 'b', 'branch': 'refs/heads/x, refs/heads/release/2',
+               'id': 2})
+        self.assertEqual([1, 2, 0], [m['id'] for m in self.drain(q)])
+
+    def test_full(self):
+        """Verify max size is enforced."""
+        q = delivery.FairQueue(maxsize=1)
+        q.put_nowait({'repo': 'a'})
+        self.assertTrue(q.full())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import distutils.spawn
+import mock
+import os
+import os.path
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import diffstat
+
+
+class DiffstatCacheTests(unittest.TestCase):
+
+    def test_lru(self):
+        """Verify least recently used diffstats are evicted."""
+        cache = diffstat.DiffstatCache(max_entries=2)
+        cache.put('a', {'x': (1, 0)})
+        cache.put('b', {})
+        self.assertEqual({'x': (1, 0)}, cache.get('a'))
+        cache.put('c', {})
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual({}, cache.get('c'))
+        self.assertEqual(2, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+
+class ParseNumstatTests(unittest.TestCase):
+
+    def test_parse_numstat(self):
+        """Verify counts per path, with None for binary files."""
+        self.assertEqual(
+            {u'a.txt': (3, 1), u'b\tc': (0, 2), u'bin': (None, None)},
+            diffstat.parse_numstat('\n3\t1\ta.txt\x000\t2\tb\tc\x00'
+                                   '-\t-\tbin\x00'))
+
+
+@unittest.skipIf(distutils.spawn.find_executable('git') is None,
+                 'git is not installed')
+class MirrorsTests(unittest.TestCase):
+
+    def setUp(self):
+        """Setup repo with two commits and a mirror of it."""
+        super(MirrorsTests, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp_dir, 'src')
+        os.mkdir(self.src)
+        self.git('init', '-q')
+        self.first = self.commit({'a.txt': 'a\nb\n', 'bin': 'x\0y'})
+        self.second = self.commit({'a.txt': 'a\nc\nd\n'})
+        self.root = os.path.join(self.tmp_dir, 'mirrors')
+        self.git('clone', '-q', '--mirror', self.src,
+                 os.path.join(self.root, 'org', 'repo.git'))
+        self.mirrors = diffstat.Mirrors(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        super(MirrorsTests, self).tearDown()
+
+    def git(self, *args):
+        return subprocess.check_output(
+            ('git', '-c', 'user.name=a', '-c', 'user.email=a@fake.fake') +
+            args, cwd=self.src).strip()
+
+    def commit(self, files):
+        """Commit files in src repo and return its sha."""
+        for name, content in files.items():
+            with open(os.path.join(self.src, name), 'w') as f:
+                f.write(content)
+            self.git('add', name)
+        self.git('commit', '-q', '-m', 'change')
+        return self.git('rev-parse', 'HEAD')
+
+    def test_diffstat(self):
+        """Verify diffstats of commits are added up."""
+        self.assertEqual({u'a.txt': (2, 0), u'bin': (None, None)},
+                         self.mirrors.diffstat('org/repo', [self.first], 5))
+        self.assertEqual({u'a.txt': (4, 1), u'bin': (None, None)},
+                         self.mirrors.diffstat(
+                             'org/repo', [self.first, self.second], 5))
+
+    def test_diffstat__cached(self):
+        """Verify diffstats are cached by commit."""
+        self.mirrors.diffstat('org/repo', [self.first], 5)
+        with mock.patch('subprocess.Popen') as mock_popen:
+            self.assertEqual(
+                {u'a.txt': (2, 0), u'bin': (None, None)},
+                self.mirrors.diffstat('org/repo', [self.first], 5))
+        self.assertEqual(0, mock_popen.call_count)
+
+    def test_diffstat__fetches(self):
+        """Verify mirror is fetched for commits it does not have yet."""
+        third = self.commit({'c.txt': 'c\n'})
+        self.assertEqual({u'c.txt': (1, 0)},
+                         self.mirrors.diffstat('org/repo', [third], 10))
+
+    @mock.patch('diffstat.Mirrors._fetch')
+    def test_diffstat__cold(self, mock_fetch):
+        """Verify None when the mirror cannot be fetched in time."""
+        mock_fetch.return_value.is_alive.return_value = True
+        third = self.commit({'c.txt': 'c\n'})
+        self.assertIsNone(self.mirrors.diffstat('org/repo', [third], 5))
+        self.assertIsNone(self.mirrors.diffstat('org/repo', [self.first],
+                                                0))
+
+    def test_diffstat__no_mirror(self):
+        """Verify None for repos without mirror, or with bad names."""
+        self.assertIsNone(self.mirrors.diffstat('org/other', [self.first],
+                                                5))
+        self.assertIsNone(self.mirrors.diffstat('../repo', [self.first], 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
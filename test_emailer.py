@@ -1,12 +1,25 @@
+import hashlib
 import hmac
 import json
 import mock
 import os
-import sha
+import shutil
+import signal
+import tempfile
+import threading
+import time
 import unittest
 import uuid
 
+import dedup
+import delivery
 import emailer
+import logs
+import ratelimit
+import signatures
+import smtp_pool
+import spool
+import workqueue
 
 
 @mock.patch('logging.error', new=mock.Mock())
@@ -18,6 +31,12 @@ class EmailerTests(unittest.TestCase):
         """Setup flask app for testing."""
         super(EmailerTests, self).setUp()
         emailer.app.config['TESTING'] = True
+        emailer._renderer = None
+        emailer._secret_registry = None
+        emailer._metrics = None
+        emailer._settings = None
+        emailer._rollbar_initialized = False
+        self.registry = signatures.SecretRegistry([signatures.Key('adsf')])
         self.app = emailer.app.test_client()
         self.headers = {
             'x-github-event': 'push',
@@ -68,6 +87,18 @@ class EmailerTests(unittest.TestCase):
         )
         mock_exc.assert_called_once_with(mock.ANY, emailer.app)
 
+    @mock.patch('flask.got_request_exception.connect')
+    @mock.patch('rollbar.init')
+    def test_rollbar_init__once(self, mock_init, mock_exc):
+        """Verify rollbar is not initialized again on first request when
+        the worker already did."""
+        os.environ['ROLLBAR_ACCESS_TOKEN'] = 'fakefakefake'
+        emailer.app.config['TESTING'] = False
+        emailer.init_rollbar()
+        emailer.app.before_first_request_funcs[0]()
+        self.assertEqual(1, mock_init.call_count)
+        self.assertEqual(1, mock_exc.call_count)
+
     @mock.patch('flask.got_request_exception.connect')
     @mock.patch('rollbar.init')
     def test_rollbar_init__env_name(self, mock_init, mock_exc):
@@ -85,6 +116,30 @@ class EmailerTests(unittest.TestCase):
         )
         mock_exc.assert_called_once_with(mock.ANY, emailer.app)
 
+    def test_fast_path(self):
+        """Verify ignored events and too large bodies are answered before
+        reaching flask."""
+        mock_commit_email = mock.Mock()
+        views = mock.patch.dict(emailer.app.view_functions,
+                                {'commit_email': mock_commit_email})
+        views.start()
+        self.addCleanup(views.stop)
+        r = self.app.post('/commit-email', headers={'x-github-event': 'star'},
+                          data='x' * 100)
+        self.assertEqual(200, r.status_code)
+        self.assertEqual('nope', r.data)
+        os.environ['GITHUB_COMMIT_EMAILER_MAX_BODY_SIZE'] = '10'
+        try:
+            r = self.app.post('/commit-email', headers=self.headers,
+                              data='x' * 100)
+        finally:
+            del os.environ['GITHUB_COMMIT_EMAILER_MAX_BODY_SIZE']
+        self.assertEqual(413, r.status_code)
+        self.assertEqual(404, self.app.post('/other').status_code)
+        self.assertEqual(0, mock_commit_email.call_count)
+        self.assertEqual(1, self.counter('github_email_events_skipped_total',
+                                         reason='too_large'))
+
     def test_index_redirects(self):
         """Verify index page redirects to chapel-lang.org."""
         r = self.app.get('/')
@@ -99,11 +154,11 @@ class EmailerTests(unittest.TestCase):
         self.assertEqual(200, r.status_code)
         self.assertEqual(0, mock_send.call_count)
 
-    @mock.patch('emailer._get_secret')
+    @mock.patch('emailer._get_secret_registry')
     @mock.patch('emailer._send_email')
     def test_push_invalid_signature(self, mock_send, mock_secret):
         """Verify push event with invalid sig is skipped."""
-        mock_secret.return_value = 'asdf'
+        mock_secret.return_value = self.registry
         headers = {'x-github-event': 'push',
                    'x-hub-signature': 'sha1=bogus'}
         r = self.app.post('/commit-email', headers=headers)
@@ -121,12 +176,12 @@ class EmailerTests(unittest.TestCase):
             headers=self.headers
         )
 
-    @mock.patch('emailer._valid_signature')
-    @mock.patch('emailer._get_secret')
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
     @mock.patch('emailer._send_email')
     def test_deleted_branch(self, mock_send, mock_sec, mock_sig):
         """Verify deleted branch notification are skipped."""
-        mock_sec.return_value = 'asdf'
+        mock_sec.return_value = self.registry
         mock_sig.return_value = True
         r = self.app.post('/commit-email',
                           headers=self.headers,
@@ -134,12 +189,12 @@ class EmailerTests(unittest.TestCase):
         self.assertEqual(200, r.status_code)
         self.assertEqual(0, mock_send.call_count)
 
-    @mock.patch('emailer._valid_signature')
-    @mock.patch('emailer._get_secret')
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
     @mock.patch('emailer._send_email')
     def test_test_send_mail(self, mock_send, mock_sec, mock_sig):
         """Verify correct message info is passed to _send_email."""
-        mock_sec.return_value = 'adsf'
+        mock_sec.return_value = self.registry
         mock_sig.return_value = True
         body = {
             'ref': 'the/master',
@@ -175,6 +230,866 @@ class EmailerTests(unittest.TestCase):
         self.assertEqual(200, r.status_code)
         mock_send.assert_called_once_with(expected_msg_info)
 
+    @mock.patch('emailer._get_delivery_queue')
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
+    @mock.patch('emailer._send_email')
+    def test_push__queued(self, mock_send, mock_sec, mock_sig, mock_queue):
+        """Verify push is enqueued and accepted when delivery queue is
+        configured."""
+        mock_sec.return_value = self.registry
+        mock_sig.return_value = True
+        r = self.app.post('/commit-email',
+                          headers=self.headers,
+                          data=json.dumps(self.push_body()))
+        self.assertEqual(202, r.status_code)
+        self.assertEqual(0, mock_send.call_count)
+        mock_queue.return_value.put.assert_called_once_with(mock.ANY)
+        msg_info = mock_queue.return_value.put.call_args[0][0]
+        self.assertEqual('testing/test', msg_info['repo'])
+
+    @mock.patch('emailer._get_delivery_queue')
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
+    @mock.patch('emailer._send_email')
+    def test_push__queue_full(self, mock_send, mock_sec, mock_sig,
+                              mock_queue):
+        """Verify 503 when delivery queue is full."""
+        mock_sec.return_value = self.registry
+        mock_sig.return_value = True
+        mock_queue.return_value.put.side_effect = delivery.QueueFull()
+        r = self.app.post('/commit-email',
+                          headers=self.headers,
+                          data=json.dumps(self.push_body()))
+        self.assertEqual(503, r.status_code)
+        self.assertEqual(0, mock_send.call_count)
+
+    @mock.patch('emailer._get_rate_limiter')
+    @mock.patch('emailer._get_smtp_pool')
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
+    def test_push__rate_limited(self, mock_sec, mock_sig, mock_pool,
+                                mock_limiter):
+        """Verify 503 when a rate limit does not allow sending the email in
+        time."""
+        self.prep_env()
+        mock_sec.return_value = self.registry
+        mock_sig.return_value = True
+        mock_limiter.return_value.acquire.side_effect = \
+            ratelimit.RateLimited('boom')
+        r = self.app.post('/commit-email',
+                          headers=self.headers,
+                          data=json.dumps(self.push_body()))
+        self.assertEqual(503, r.status_code)
+        mock_limiter.return_value.acquire.assert_called_once_with(
+            [self.recipient], max_wait=10)
+        self.assertEqual(0, mock_pool.return_value.send.call_count)
+        self.assertEqual(1, self.counter('github_email_events_skipped_total',
+                                         reason='rate_limited'))
+        self.assertEqual(0, self.counter('github_email_emails_failed_total'))
+
+    @mock.patch('emailer._get_rate_limiter')
+    @mock.patch('emailer._get_smtp_pool')
+    def test_deliver__rate_limited(self, mock_pool, mock_limiter):
+        """Verify queued batch waits for the rate limits of each email."""
+        self.prep_env()
+        mock_pool.return_value.send_many.return_value = [None, None]
+        emailer._deliver([self.msg_info, self.msg_info])
+        self.assertEqual([mock.call([self.recipient], max_wait=None)] * 2,
+                         mock_limiter.return_value.acquire.call_args_list)
+
+    def test_get_rate_limiter__not_configured(self):
+        """Verify no rate limiter when no limit is configured."""
+        self.assertIsNone(emailer._get_rate_limiter())
+
+    @mock.patch('emailer._rate_limiter', new=None)
+    def test_get_rate_limiter(self):
+        """Verify rate limiter is created once with limits per second."""
+        os.environ['GITHUB_COMMIT_EMAILER_RECIPIENT_RATE_LIMIT'] = '30'
+        try:
+            limiter = emailer._get_rate_limiter()
+            self.assertIs(limiter, emailer._get_rate_limiter())
+        finally:
+            del os.environ['GITHUB_COMMIT_EMAILER_RECIPIENT_RATE_LIMIT']
+        self.assertEqual(0, limiter._rate)
+        self.assertEqual(0.5, limiter._recipient_rate)
+        self.assertEqual(5, limiter._recipient_burst)
+        self.assertIsInstance(limiter._buckets, ratelimit.MemoryBuckets)
+
+    def test_get_delivery_queue__not_configured(self):
+        """Verify no delivery queue when send workers are not configured."""
+        if 'GITHUB_COMMIT_EMAILER_SEND_WORKERS' in os.environ:
+            del os.environ['GITHUB_COMMIT_EMAILER_SEND_WORKERS']
+        self.assertIsNone(emailer._get_delivery_queue())
+
+    @mock.patch('atexit.register')
+    @mock.patch('emailer._delivery_queue', new=None)
+    def test_get_delivery_queue(self, mock_atexit):
+        """Verify delivery queue is created once and drained at exit."""
+        os.environ['GITHUB_COMMIT_EMAILER_SEND_WORKERS'] = '3'
+        os.environ['GITHUB_COMMIT_EMAILER_QUEUE_SIZE'] = '7'
+        try:
+            q = emailer._get_delivery_queue()
+            self.assertIs(q, emailer._get_delivery_queue())
+        finally:
+            del os.environ['GITHUB_COMMIT_EMAILER_SEND_WORKERS']
+            del os.environ['GITHUB_COMMIT_EMAILER_QUEUE_SIZE']
+        self.assertEqual(3, q._workers)
+        self.assertEqual(7, q._queue.maxsize)
+        self.assertEqual(10, q._batch_size)
+        self.assertEqual(0, q._queue._priority(
+            {'branch': 'refs/heads/master'}))
+        self.assertEqual(1, q._queue._priority({'branch': 'refs/heads/x'}))
+        mock_atexit.assert_called_once_with(emailer._drain_delivery_queue)
+
+    @mock.patch('emailer._get_smtp_pool')
+    def test_deliver(self, mock_pool):
+        """Verify queued batch is sent in one SMTP session."""
+        self.prep_env()
+        mock_pool.return_value.send_many.return_value = [None, None]
+        other = dict(self.msg_info, repo='TESTING/other')
+        emailer._deliver([self.msg_info, other])
+
+        mock_pool.return_value.send_many.assert_called_once_with(mock.ANY)
+        msgs = mock_pool.return_value.send_many.call_args[0][0]
+        self.assertEqual(2, len(msgs))
+        self.check_msg(msgs[0])
+        self.assertEqual('[TESTING/other] TEST commit message.',
+                         msgs[1].subject)
+
+    @mock.patch('rollbar.report_exc_info')
+    @mock.patch('emailer._get_smtp_pool')
+    def test_deliver__error(self, mock_pool, mock_report):
+        """Verify queued delivery errors are reported to rollbar per
+        message."""
+        self.prep_env()
+        error = ValueError('boom')
+        mock_pool.return_value.send_many.return_value = [error, None]
+        emailer._deliver([self.msg_info, self.msg_info])
+        mock_report.assert_called_once_with((ValueError, error, None))
+
+    @mock.patch('rollbar.report_exc_info')
+    @mock.patch('emailer._get_smtp_pool')
+    def test_deliver__build_error(self, mock_pool, mock_report):
+        """Verify a message that cannot be built does not stop the rest of
+        the batch."""
+        self.prep_env()
+        mock_pool.return_value.send_many.return_value = [None]
+        emailer._deliver([{'pusher_email': 'x', 'repo': 'x'}, self.msg_info])
+        self.assertEqual(1, mock_report.call_count)
+        msgs = mock_pool.return_value.send_many.call_args[0][0]
+        self.assertEqual(1, len(msgs))
+
+    @mock.patch('emailer._get_smtp_pool')
+    def test_send_email__subject(self, mock_pool):
+        """Verify subject from message info is used when present."""
+        self.prep_env()
+        emailer._send_email(dict(self.msg_info, subject='[x] 2 pushes'))
+        actual_msg = mock_pool.return_value.send.call_args[0][0]
+        self.assertEqual('[x] 2 pushes', actual_msg.subject)
+
+    @mock.patch('emailer._digest_buffer')
+    @mock.patch('emailer._get_delivery_queue')
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
+    def test_push__digest(self, mock_sec, mock_sig, mock_queue,
+                          mock_digest):
+        """Verify push to digested repo is held instead of queued."""
+        mock_sec.return_value = self.registry
+        mock_sig.return_value = True
+        mock_digest.add.return_value = True
+        r = self.app.post('/commit-email',
+                          headers=self.headers,
+                          data=json.dumps(self.push_body()))
+        self.assertEqual(202, r.status_code)
+        self.assertEqual(1, mock_digest.add.call_count)
+        self.assertEqual(0, mock_queue.return_value.put.call_count)
+
+    @mock.patch('emailer._smtp_pool', new=None)
+    def test_get_smtp_pool(self):
+        """Verify SMTP pool is created once per process."""
+        os.environ['GITHUB_COMMIT_EMAILER_SMTP_POOL_SIZE'] = '5'
+        try:
+            pool = emailer._get_smtp_pool()
+            self.assertIs(pool, emailer._get_smtp_pool())
+        finally:
+            del os.environ['GITHUB_COMMIT_EMAILER_SMTP_POOL_SIZE']
+        self.assertEqual(5, pool._max_size)
+
+    @mock.patch('envelopes.SMTP')
+    @mock.patch('envelopes.SendGridSMTP')
+    def test_new_smtp(self, mock_sendgrid, mock_smtp):
+        """Verify SendGrid is used unless an SMTP host is configured."""
+        self.assertIs(mock_sendgrid.return_value, emailer._new_smtp())
+        os.environ['GITHUB_COMMIT_EMAILER_SMTP_HOST'] = 'localhost'
+        os.environ['GITHUB_COMMIT_EMAILER_SMTP_PORT'] = '2525'
+        try:
+            self.assertIs(mock_smtp.return_value, emailer._new_smtp())
+        finally:
+            del os.environ['GITHUB_COMMIT_EMAILER_SMTP_HOST']
+            del os.environ['GITHUB_COMMIT_EMAILER_SMTP_PORT']
+        mock_smtp.assert_called_once_with(host='localhost', port=2525,
+                                          timeout=30)
+
+    @mock.patch('envelopes.SendGridSMTP')
+    def test_index__no_smtp(self, mock_smtp):
+        """Verify requests that do not send email do not create SMTP
+        connections."""
+        self.app.get('/')
+        self.app.post('/commit-email', headers={'x-github-event': 'ping'})
+        self.assertEqual(0, mock_smtp.call_count)
+
+    @mock.patch('emailer._deliver')
+    @mock.patch('emailer._get_spool')
+    @mock.patch('emailer._get_delivery_queue')
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
+    @mock.patch('emailer._send_email')
+    def test_push__spooled(self, mock_send, mock_sec, mock_sig, mock_queue,
+                           mock_spool, mock_deliver):
+        """Verify push is spooled before it is sent."""
+        mock_sec.return_value = self.registry
+        mock_sig.return_value = True
+        mock_queue.return_value = None
+        mock_spool.return_value.put.return_value = 17
+        r = self.app.post('/commit-email',
+                          headers=self.headers,
+                          data=json.dumps(self.push_body()))
+        self.assertEqual(200, r.status_code)
+        mock_spool.return_value.put.assert_called_once_with(mock.ANY, hold=0)
+        self.assertEqual(0, mock_send.call_count)
+        mock_deliver.assert_called_once_with([mock.ANY], max_wait=10)
+        self.assertEqual([17], mock_deliver.call_args[0][0][0]['spool_ids'])
+
+    @mock.patch('emailer._get_smtp_pool')
+    @mock.patch('emailer._get_rate_limiter')
+    @mock.patch('emailer._get_spool')
+    @mock.patch('emailer._get_delivery_queue')
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
+    def test_push__spooled_rate_limited(self, mock_sec, mock_sig, mock_queue,
+                                        mock_spool, mock_limiter, mock_pool):
+        """Verify spooled push that the rate limits do not allow sending
+        within the allowed wait is accepted and left in the spool, instead
+        of blocking the web hook."""
+        self.prep_env()
+        mock_sec.return_value = self.registry
+        mock_sig.return_value = True
+        mock_queue.return_value = None
+        mock_spool.return_value.put.return_value = 17
+        mock_limiter.return_value.acquire.side_effect = (
+            ratelimit.RateLimited('TEST limited.'))
+        r = self.app.post('/commit-email',
+                          headers=self.headers,
+                          data=json.dumps(self.push_body()))
+        self.assertEqual(202, r.status_code)
+        mock_limiter.return_value.acquire.assert_called_once_with(
+            [self.recipient], max_wait=10)
+        mock_spool.return_value.release.assert_called_once_with([17])
+        self.assertEqual(0, mock_pool.return_value.send_many.call_count)
+        self.assertEqual(0, mock_spool.return_value.fail.call_count)
+
+    @mock.patch('emailer._digest_buffer')
+    @mock.patch('emailer._get_spool')
+    @mock.patch('emailer._get_delivery_queue')
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
+    def test_push__spooled_digest(self, mock_sec, mock_sig, mock_queue,
+                                  mock_spool, mock_digest):
+        """Verify spooled push held for digest is leased for the digest
+        window."""
+        mock_sec.return_value = self.registry
+        mock_sig.return_value = True
+        mock_digest.window_for.return_value = 30
+        mock_digest.add.return_value = True
+        r = self.app.post('/commit-email',
+                          headers=self.headers,
+                          data=json.dumps(self.push_body()))
+        self.assertEqual(202, r.status_code)
+        mock_spool.return_value.put.assert_called_once_with(mock.ANY,
+                                                            hold=30)
+
+    @mock.patch('emailer._get_spool')
+    @mock.patch('emailer._get_delivery_queue')
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
+    def test_push__spooled_queue_full(self, mock_sec, mock_sig, mock_queue,
+                                      mock_spool):
+        """Verify push is accepted and left for retry when queue is full but
+        message is spooled."""
+        mock_sec.return_value = self.registry
+        mock_sig.return_value = True
+        mock_queue.return_value.put.side_effect = delivery.QueueFull()
+        mock_spool.return_value.put.return_value = 17
+        r = self.app.post('/commit-email',
+                          headers=self.headers,
+                          data=json.dumps(self.push_body()))
+        self.assertEqual(202, r.status_code)
+        mock_spool.return_value.release.assert_called_once_with([17])
+
+    @mock.patch('rollbar.report_exc_info', new=mock.Mock())
+    @mock.patch('emailer._get_spool')
+    @mock.patch('emailer._get_smtp_pool')
+    def test_deliver__spooled(self, mock_pool, mock_spool):
+        """Verify spooled messages are acked when sent and failed when not."""
+        self.prep_env()
+        error = ValueError('boom')
+        mock_pool.return_value.send_many.return_value = [None, error]
+        emailer._deliver([dict(self.msg_info, spool_ids=[1]),
+                          dict(self.msg_info, spool_ids=[2, 3])])
+        mock_spool.return_value.ack.assert_called_once_with([1])
+        mock_spool.return_value.fail.assert_called_once_with([2, 3], error)
+
+    @mock.patch('rollbar.report_exc_info', new=mock.Mock())
+    @mock.patch('emailer._get_smtp_pool')
+    def test_deliver__spooled_pool_timeout(self, mock_pool):
+        """Verify spooled message is failed when its batch cannot be sent at
+        all, so it is retried later rather than kept leased."""
+        self.prep_env()
+        tmp_dir = tempfile.mkdtemp()
+        msg_spool = spool.Spool(os.path.join(tmp_dir, 'spool.db'),
+                                base_delay=0, max_delay=0)
+        try:
+            spool_id = msg_spool.put(self.msg_info)
+            mock_pool.return_value.send_many.side_effect = \
+                smtp_pool.PoolTimeout('No SMTP connection available.')
+            with mock.patch('emailer._get_spool', return_value=msg_spool):
+                errors = emailer._deliver(
+                    [dict(self.msg_info, spool_ids=[spool_id])])
+                self.assertIsInstance(errors[0], smtp_pool.PoolTimeout)
+                self.assertEqual([], msg_spool.held([spool_id]))
+
+                mock_pool.return_value.send_many.side_effect = None
+                mock_pool.return_value.send_many.return_value = [None]
+                scheduler = spool.RetryScheduler(msg_spool, emailer._deliver)
+                self.assertEqual(1, scheduler.run_once())
+            self.assertEqual(0, msg_spool.pending())
+        finally:
+            msg_spool.close()
+            shutil.rmtree(tmp_dir)
+
+    @mock.patch('rollbar.report_exc_info', new=mock.Mock())
+    @mock.patch('emailer._get_smtp_pool')
+    def test_deliver__results(self, mock_pool):
+        """Verify error of each message is returned, in order."""
+        self.prep_env()
+        error = ValueError('boom')
+        mock_pool.return_value.send_many.return_value = [error, None]
+        errors = emailer._deliver([self.msg_info, {'repo': 'x'},
+                                   self.msg_info])
+        self.assertEqual(3, len(errors))
+        self.assertIs(error, errors[0])
+        self.assertIsInstance(errors[1], Exception)
+        self.assertIsNone(errors[2])
+
+    @mock.patch('emailer._work_priority',
+                new=delivery.branch_priority(['the/*']))
+    @mock.patch('emailer._senders')
+    @mock.patch('emailer._get_delivery_queue')
+    @mock.patch('emailer._get_work_queue')
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
+    def test_push__work_queue(self, mock_sec, mock_sig, mock_work_queue,
+                              mock_queue, mock_senders):
+        """Verify push is put on the shared work queue, keyed by its head
+        commit, with the priority of its branch, and local senders are woken
+        up."""
+        mock_sec.return_value = self.registry
+        mock_sig.return_value = True
+        mock_work_queue.return_value.put.return_value = 5
+        r = self.app.post('/commit-email',
+                          headers=self.headers,
+                          data=json.dumps(self.push_body()))
+        self.assertEqual(202, r.status_code)
+        mock_work_queue.return_value.put.assert_called_once_with(
+            mock.ANY, key='push:testing/test:the/master:some-sha1', delay=0,
+            group=None, priority=0, repo='testing/test')
+        mock_senders.wake.assert_called_once_with()
+        self.assertEqual(0, mock_queue.call_count)
+
+    @mock.patch('emailer._get_work_queue')
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
+    def test_push__work_queue_duplicate(self, mock_sec, mock_sig,
+                                        mock_work_queue):
+        """Verify push already in the work queue is skipped."""
+        mock_sec.return_value = self.registry
+        mock_sig.return_value = True
+        mock_work_queue.return_value.put.return_value = None
+        r = self.app.post('/commit-email',
+                          headers=self.headers,
+                          data=json.dumps(self.push_body()))
+        self.assertEqual(200, r.status_code)
+        self.assertEqual('nope', r.data)
+        self.assertEqual(1, self.counter('github_email_events_skipped_total',
+                                         reason='duplicate_push'))
+
+    @mock.patch('emailer._work_priority', new=None)
+    @mock.patch('emailer._senders', new=None)
+    @mock.patch('emailer._digest_rules', new=[('testing/*', 30.0)])
+    @mock.patch('emailer._get_work_queue')
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
+    def test_push__work_queue_digest(self, mock_sec, mock_sig,
+                                     mock_work_queue):
+        """Verify push to digested repo is held in the work queue, grouped
+        by repo and branch."""
+        mock_sec.return_value = self.registry
+        mock_sig.return_value = True
+        r = self.app.post('/commit-email',
+                          headers=self.headers,
+                          data=json.dumps(self.push_body()))
+        self.assertEqual(202, r.status_code)
+        mock_work_queue.return_value.put.assert_called_once_with(
+            mock.ANY, key=mock.ANY, delay=30.0,
+            group='testing/test:the/master', priority=0, repo='testing/test')
+
+    @mock.patch('emailer._deliver')
+    def test_deliver_jobs(self, mock_deliver):
+        """Verify jobs of one group are sent as a digest, and the error of
+        each email is returned for each of its jobs."""
+        error = ValueError('boom')
+        mock_deliver.return_value = [None, error]
+        jobs = [
+            workqueue.Job(1, 't1', dict(self.msg_info, revision='a'), 1,
+                          'TESTING/test'),
+            workqueue.Job(2, 't2', self.msg_info, 1, None),
+            workqueue.Job(3, 't3', dict(self.msg_info, revision='b'), 1,
+                          'TESTING/test'),
+        ]
+        self.assertEqual([None, error, None], emailer._deliver_jobs(jobs))
+        digest, single = mock_deliver.call_args[0][0]
+        self.assertIn('2 pushes', digest['subject'])
+        self.assertIs(self.msg_info, single)
+
+    def test_get_work_queue__not_configured(self):
+        """Verify no work queue when it is not configured."""
+        if 'GITHUB_COMMIT_EMAILER_WORK_QUEUE' in os.environ:
+            del os.environ['GITHUB_COMMIT_EMAILER_WORK_QUEUE']
+        self.assertIsNone(emailer._get_work_queue())
+
+    @mock.patch('atexit.register')
+    @mock.patch('workqueue.Senders')
+    @mock.patch('workqueue.open_queue')
+    @mock.patch('emailer._work_priority', new=None)
+    @mock.patch('emailer._digest_rules', new=[])
+    @mock.patch('emailer._senders', new=None)
+    @mock.patch('emailer._work_queue', new=None)
+    def test_get_work_queue(self, mock_open, mock_senders, mock_atexit):
+        """Verify work queue is opened once, with senders started if send
+        workers are configured."""
+        os.environ['GITHUB_COMMIT_EMAILER_WORK_QUEUE'] = 'sqlite:///TEST/q.db'
+        os.environ['GITHUB_COMMIT_EMAILER_SEND_WORKERS'] = '3'
+        try:
+            q = emailer._get_work_queue()
+            self.assertIs(q, emailer._get_work_queue())
+        finally:
+            del os.environ['GITHUB_COMMIT_EMAILER_WORK_QUEUE']
+            del os.environ['GITHUB_COMMIT_EMAILER_SEND_WORKERS']
+        self.assertIs(mock_open.return_value, q)
+        mock_open.assert_called_once_with('sqlite:///TEST/q.db', lease=60.0,
+                                          max_attempts=8, retention=86400.0)
+        mock_senders.assert_called_once_with(
+            q, emailer._deliver_jobs, workers=3, batch_size=10,
+            heartbeat=20.0)
+        mock_senders.return_value.start.assert_called_once_with()
+        mock_atexit.assert_called_once_with(emailer._stop_senders)
+
+    def test_get_spool__not_configured(self):
+        """Verify no spool when spool path is not configured."""
+        if 'GITHUB_COMMIT_EMAILER_SPOOL_PATH' in os.environ:
+            del os.environ['GITHUB_COMMIT_EMAILER_SPOOL_PATH']
+        self.assertIsNone(emailer._get_spool())
+
+    @mock.patch('atexit.register')
+    @mock.patch('spool.RetryScheduler')
+    @mock.patch('spool.Spool')
+    @mock.patch('emailer._spool', new=None)
+    def test_get_spool(self, mock_spool, mock_scheduler, mock_atexit):
+        """Verify spool is created once and its retry scheduler started."""
+        os.environ['GITHUB_COMMIT_EMAILER_SPOOL_PATH'] = '/TEST/spool.db'
+        try:
+            s = emailer._get_spool()
+            self.assertIs(s, emailer._get_spool())
+        finally:
+            del os.environ['GITHUB_COMMIT_EMAILER_SPOOL_PATH']
+        self.assertIs(mock_spool.return_value, s)
+        mock_spool.assert_called_once_with(
+            '/TEST/spool.db', dead_letter_dir=None, max_attempts=8,
+            lease=60.0)
+        mock_scheduler.assert_called_once_with(
+            s, emailer._deliver, interval=10.0, heartbeat=20.0)
+        mock_scheduler.return_value.start.assert_called_once_with()
+        mock_atexit.assert_called_once_with(
+            mock_scheduler.return_value.stop, 5)
+
+    @mock.patch('emailer._get_dedup_cache')
+    @mock.patch('emailer._get_secret_registry')
+    @mock.patch('emailer._send_email')
+    def test_push__duplicate_delivery(self, mock_send, mock_sec, mock_dedup):
+        """Verify redelivery is skipped before verifying signature."""
+        mock_dedup.return_value.seen.return_value = True
+        headers = dict(self.headers, **{'x-github-delivery': 'TEST-id'})
+        r = self.app.post('/commit-email', headers=headers,
+                          data=json.dumps(self.push_body()))
+        self.assertEqual(200, r.status_code)
+        mock_dedup.return_value.seen.assert_called_once_with(
+            'delivery:TEST-id')
+        self.assertEqual(0, mock_sec.call_count)
+        self.assertEqual(0, mock_send.call_count)
+
+    @mock.patch('emailer._get_dedup_cache')
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
+    @mock.patch('emailer._send_email')
+    def test_push__duplicate_push(self, mock_send, mock_sec, mock_sig,
+                                  mock_dedup):
+        """Verify push of the same head commit is skipped."""
+        mock_sec.return_value = self.registry
+        mock_sig.return_value = True
+        mock_dedup.return_value.seen.return_value = False
+        mock_dedup.return_value.add.return_value = False
+        headers = dict(self.headers, **{'x-github-delivery': 'TEST-id'})
+        r = self.app.post('/commit-email', headers=headers,
+                          data=json.dumps(self.push_body()))
+        self.assertEqual(200, r.status_code)
+        mock_dedup.return_value.add.assert_called_once_with(
+            'delivery:TEST-id', 'push:testing/test:the/master:some-sha1')
+        self.assertEqual(0, mock_send.call_count)
+
+    @mock.patch('emailer._get_dedup_cache')
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
+    @mock.patch('emailer._send_email')
+    def test_push__dedup_metrics(self, mock_send, mock_sec, mock_sig,
+                                 mock_dedup):
+        """Verify duplicate deliveries and pushes are counted as dedup hits,
+        and accepted deliveries as misses."""
+        mock_sec.return_value = self.registry
+        mock_sig.return_value = True
+        mock_dedup.return_value = dedup.DedupCache(dedup.LRUCache(ttl=60))
+        for delivery_id in ('TEST-1', 'TEST-1', 'TEST-2'):
+            headers = dict(self.headers,
+                           **{'x-github-delivery': delivery_id})
+            self.app.post('/commit-email', headers=headers,
+                          data=json.dumps(self.push_body()))
+        self.assertEqual(1, mock_send.call_count)
+        self.assertEqual(2, self.counter('github_email_dedup_hits_total'))
+        self.assertEqual(1, self.counter('github_email_dedup_misses_total'))
+
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
+    @mock.patch('emailer._send_email')
+    def test_push__delivery_id(self, mock_send, mock_sec, mock_sig):
+        """Verify delivery id is logged while handling the push, and passed
+        on with the message info."""
+        mock_sec.return_value = self.registry
+        mock_sig.return_value = True
+        contexts = []
+        mock_send.side_effect = lambda msg_info: contexts.append(
+            logs.current_context())
+        headers = dict(self.headers, **{'x-github-delivery': 'TEST-id'})
+        r = self.app.post('/commit-email', headers=headers,
+                          data=json.dumps(self.push_body()))
+        self.assertEqual(200, r.status_code)
+        self.assertEqual('TEST-id', mock_send.call_args[0][0]['delivery_id'])
+        self.assertEqual([{'delivery_id': 'TEST-id'}], contexts)
+        self.assertEqual({}, logs.current_context())
+
+    @mock.patch('emailer._get_dedup_cache')
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
+    @mock.patch('emailer._send_email')
+    def test_push__dedup_send_fails(self, mock_send, mock_sec, mock_sig,
+                                    mock_dedup):
+        """Verify delivery is forgotten when sending fails, so github can
+        redeliver it."""
+        mock_sec.return_value = self.registry
+        mock_sig.return_value = True
+        mock_dedup.return_value.add.return_value = True
+        mock_send.side_effect = ValueError('boom')
+        self.assertRaises(ValueError, self.app.post, '/commit-email',
+                          headers=self.headers,
+                          data=json.dumps(self.push_body()))
+        mock_dedup.return_value.discard.assert_called_once_with(
+            'push:testing/test:the/master:some-sha1')
+
+    @mock.patch('emailer._get_dedup_cache')
+    @mock.patch('emailer._get_delivery_queue')
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
+    def test_push__dedup_queue_full(self, mock_sec, mock_sig, mock_queue,
+                                    mock_dedup):
+        """Verify delivery is forgotten when it is rejected with 503."""
+        mock_sec.return_value = self.registry
+        mock_sig.return_value = True
+        mock_dedup.return_value.add.return_value = True
+        mock_queue.return_value.put.side_effect = delivery.QueueFull()
+        r = self.app.post('/commit-email',
+                          headers=self.headers,
+                          data=json.dumps(self.push_body()))
+        self.assertEqual(503, r.status_code)
+        self.assertEqual(1, mock_dedup.return_value.discard.call_count)
+
+    @mock.patch('rollbar.report_exc_info', new=mock.Mock())
+    @mock.patch('emailer._get_smtp_pool')
+    @mock.patch('emailer._get_dedup_cache')
+    @mock.patch('emailer._get_delivery_queue')
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
+    def test_push__dedup_background_send_fails(self, mock_sec, mock_sig,
+                                               mock_queue, mock_dedup,
+                                               mock_pool):
+        """Verify delivery sent in the background is forgotten when sending
+        it fails, so a redelivery is accepted."""
+        self.prep_env()
+        mock_sec.return_value = self.registry
+        mock_sig.return_value = True
+        mock_dedup.return_value = dedup.DedupCache(dedup.LRUCache(ttl=60))
+        mock_pool.return_value.send_many.return_value = [ValueError('boom')]
+        headers = dict(self.headers, **{'x-github-delivery': 'TEST-id'})
+        for _ in range(2):
+            r = self.app.post('/commit-email', headers=headers,
+                              data=json.dumps(self.push_body()))
+            self.assertEqual(202, r.status_code)
+            msg_info = mock_queue.return_value.put.call_args[0][0]
+            emailer._deliver([msg_info])
+        self.assertEqual(2, mock_queue.return_value.put.call_count)
+
+    @mock.patch('rollbar.report_exc_info', new=mock.Mock())
+    @mock.patch('emailer._get_smtp_pool')
+    @mock.patch('emailer._get_dedup_cache')
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
+    def test_push__dedup_background_batch_fails(self, mock_sec, mock_sig,
+                                                mock_dedup, mock_pool):
+        """Verify delivery sent in the background is forgotten when its
+        whole batch fails to send, so a redelivery is accepted."""
+        self.prep_env()
+        mock_sec.return_value = self.registry
+        mock_sig.return_value = True
+        cache = dedup.DedupCache(dedup.LRUCache(ttl=60))
+        mock_dedup.return_value = cache
+        mock_pool.return_value.send_many.side_effect = \
+            smtp_pool.PoolTimeout('No SMTP connection available.')
+        headers = dict(self.headers, **{'x-github-delivery': 'TEST-id'})
+        queue = delivery.DeliveryQueue(emailer._deliver, workers=1)
+        with mock.patch('emailer._get_delivery_queue', return_value=queue):
+            r = self.app.post('/commit-email', headers=headers,
+                              data=json.dumps(self.push_body()))
+            self.assertEqual(202, r.status_code)
+            self.assertTrue(queue.shutdown(timeout=5))
+        self.assertEqual(1, mock_pool.return_value.send_many.call_count)
+        self.assertFalse(cache.seen('delivery:TEST-id'))
+
+    @mock.patch('rollbar.report_exc_info', new=mock.Mock())
+    @mock.patch('emailer._get_dedup_cache')
+    @mock.patch('emailer._get_spool')
+    @mock.patch('emailer._get_smtp_pool')
+    def test_deliver__spooled_dedup(self, mock_pool, mock_spool, mock_dedup):
+        """Verify deliveries of a spooled message are only forgotten once it
+        is given up on."""
+        self.prep_env()
+        mock_pool.return_value.send_many.return_value = [ValueError('boom')]
+        msg_info = dict(self.msg_info, spool_ids=[1], dedup_keys=['k1'])
+        mock_spool.return_value.fail.return_value = []
+        emailer._deliver([msg_info])
+        self.assertEqual(0, mock_dedup.return_value.discard.call_count)
+        mock_spool.return_value.fail.return_value = [1]
+        emailer._deliver([msg_info])
+        mock_dedup.return_value.discard.assert_called_once_with('k1')
+
+    def test_get_dedup_cache__not_configured(self):
+        """Verify no dedup cache when ttl is not configured."""
+        if 'GITHUB_COMMIT_EMAILER_DEDUP_TTL' in os.environ:
+            del os.environ['GITHUB_COMMIT_EMAILER_DEDUP_TTL']
+        self.assertIsNone(emailer._get_dedup_cache())
+
+    @mock.patch('emailer._dedup_cache', new=None)
+    def test_get_dedup_cache(self):
+        """Verify dedup cache is created once, in memory only by default."""
+        os.environ['GITHUB_COMMIT_EMAILER_DEDUP_TTL'] = '60'
+        try:
+            cache = emailer._get_dedup_cache()
+            self.assertIs(cache, emailer._get_dedup_cache())
+        finally:
+            del os.environ['GITHUB_COMMIT_EMAILER_DEDUP_TTL']
+        self.assertEqual(60, cache._local._ttl)
+        self.assertIsNone(cache._shared)
+
+    @mock.patch('emailer._get_secret_registry')
+    @mock.patch('emailer._send_email')
+    def test_push__signed(self, mock_send, mock_sec):
+        """Verify push with valid signature is sent."""
+        mock_sec.return_value = signatures.SecretRegistry(
+            [signatures.Key('TEST-secret')])
+        body = json.dumps(self.push_body())
+        h = hmac.new('TEST-secret', body, hashlib.sha1)
+        headers = dict(self.headers, **{
+            'x-hub-signature': 'sha1=' + h.hexdigest()})
+        r = self.app.post('/commit-email', headers=headers, data=body)
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(1, mock_send.call_count)
+
+    @mock.patch('emailer._get_secret_registry')
+    @mock.patch('emailer._send_email')
+    def test_push__signed_sha256(self, mock_send, mock_sec):
+        """Verify push signed with sha256 is sent, and its signature is
+        preferred over the sha1 one."""
+        mock_sec.return_value = signatures.SecretRegistry(
+            [signatures.Key('TEST-secret')])
+        body = json.dumps(self.push_body())
+        h = hmac.new('TEST-secret', body, hashlib.sha256)
+        headers = dict(self.headers, **{
+            'x-hub-signature': 'sha1=bogus',
+            'x-hub-signature-256': 'sha256=' + h.hexdigest()})
+        r = self.app.post('/commit-email', headers=headers, data=body)
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(1, mock_send.call_count)
+
+    @mock.patch('emailer._get_secret_registry')
+    @mock.patch('emailer._send_email')
+    def test_push__signed_per_repo(self, mock_send, mock_sec):
+        """Verify push is verified with the secret of its repo."""
+        mock_sec.return_value = signatures.SecretRegistry(
+            [signatures.Key('default')],
+            {'testing/test': [signatures.Key('TEST-secret')]})
+        body = json.dumps(self.push_body())
+        for secret, sends in (('default', 0), ('TEST-secret', 1)):
+            h = hmac.new(secret, body, hashlib.sha1)
+            headers = dict(self.headers, **{
+                'x-hub-signature': 'sha1=' + h.hexdigest()})
+            self.app.post('/commit-email', headers=headers, data=body)
+            self.assertEqual(sends, mock_send.call_count)
+
+    @mock.patch('emailer._get_secret_registry')
+    @mock.patch('emailer._send_email')
+    def test_push__signed_per_repo__other_repo(self, mock_send, mock_sec):
+        """Verify push signed with the secret of one repo is rejected if it
+        is parsed as a push for another repo."""
+        mock_sec.return_value = signatures.SecretRegistry(
+            [signatures.Key('default')],
+            {'TEST/attacker': [signatures.Key('attacker-secret')],
+             'testing/test': [signatures.Key('TEST-secret')]})
+        body = ('{"repository": {"full_name": "TEST/attacker"}, ' +
+                json.dumps(self.push_body())[1:])
+        h = hmac.new('attacker-secret', body, hashlib.sha1)
+        headers = dict(self.headers, **{
+            'x-hub-signature': 'sha1=' + h.hexdigest()})
+        r = self.app.post('/commit-email', headers=headers, data=body)
+        self.assertEqual(200, r.status_code)
+        self.assertEqual('nope', r.data)
+        self.assertEqual(0, mock_send.call_count)
+
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
+    @mock.patch('emailer._send_email')
+    def test_push__too_large(self, mock_send, mock_sec, mock_sig):
+        """Verify push over max body size is rejected."""
+        mock_sec.return_value = self.registry
+        os.environ['GITHUB_COMMIT_EMAILER_MAX_BODY_SIZE'] = '100'
+        try:
+            r = self.app.post('/commit-email',
+                              headers=self.headers,
+                              data=json.dumps(self.push_body()))
+        finally:
+            del os.environ['GITHUB_COMMIT_EMAILER_MAX_BODY_SIZE']
+        self.assertEqual(413, r.status_code)
+        self.assertEqual(0, mock_sig.call_count)
+        self.assertEqual(0, mock_send.call_count)
+
+    @mock.patch('emailer._signature_matches')
+    @mock.patch('emailer._get_secret_registry')
+    @mock.patch('emailer._send_email')
+    def test_push__malformed(self, mock_send, mock_sec, mock_sig):
+        """Verify push with body that is not a push event is rejected."""
+        mock_sec.return_value = self.registry
+        mock_sig.return_value = True
+        for data in ('not json', json.dumps({'deleted': False}), '[]'):
+            r = self.app.post('/commit-email', headers=self.headers,
+                              data=data)
+            self.assertEqual(400, r.status_code)
+        self.assertEqual(0, mock_send.call_count)
+
+    def push_body(self):
+        """Returns minimal github push event body."""
+        return {
+            'ref': 'the/master',
+            'deleted': False,
+            'compare': 'http://the-url.it',
+            'repository': {'full_name': 'testing/test'},
+            'pusher': {'name': 'the-tester', 'email': 'the@example.com'},
+            'head_commit': {
+                'id': 'some-sha1',
+                'message': 'A lovely\n\ncommit message.',
+                'added': [],
+                'removed': ['a.out', 'gen'],
+                'modified': ['README.md', 'README', 'LICENSE'],
+            },
+        }
+
+    @mock.patch('emailer._get_secret_registry')
+    @mock.patch('emailer._send_email')
+    def test_push__commits(self, mock_send, mock_sec):
+        """Verify the newest commits of the push, up to max commits, are in
+        the email when max commits is configured."""
+        mock_sec.return_value = signatures.SecretRegistry([])
+        body = self.push_body()
+        body['commits'] = [
+            {'id': 'first-sha1', 'message': 'First\n', 'added': ['new'],
+             'removed': [], 'modified': ['README'],
+             'author': {'name': 'one'}},
+            dict(body['head_commit'], author={'name': 'two'}),
+            {'id': 'third-sha1', 'message': 'Third', 'added': ['head.txt'],
+             'removed': [], 'modified': [], 'author': {'name': 'three'}},
+        ]
+        body['head_commit']['id'] = 'third-sha1'
+        os.environ['GITHUB_COMMIT_EMAILER_MAX_COMMITS'] = '2'
+        try:
+            with mock.patch('emailer._signature_matches', return_value=True):
+                self.app.post('/commit-email', headers=self.headers,
+                              data=json.dumps(body))
+        finally:
+            del os.environ['GITHUB_COMMIT_EMAILER_MAX_COMMITS']
+        msg_info = mock_send.call_args[0][0]
+        self.assertEqual('third-s', msg_info['revision'])
+        self.assertEqual(u'\u2026 1 earlier commits not shown\n\n'
+                         u'some-sh by two:\n\nA lovely\n\ncommit message.'
+                         u'\n\nthird-s by three:\n\nThird',
+                         msg_info['message'])
+        self.assertEqual('[testing/test] commit message.',
+                         msg_info['subject'])
+        self.assertEqual('A head.txt\nR a.out\nR gen\nM README.md\nM README\n'
+                         'M LICENSE', msg_info['changed_files'])
+
+    @mock.patch('emailer._get_mirrors')
+    def test_get_msg_info__diffstat(self, mock_mirrors):
+        """Verify line counts from the mirror are shown."""
+        mock_mirrors.return_value.diffstat.return_value = {
+            'README': (1, 2)}
+        body = self.push_body()
+        body['commits'] = []
+        msg_info = emailer._get_msg_info(body)
+        self.assertIn('M README (+1 -2)\n', msg_info['changed_files'])
+        self.assertNotIn('subject', msg_info)
+        mock_mirrors.return_value.diffstat.assert_called_once_with(
+            'testing/test', ['some-sha1'], budget=2)
+
+    @mock.patch('emailer._mirrors', new=None)
+    def test_get_mirrors(self):
+        """Verify mirrors are only used when configured."""
+        self.assertIsNone(emailer._get_mirrors())
+        os.environ['GITHUB_COMMIT_EMAILER_MIRROR_DIR'] = '/TEST/mirrors'
+        try:
+            # Settings are read once, until reloaded.
+            self.assertIsNone(emailer._get_mirrors())
+            emailer._reload_config(signal.SIGHUP, None)
+            mirrors = emailer._get_mirrors()
+            self.assertIs(mirrors, emailer._get_mirrors())
+        finally:
+            del os.environ['GITHUB_COMMIT_EMAILER_MIRROR_DIR']
+        self.assertEqual('/TEST/mirrors', mirrors._root)
+
     def test_send_email__no_sender(self):
         """Verify ValueError when sender is not configured."""
         if 'GITHUB_COMMIT_EMAILER_SENDER' in os.environ:
@@ -205,14 +1120,14 @@ class EmailerTests(unittest.TestCase):
 
     def check_msg(self, actual_msg):
         """Verify recipient and sender on sent message."""
-        self.assertEqual([self.recipient], actual_msg.to_addr)
+        self.assertEqual([self.recipient], actual_msg.to_addrs)
         self.assertEqual(self.sender, actual_msg.from_addr)
         self.assertEqual(
             self.send_grid_header, actual_msg.headers.get('X-SMTPAPI'))
         self.assertEqual(
-            '[TESTING/test] TEST commit message.', actual_msg._subject)
+            '[TESTING/test] TEST commit message.', actual_msg.subject)
 
-    @mock.patch('envelopes.connstack.get_current_connection')
+    @mock.patch('emailer._get_smtp_pool')
     def test_send_email__no_reply_to(self, mock_send):
         """Verify email is sent as expected when reply-to is not configured."""
         self.prep_env()
@@ -225,7 +1140,7 @@ class EmailerTests(unittest.TestCase):
         self.check_msg(actual_msg)
         self.assertEqual(None, actual_msg.headers.get('Reply-To'))
 
-    @mock.patch('envelopes.connstack.get_current_connection')
+    @mock.patch('emailer._get_smtp_pool')
     def test_send_email__reply_to(self, mock_send):
         """Verify email is sent as expected when reply-to is configured."""
         self.prep_env()
@@ -237,7 +1152,7 @@ class EmailerTests(unittest.TestCase):
         self.check_msg(actual_msg)
         self.assertEqual(self.reply_to, actual_msg.headers.get('Reply-To'))
 
-    @mock.patch('envelopes.connstack.get_current_connection')
+    @mock.patch('emailer._get_smtp_pool')
     def test_send_email__approved(self, mock_send):
         """Verify approved header is added when config is set."""
         self.prep_env()
@@ -249,7 +1164,7 @@ class EmailerTests(unittest.TestCase):
         self.check_msg(actual_msg)
         self.assertEqual('my-super-secret', actual_msg.headers.get('Approved'))
 
-    @mock.patch('envelopes.connstack.get_current_connection')
+    @mock.patch('emailer._get_smtp_pool')
     def test_send_email__no_approved(self, mock_send):
         """Verify approved header is not added when config is not set."""
         self.prep_env()
@@ -262,73 +1177,275 @@ class EmailerTests(unittest.TestCase):
         self.check_msg(actual_msg)
         self.assertEqual(None, actual_msg.headers.get('Approved'))
 
-    def test_get_sender__from_author(self):
-        """Verify sent from author when appropriate config var set."""
-        os.environ['GITHUB_COMMIT_EMAILER_SEND_FROM_AUTHOR'] = 'whatevs'
-        actual = emailer._get_sender('my-address')
-        self.assertEqual('my-address', actual)
-
-    def test_get_sender__from_noreply(self):
-        """Verify sent from config'd sender when appropriate config var
-        not set.
-        """
-        if 'GITHUB_COMMIT_EMAILER_SEND_FROM_AUTHOR' in os.environ:
-            del os.environ['GITHUB_COMMIT_EMAILER_SEND_FROM_AUTHOR']
-        os.environ['GITHUB_COMMIT_EMAILER_SENDER'] = 'noreply-addr'
-        actual = emailer._get_sender('my-address')
-        self.assertEqual('noreply-addr', actual)
-
-    def test_get_subject(self):
-        """Verify get_subject returns first line of commit message and
-        repo name.
-        """
-        expected = '[TEST/it] this is a message'
-        actual = emailer._get_subject('TEST/it', 'this is a message')
-        self.assertEqual(expected, actual)
-
-    def test_get_subject__msg_greater_than_50(self):
-        """Verify subject when commit message line has more than 50 chars."""
-        repo = 'TEST/realllllllllllllllyyyyyyyyyyy-loooooooooooooong'
-        msg = 'this is really long {0}'.format('.' * 100)
-        assert len(msg) > 50
-        expected = '[{0}] {1}'.format(repo, msg[:50])
-        actual = emailer._get_subject(repo, msg)
-        self.assertEqual(expected, actual)
-
-    def test_get_subject__third_line(self):
-        """Verify subject when commit message has three lines."""
-        msg = ('merge pull request #blah\n\n'
-               'my real message\n\n'
-               'with lots of info\n')
-        expected = '[TEST/it] my real message'
-        actual = emailer._get_subject('TEST/it', msg)
-        self.assertEqual(expected, actual)
-
-    def test_valid_signature__true__str(self):
-        """Verify _valid_signature returns true when signature matches."""
-        body = '{"rock": "on"}'
-        secret = str(uuid.uuid4())
-        h = hmac.new(secret, body, sha)
-        sig = 'sha1=' + h.hexdigest()
-        gh_sig = sig
-        self.assertTrue(emailer._valid_signature(gh_sig, body, secret))
-
-    def test_valid_signature__true__unicode(self):
-        """Verify _valid_signature returns true when signature matches, even if github
-        signature is unicode."""
+    def counter(self, name, **labels):
+        """Returns value of counter in emailer metrics."""
+        for n, lbl, value in emailer._get_metrics().snapshot()['counters']:
+            if n == name and lbl == labels:
+                return value
+        return 0
+
+    def test_metrics(self):
+        """Verify /metrics shows counts of received and skipped events, with
+        unknown event types counted as other, and request times."""
+        self.app.post('/commit-email', headers={'x-github-event': 'issues'})
+        self.app.post('/commit-email', headers={'x-github-event': 'made-up'})
+        self.app.get('/')
+        r = self.app.get('/metrics')
+        self.assertEqual(200, r.status_code)
+        self.assertTrue(r.content_type.startswith('text/plain; version=0.0.4'))
+        lines = r.data.splitlines()
+        self.assertIn(
+            'github_email_events_received_total{event="issues"} 1', lines)
+        self.assertIn(
+            'github_email_events_received_total{event="other"} 1', lines)
+        self.assertIn(
+            'github_email_events_skipped_total{reason="not_push"} 2', lines)
+        self.assertIn('github_email_request_seconds_count'
+                      '{endpoint="index",status="301"} 1', lines)
+
+    @mock.patch('emailer._get_secret_registry')
+    @mock.patch('emailer._send_email')
+    def test_push__metrics(self, mock_send, mock_sec):
+        """Verify bad signatures are counted, and stages of accepted pushes
+        are timed."""
+        mock_sec.return_value = self.registry
+        body = json.dumps(self.push_body())
+        self.app.post('/commit-email', headers=self.headers, data=body)
+        self.assertEqual(1, self.counter('github_email_events_skipped_total',
+                                         reason='bad_signature'))
+
+        h = hmac.new('adsf', body, hashlib.sha1)
+        headers = dict(self.headers, **{
+            'x-hub-signature': 'sha1=' + h.hexdigest()})
+        self.app.post('/commit-email', headers=headers, data=body)
+        stages = set(lbl['stage'] for n, lbl, _, _ in
+                     emailer._get_metrics().snapshot()['histograms']
+                     if n == emailer.STAGE_SECONDS)
+        self.assertEqual(set(['read_body', 'verify_signature', 'parse',
+                              'summarize', 'dispatch']), stages)
+
+    @mock.patch('emailer._get_smtp_pool')
+    def test_send_email__metrics(self, mock_pool):
+        """Verify sent and failed emails are counted."""
+        self.prep_env()
+        emailer._send_email(self.msg_info)
+        mock_pool.return_value.send.side_effect = ValueError('boom')
+        self.assertRaises(ValueError, emailer._send_email, self.msg_info)
+        self.assertEqual(1, self.counter('github_email_emails_sent_total'))
+        self.assertEqual(1, self.counter('github_email_emails_failed_total'))
+
+    @mock.patch('emailer._get_smtp_pool')
+    def test_send_email__delivery_id(self, mock_pool):
+        """Verify email is sent with the delivery id in the log context."""
+        self.prep_env()
+        contexts = []
+        mock_pool.return_value.send.side_effect = lambda msg: contexts.append(
+            logs.current_context())
+        emailer._send_email(dict(self.msg_info, delivery_id='TEST-id'))
+        self.assertEqual([{'delivery_id': 'TEST-id'}], contexts)
+
+    @mock.patch('emailer._metrics', new=None)
+    def test_get_metrics(self):
+        """Verify metrics snapshots are written to the configured dir."""
+        os.environ['GITHUB_COMMIT_EMAILER_METRICS_DIR'] = '/TEST/metrics'
+        try:
+            with mock.patch('atexit.register') as mock_atexit:
+                m = emailer._get_metrics()
+        finally:
+            del os.environ['GITHUB_COMMIT_EMAILER_METRICS_DIR']
+        self.assertEqual('/TEST/metrics', m._snapshot_dir)
+        self.assertIs(m, emailer._get_metrics())
+        mock_atexit.assert_called_once_with(m.stop)
+
+    def test_reload_config(self):
+        """Verify renderer and secrets pick up config changes after
+        SIGHUP."""
+        self.prep_env()
+        os.environ['GITHUB_COMMIT_EMAILER_SECRET'] = 'TEST-secret'
+        renderer = emailer._get_renderer()
+        registry = emailer._get_secret_registry()
+        self.assertIs(renderer, emailer._get_renderer())
+        self.assertIs(registry, emailer._get_secret_registry())
+        config = emailer._get_settings()
+        emailer._reload_config(signal.SIGHUP, None)
+        self.assertIsNot(renderer, emailer._get_renderer())
+        self.assertIsNot(registry, emailer._get_secret_registry())
+        self.assertIsNot(config, emailer._get_settings())
+
+    @mock.patch('emailer._secret_registry', new=None)
+    @mock.patch('emailer._renderer', new=None)
+    @mock.patch('emailer._settings', new=None)
+    def test_preload(self):
+        """Verify config is parsed and templates compiled by preload."""
+        self.prep_env()
+        os.environ['GITHUB_COMMIT_EMAILER_SECRET'] = 'TEST-secret'
+        with mock.patch('rendering.Renderer.preload') as mock_preload:
+            emailer.preload()
+        mock_preload.assert_called_once_with()
+        self.assertIsNotNone(emailer._settings)
+        self.assertIsNotNone(emailer._renderer)
+        self.assertIsNotNone(emailer._secret_registry)
+
+    @mock.patch('emailer._secret_registry', new=None)
+    @mock.patch('emailer._renderer', new=None)
+    @mock.patch('emailer._settings', new=None)
+    def test_reload(self):
+        """Verify reload parses config again, for workers forked after it."""
+        self.prep_env()
+        os.environ['GITHUB_COMMIT_EMAILER_SECRET'] = 'TEST-secret'
+        emailer.preload()
+        settings = emailer._settings
+        renderer = emailer._renderer
+        os.environ['GITHUB_COMMIT_EMAILER_SECRET'] = 'TEST-new-secret'
+        emailer.reload()
+        self.assertIsNotNone(emailer._settings)
+        self.assertIsNot(settings, emailer._settings)
+        self.assertIsNot(renderer, emailer._renderer)
+        self.assertIsNotNone(emailer._secret_registry)
+
+    @mock.patch('emailer._secret_registry', new=None)
+    def test_preload__no_secret(self):
+        """Verify preload succeeds without secret, leaving the error for
+        web hooks."""
+        if 'GITHUB_COMMIT_EMAILER_SECRET' in os.environ:
+            del os.environ['GITHUB_COMMIT_EMAILER_SECRET']
+        emailer.preload()
+        self.assertIsNone(emailer._secret_registry)
+
+    @mock.patch('emailer._get_work_queue')
+    @mock.patch('emailer._get_spool')
+    @mock.patch('emailer._get_delivery_queue')
+    @mock.patch('emailer._get_smtp_pool')
+    @mock.patch('emailer._log_handler')
+    @mock.patch('signal.signal')
+    def test_init_worker(self, mock_signal, mock_log_handler, mock_pool,
+                         mock_queue, mock_spool, mock_work_queue):
+        """Verify per-worker resources are set up by init_worker."""
+        emailer.init_worker()
+        mock_work_queue.assert_called_once_with()
+        mock_signal.assert_called_once_with(signal.SIGHUP,
+                                            emailer._reload_config)
+        mock_log_handler.start.assert_called_once_with()
+        mock_pool.return_value.warm.assert_called_once_with()
+        mock_queue.assert_called_once_with()
+        mock_spool.assert_called_once_with()
+
+    def test_signature_matches(self):
+        """Verify _signature_matches returns true when any hmac matches."""
         body = '{"rock": "on"}'
         secret = str(uuid.uuid4())
-        h = hmac.new(secret, body, sha)
-        sig = 'sha1=' + h.hexdigest()
-        gh_sig = unicode(sig)
-        self.assertTrue(emailer._valid_signature(gh_sig, body, secret))
-
-    def test_valid_signature__false(self):
-        """Verify _valid_signature returns False when signature does
-        not match."""
-        self.assertFalse(
-            emailer._valid_signature(str(unicode('adsf')), 'asdf', 'my-secret')
-        )
+        h = hmac.new(secret, body, hashlib.sha1)
+        sig = signatures.Signature('sha1', h.hexdigest())
+        other = hmac.new('other', body, hashlib.sha1)
+        self.assertTrue(emailer._signature_matches(sig, [other, h]))
+
+    def test_signature_matches__false(self):
+        """Verify _signature_matches returns False when signature does
+        not match, or is missing."""
+        h = hmac.new('my-secret', 'asdf', hashlib.sha1)
+        sig = signatures.Signature('sha1', 'adsf')
+        self.assertFalse(emailer._signature_matches(sig, [h]))
+        self.assertFalse(emailer._signature_matches(sig, []))
+        self.assertFalse(emailer._signature_matches(None, [h]))
+
+
+class _SMTPConnection(object):
+    """Fake smtplib connection that records the thread that sent each
+    message, and whether it was ever used by two threads at once."""
+
+    def __init__(self, sent, overlaps):
+        self._sent = sent
+        self._overlaps = overlaps
+        self._lock = threading.Lock()
+
+    def sendmail(self, from_addr, to_addrs, data):
+        if not self._lock.acquire(False):
+            self._overlaps.append(threading.current_thread().name)
+            return
+        try:
+            # Give other requests time to pick the same connection.
+            time.sleep(0.001)
+            self._sent.append((id(self), threading.current_thread().name,
+                               data))
+        finally:
+            self._lock.release()
+
+
+@mock.patch('logging.info', new=mock.Mock())
+class ConcurrentRequestsTests(unittest.TestCase):
+
+    def setUp(self):
+        """Setup app that sends email while handling each web hook, like
+        under gunicorn's gthread worker, on a pool of fake connections."""
+        super(ConcurrentRequestsTests, self).setUp()
+        emailer.app.config['TESTING'] = True
+        self.sent = []
+        self.overlaps = []
+        self.pool = smtp_pool.SMTPPool(self.factory, max_size=4,
+                                       checkout_timeout=30)
+        env = mock.patch.dict(os.environ, {
+            'GITHUB_COMMIT_EMAILER_SENDER': 'noreply@fake.fake',
+            'GITHUB_COMMIT_EMAILER_RECIPIENT': 'recip@fake.fake',
+        })
+        for patcher in [
+                env,
+                mock.patch('emailer._smtp_pool', new=self.pool),
+                mock.patch('emailer._renderer', new=None),
+                mock.patch('emailer._settings', new=None),
+                mock.patch('emailer._metrics', new=None),
+                mock.patch('emailer._signature_matches',
+                           new=mock.Mock(return_value=True)),
+                mock.patch('emailer._get_secret_registry',
+                           new=mock.Mock(return_value=signatures.
+                                         SecretRegistry([])))]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def factory(self):
+        smtp = mock.Mock()
+        smtp.is_connected = True
+        smtp._conn = _SMTPConnection(self.sent, self.overlaps)
+        return smtp
+
+    def push(self, n):
+        """Post push whose email names `n`, from a thread named after n."""
+        body = json.dumps({
+            'ref': 'refs/heads/master',
+            'deleted': False,
+            'compare': 'http://the-url.it',
+            'repository': {'full_name': 'testing/test'},
+            'pusher': {'name': 'the-tester', 'email': 'the@example.com'},
+            'head_commit': {
+                'id': '{0:040x}'.format(n),
+                'message': 'Push {0}\n\nPush {0} body'.format(n),
+                'added': [], 'removed': [], 'modified': ['README'],
+            },
+        })
+        r = emailer.app.test_client().post(
+            '/commit-email', data=body, headers={
+                'x-github-event': 'push',
+                'x-github-delivery': 'delivery-{0}'.format(n),
+                'content-type': 'application/json'})
+        self.assertEqual(200, r.status_code)
+
+    def test_concurrent_requests(self):
+        """Verify 128 concurrent requests each send their own email, once,
+        on a connection no other request uses at the same time."""
+        threads = [threading.Thread(target=self.push, args=(n,),
+                                    name='request-{0}'.format(n))
+                   for n in range(128)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(30)
+
+        self.assertEqual([], self.overlaps)
+        self.assertEqual(128, len(self.sent))
+        for _, thread_name, data in self.sent:
+            n = thread_name.split('-')[1]
+            self.assertIn('Push {0} body'.format(n), data)
+        self.assertEqual(4, len(set(conn for conn, _, _ in self.sent)))
+        self.assertEqual(0, self.pool.stats()['checked_out'])
 
 
 if __name__ == '__main__':
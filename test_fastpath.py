@@ -0,0 +1,69 @@
+import mock
+import unittest
+
+import werkzeug.test
+import werkzeug.wrappers
+
+import fastpath
+
+
+class FastPathTests(unittest.TestCase):
+
+    def setUp(self):
+        """Setup fast path in front of a mock app."""
+        super(FastPathTests, self).setUp()
+        self.app = mock.Mock()
+        self.app.side_effect = werkzeug.wrappers.Response('app')
+        self.on_reject = mock.Mock()
+        self.client = werkzeug.test.Client(
+            fastpath.FastPath(self.app, ['/', '/commit-email'],
+                              '/commit-email', events=['push', 'ping'],
+                              max_body_size=lambda: 10,
+                              on_reject=self.on_reject),
+            werkzeug.wrappers.Response)
+
+    def post(self, event=None, data=''):
+        headers = {}
+        if event is not None:
+            headers['x-github-event'] = event
+        return self.client.post('/commit-email', headers=headers, data=data)
+
+    def test_ignored_event(self):
+        """Verify events not allowed are answered without the app."""
+        r = self.post('issues', data='x' * 100)
+        self.assertEqual(200, r.status_code)
+        self.assertEqual('nope', r.data)
+        self.assertEqual(0, self.app.call_count)
+        self.on_reject.assert_called_once_with('issues', 'not_push')
+
+    def test_allowed_event(self):
+        """Verify allowed events go to the app."""
+        self.assertEqual('app', self.post('ping').data)
+        self.assertEqual('app', self.post('push', data='x' * 10).data)
+        self.assertEqual(0, self.on_reject.call_count)
+
+    def test_no_event(self):
+        """Verify requests without event header go to the app."""
+        self.assertEqual('app', self.post().data)
+
+    def test_too_large(self):
+        """Verify bodies over the max size are rejected by content length."""
+        r = self.post('push', data='x' * 11)
+        self.assertEqual(413, r.status_code)
+        self.assertEqual(0, self.app.call_count)
+        self.on_reject.assert_called_once_with('push', 'too_large')
+
+    def test_not_found(self):
+        """Verify unknown paths get 404 without the app."""
+        r = self.client.get('/wp-login.php')
+        self.assertEqual(404, r.status_code)
+        self.assertEqual(0, self.app.call_count)
+
+    def test_other_requests(self):
+        """Verify other requests to known paths go to the app."""
+        self.assertEqual('app', self.client.get('/').data)
+        self.assertEqual('app', self.client.get('/commit-email').data)
+
+
+if __name__ == '__main__':
+    unittest.main()
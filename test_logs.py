@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import mock
+import StringIO
+import sys
+import threading
+import unittest
+
+import logs
+
+
+def make_record(msg, *args, **kwargs):
+    """Returns log record like logging.info(msg, *args) would create."""
+    return logging.makeLogRecord(dict(
+        dict(name='root', levelno=logging.INFO, levelname='INFO', msg=msg,
+             args=args),
+        **kwargs))
+
+
+class ContextTests(unittest.TestCase):
+
+    def test_context(self):
+        """Verify fields are nested, restored and None fields left out."""
+        self.assertEqual({}, logs.current_context())
+        with logs.context(delivery_id='d1', repo=None):
+            self.assertEqual({'delivery_id': 'd1'}, logs.current_context())
+            with logs.context(repo='org/repo'):
+                self.assertEqual({'delivery_id': 'd1', 'repo': 'org/repo'},
+                                 logs.current_context())
+            self.assertEqual({'delivery_id': 'd1'}, logs.current_context())
+        self.assertEqual({}, logs.current_context())
+
+    def test_context__per_thread(self):
+        """Verify fields are not seen by other threads."""
+        seen = []
+        with logs.context(delivery_id='d1'):
+            t = threading.Thread(
+                target=lambda: seen.append(logs.current_context()))
+            t.start()
+            t.join()
+        self.assertEqual([{}], seen)
+
+
+class RedactorTests(unittest.TestCase):
+
+    def test_text(self):
+        """Verify email addresses are masked, keeping the domain."""
+        redactor = logs.Redactor()
+        self.assertEqual(
+            'To: ***@example.com, ***@lists.example.org ok',
+            redactor.text('To: bot@example.com, a.b+c@lists.example.org ok'))
+        self.assertEqual('1', redactor.text(1))
+
+    def test_text__not_redacted(self):
+        """Verify email addresses are kept if emails are not redacted."""
+        self.assertEqual('bot@example.com',
+                         logs.Redactor(redact=[]).text('bot@example.com'))
+
+    def test_text__max_length(self):
+        """Verify long text is capped."""
+        self.assertEqual(u'xxxx… (1,996 more characters)',
+                         logs.Redactor(max_length=4).text('x' * 2000))
+
+    def test_fields(self):
+        """Verify redacted fields are replaced and the rest masked."""
+        self.assertEqual(
+            {'pusher_email': '[redacted]', 'count': 3, 'ok': None,
+             'pusher': '***@example.com'},
+            logs.Redactor().fields(
+                {'pusher_email': 'bot@example.com', 'count': 3, 'ok': None,
+                 'pusher': 'bot@example.com'}))
+
+
+class FormatterTests(unittest.TestCase):
+
+    def test_text_formatter(self):
+        """Verify basicConfig format with context fields and traceback."""
+        formatter = logs.TextFormatter(logs.Redactor())
+        record = make_record('Sending email to %s.', 'bot@example.com',
+                             context={'delivery_id': 'd1'},
+                             exc_text='Traceback...')
+        self.assertEqual(
+            'INFO:root:Sending email to ***@example.com. delivery_id=d1\n'
+            'Traceback...',
+            formatter.format(record))
+
+    def test_json_formatter(self):
+        """Verify records are formatted as JSON with redacted fields."""
+        formatter = logs.JSONFormatter(logs.Redactor())
+        record = make_record(
+            'Push of %s.', 'abcdef0', created=0,
+            context={'delivery_id': 'd1'},
+            fields={'repo': 'org/repo', 'to_addrs': 'a@example.com'})
+        data = json.loads(formatter.format(record))
+        self.assertEqual('1970-01-01T00:00:00Z', data['time'])
+        self.assertEqual('INFO', data['level'])
+        self.assertEqual('root', data['logger'])
+        self.assertEqual('Push of abcdef0.', data['message'])
+        self.assertEqual('d1', data['delivery_id'])
+        self.assertEqual('org/repo', data['repo'])
+        self.assertEqual('[redacted]', data['to_addrs'])
+        self.assertNotIn('exc', data)
+
+
+class SamplingFilterTests(unittest.TestCase):
+
+    @mock.patch('random.random')
+    def test_filter(self, mock_random):
+        """Verify only a fraction of debug records are kept."""
+        mock_random.side_effect = [0.2, 0.8]
+        sample = logs.SamplingFilter(0.5)
+        debug = make_record('x', levelno=logging.DEBUG)
+        self.assertTrue(sample.filter(debug))
+        self.assertFalse(sample.filter(debug))
+        self.assertTrue(sample.filter(make_record('x')))
+        self.assertEqual(2, mock_random.call_count)
+
+
+class QueueHandlerTests(unittest.TestCase):
+
+    def setUp(self):
+        """Setup queue handler in front of a mock handler."""
+        super(QueueHandlerTests, self).setUp()
+        self.target = mock.Mock()
+        self.target.handle.side_effect = self.handle
+        self.handled = []
+        self.handler = logs.QueueHandler(self.target)
+
+    def handle(self, record):
+        self.handled.append((record, threading.current_thread()))
+
+    def test_emit(self):
+        """Verify records are written by the writer thread, with the context
+        of the thread that logged them."""
+        with logs.context(delivery_id='d1'):
+            self.handler.emit(make_record('one'))
+        self.handler.emit(make_record('two'))
+        self.handler.close()
+        self.assertEqual(['one', 'two'],
+                         [r.getMessage() for r, _ in self.handled])
+        self.assertEqual([{'delivery_id': 'd1'}, {}],
+                         [r.context for r, _ in self.handled])
+        self.assertNotIn(threading.current_thread(),
+                         [t for _, t in self.handled])
+        self.target.close.assert_called_once_with()
+
+    def test_emit__exception(self):
+        """Verify tracebacks are formatted by the thread that logged them."""
+        try:
+            raise ValueError('bad')
+        except ValueError:
+            record = make_record('failed')
+            record.exc_info = sys.exc_info()
+        self.handler.emit(record)
+        self.handler.close()
+        self.assertIsNone(record.exc_info)
+        self.assertIn('ValueError: bad', record.exc_text)
+
+    def test_emit__full(self):
+        """Verify records are dropped and counted when the queue is full."""
+        started = threading.Event()
+        blocked = threading.Event()
+        written = []
+
+        def handle(record):
+            written.append(record.getMessage())
+            started.set()
+            blocked.wait()
+        self.target.handle.side_effect = handle
+        handler = logs.QueueHandler(self.target, max_size=1)
+        self.addCleanup(blocked.set)
+        handler.emit(make_record('first'))
+        started.wait()
+        handler.emit(make_record('second'))
+        handler.emit(make_record('third'))
+        self.assertEqual(1, handler.dropped)
+        blocked.set()
+        handler.close()
+        self.assertEqual(
+            ['first', 'second', 'Dropped 1 log records, queue was full.'],
+            written)
+
+    @mock.patch('os.getpid')
+    def test_emit__forked(self, mock_getpid):
+        """Verify a new writer thread is started in a forked process."""
+        mock_getpid.return_value = 1
+        self.handler.emit(make_record('parent'))
+        parent_thread = self.handler._thread
+        parent_queue = self.handler._queue
+        mock_getpid.return_value = 2
+        self.handler.emit(make_record('child'))
+        self.assertIsNot(parent_thread, self.handler._thread)
+        self.handler.close()
+        parent_queue.put(None)
+        parent_thread.join()
+        self.assertEqual(2, self.target.handle.call_count)
+
+
+class ConfigureTests(unittest.TestCase):
+
+    def setUp(self):
+        """Setup root logger without handlers."""
+        super(ConfigureTests, self).setUp()
+        root = logging.getLogger()
+        patcher = mock.patch.object(root, 'handlers', [])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(root.setLevel, root.level)
+
+    def test_configure(self):
+        """Verify JSON logging is configured from environment."""
+        stream = StringIO.StringIO()
+        handler = logs.configure({
+            'GITHUB_COMMIT_EMAILER_LOG_FORMAT': 'json',
+            'GITHUB_COMMIT_EMAILER_LOG_LEVEL': 'WARNING',
+            'GITHUB_COMMIT_EMAILER_LOG_REDACT': 'repo',
+        }, stream=stream)
+        self.assertEqual([handler], logging.getLogger().handlers)
+        self.assertEqual(logging.WARNING, logging.getLogger().level)
+        logging.warn('Push to %s by a@example.com', 'org/repo',
+                     extra={'fields': {'repo': 'org/repo'}})
+        handler.close()
+        data = json.loads(stream.getvalue())
+        self.assertEqual('Push to org/repo by a@example.com',
+                         data['message'])
+        self.assertEqual('[redacted]', data['repo'])
+
+    def test_configure__text(self):
+        """Verify text logging with redacted emails is the default."""
+        stream = StringIO.StringIO()
+        handler = logs.configure({}, stream=stream)
+        self.assertEqual(logging.INFO, logging.getLogger().level)
+        logging.info('Sending email to a@example.com')
+        handler.close()
+        self.assertEqual('INFO:root:Sending email to ***@example.com\n',
+                         stream.getvalue())
+
+    def test_configure__has_handlers(self):
+        """Verify nothing is done if the root logger has handlers."""
+        existing = mock.Mock()
+        logging.getLogger().handlers.append(existing)
+        self.assertIsNone(logs.configure({}))
+        self.assertEqual([existing], logging.getLogger().handlers)
+
+
+if __name__ == '__main__':
+    unittest.main()
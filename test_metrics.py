@@ -0,0 +1,186 @@
+import errno
+import json
+import mock
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import metrics
+
+
+class MetricsTests(unittest.TestCase):
+
+    def setUp(self):
+        """Setup metrics with a snapshot directory."""
+        super(MetricsTests, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.metrics = metrics.Metrics(self.tmp_dir, interval=60)
+
+    def tearDown(self):
+        self.metrics.stop()
+        shutil.rmtree(self.tmp_dir)
+        super(MetricsTests, self).tearDown()
+
+    def test_inc(self):
+        """Verify counters are kept per name and labels."""
+        self.metrics.inc('a_total', event='push')
+        self.metrics.inc('a_total', 2, event='push')
+        self.metrics.inc('a_total', event='issues')
+        self.assertEqual(
+            sorted([['a_total', {'event': 'push'}, 3],
+                    ['a_total', {'event': 'issues'}, 1]]),
+            sorted(self.metrics.snapshot()['counters']))
+
+    def test_observe(self):
+        """Verify durations are counted in the first bucket they fit."""
+        self.metrics.observe('t_seconds', 0.001)
+        self.metrics.observe('t_seconds', 0.002)
+        self.metrics.observe('t_seconds', 100)
+        [[name, labels, buckets, total]] = \
+            self.metrics.snapshot()['histograms']
+        self.assertEqual(1, buckets[0])
+        self.assertEqual(1, buckets[1])
+        self.assertEqual(1, buckets[-1])
+        self.assertEqual(3, sum(buckets))
+        self.assertAlmostEqual(100.003, total)
+
+    @mock.patch('time.time')
+    def test_timer(self, mock_time):
+        """Verify timer records time spent, even on errors."""
+        mock_time.side_effect = [10, 10.2]
+        with self.assertRaises(ValueError):
+            with self.metrics.timer('t_seconds', stage='x'):
+                raise ValueError('boom')
+        [[name, labels, buckets, total]] = \
+            self.metrics.snapshot()['histograms']
+        self.assertEqual({'stage': 'x'}, labels)
+        self.assertAlmostEqual(0.2, total)
+
+    @mock.patch('metrics._alive', new=mock.Mock(return_value=True))
+    def test_collect(self):
+        """Verify snapshots of other processes are added up."""
+        self.metrics.inc('a_total')
+        self.metrics.observe('t_seconds', 0.3)
+        other = self.metrics.snapshot()
+        with open(os.path.join(self.tmp_dir, '1-a.json'), 'w') as f:
+            json.dump(other, f)
+        with open(os.path.join(self.tmp_dir, '2-b.json'), 'w') as f:
+            f.write('{not json')
+        # Own snapshot file is ignored in favor of the live metrics.
+        self.metrics.write_snapshot()
+        self.metrics.inc('a_total')
+
+        with mock.patch('logging.warn') as mock_warn:
+            collected = self.metrics.collect()
+        self.assertEqual(1, mock_warn.call_count)
+        self.assertEqual([['a_total', {}, 3]], collected['counters'])
+        [[name, labels, buckets, total]] = collected['histograms']
+        self.assertEqual(2, sum(buckets))
+        self.assertAlmostEqual(0.6, total)
+
+    def test_collect__exited(self):
+        """Verify snapshots of processes that have exited are added up into
+        one, which a new process with the same pid does not replace."""
+        self.metrics.inc('a_total')
+        other = self.metrics.snapshot()
+        for name in ('123-a.json', '124-b.json'):
+            with open(os.path.join(self.tmp_dir, name), 'w') as f:
+                json.dump(other, f)
+        self.metrics.write_snapshot()
+        with mock.patch('metrics._alive', side_effect=lambda pid: pid != 123):
+            self.assertEqual([['a_total', {}, 3]],
+                             self.metrics.collect()['counters'])
+            self.assertEqual(
+                sorted([metrics.EXITED, '124-b.json',
+                        os.path.basename(self.metrics._snapshot_path())]),
+                sorted(n for n in os.listdir(self.tmp_dir)
+                       if not n.startswith('.')))
+
+            with open(os.path.join(self.tmp_dir, '123-c.json'), 'w') as f:
+                json.dump(other, f)
+            self.assertEqual([['a_total', {}, 4]],
+                             self.metrics.collect()['counters'])
+        with mock.patch('metrics._alive', return_value=False):
+            self.assertEqual([['a_total', {}, 4]],
+                             self.metrics.collect()['counters'])
+        self.assertNotIn('124-b.json', os.listdir(self.tmp_dir))
+
+    def test_alive(self):
+        """Verify processes are alive until they have exited."""
+        self.assertTrue(metrics._alive(os.getpid()))
+        with mock.patch('os.kill', side_effect=OSError(errno.ESRCH, 'gone')):
+            self.assertFalse(metrics._alive(123))
+
+    def test_write_snapshot(self):
+        """Verify snapshot is written for this process."""
+        self.metrics.inc('a_total')
+        self.metrics.write_snapshot()
+        [name] = os.listdir(self.tmp_dir)
+        self.assertTrue(name.startswith('{0}-'.format(os.getpid())))
+        with open(os.path.join(self.tmp_dir, name)) as f:
+            self.assertEqual([['a_total', {}, 1]], json.load(f)['counters'])
+
+    def test_background_snapshots(self):
+        """Verify snapshots are written in the background once metrics are
+        recorded, and on stop."""
+        self.assertEqual(None, self.metrics._thread)
+        self.metrics.inc('a_total')
+        self.assertTrue(self.metrics._thread.is_alive())
+        self.metrics.stop()
+        self.assertFalse(self.metrics._thread.is_alive())
+        self.assertEqual(1, len(os.listdir(self.tmp_dir)))
+
+    def test_no_snapshot_dir(self):
+        """Verify nothing is written without a snapshot directory."""
+        m = metrics.Metrics()
+        m.inc('a_total')
+        self.assertEqual(None, m._thread)
+        m.write_snapshot()
+        self.assertEqual([['a_total', {}, 1]], m.collect()['counters'])
+
+
+class RenderTests(unittest.TestCase):
+
+    def test_quantile(self):
+        """Verify quantiles are interpolated within buckets."""
+        buckets = [0] * (len(metrics.BUCKETS) + 1)
+        self.assertEqual(None, metrics.quantile(0.5, buckets))
+        buckets[0] = 50
+        buckets[2] = 50
+        self.assertAlmostEqual(0.001, metrics.quantile(0.5, buckets))
+        self.assertAlmostEqual(0.00495, metrics.quantile(0.99, buckets))
+        buckets[-1] = 100
+        self.assertEqual(30.0, metrics.quantile(0.99, buckets))
+
+    def test_render(self):
+        """Verify Prometheus text format."""
+        m = metrics.Metrics()
+        m.inc('github_email_emails_sent_total')
+        m.inc('github_email_events_skipped_total', reason='bad "sig"')
+        m.observe('github_email_stage_seconds', 0.02, stage='parse')
+        text = metrics.render(m.collect())
+        lines = text.splitlines()
+        self.assertIn('# TYPE github_email_emails_sent_total counter', lines)
+        self.assertIn('github_email_emails_sent_total 1', lines)
+        self.assertIn('github_email_events_skipped_total'
+                      '{reason="bad \\"sig\\""} 1', lines)
+        self.assertIn('# TYPE github_email_stage_seconds histogram', lines)
+        self.assertIn('github_email_stage_seconds_bucket'
+                      '{le="0.01",stage="parse"} 0', lines)
+        self.assertIn('github_email_stage_seconds_bucket'
+                      '{le="0.025",stage="parse"} 1', lines)
+        self.assertIn('github_email_stage_seconds_bucket'
+                      '{le="+Inf",stage="parse"} 1', lines)
+        self.assertIn('github_email_stage_seconds_count{stage="parse"} 1',
+                      lines)
+        self.assertIn('github_email_stage_seconds_sum{stage="parse"} 0.02',
+                      lines)
+        self.assertIn('github_email_stage_seconds_quantile'
+                      '{quantile="0.5",stage="parse"} 0.0175', lines)
+        self.assertTrue(text.endswith('\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import mock
+import thread
+import unittest
+
+import offload
+
+
+class OffloadTests(unittest.TestCase):
+
+    def test_green__not_patched(self):
+        """Verify processes that are not monkey patched are not green."""
+        self.assertFalse(offload.green())
+
+    @mock.patch('offload.gevent', new=None)
+    def test_green__no_gevent(self):
+        """Verify processes are not green when gevent is not installed."""
+        self.assertFalse(offload.green())
+
+    @mock.patch('offload.green')
+    def test_call__small(self, mock_green):
+        """Verify small work runs in the calling thread."""
+        mock_green.return_value = True
+        self.assertEqual(thread.get_ident(),
+                         offload.call(10, thread.get_ident))
+
+    def test_call__not_green(self):
+        """Verify work runs in the calling thread without gevent."""
+        self.assertEqual(thread.get_ident(),
+                         offload.call(offload.MIN_SIZE, thread.get_ident))
+
+    @unittest.skipIf(offload.gevent is None, 'gevent is not installed')
+    @mock.patch('offload.green')
+    def test_call__green(self, mock_green):
+        """Verify large work runs in gevent's thread pool, and its errors are
+        raised to the caller."""
+        mock_green.return_value = True
+        self.assertNotEqual(thread.get_ident(),
+                            offload.call(offload.MIN_SIZE, thread.get_ident))
+        self.assertEqual(3, offload.call(offload.MIN_SIZE, len, 'abc'))
+        # Do not let gevent print the traceback.
+        with mock.patch.object(offload.gevent.get_hub(), 'exception_stream',
+                               new=None):
+            self.assertRaises(ValueError, offload.call, offload.MIN_SIZE,
+                              int, 'x')
+
+
+if __name__ == '__main__':
+    unittest.main()
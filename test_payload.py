@@ -0,0 +1,147 @@
+import hmac
+import json
+import mock
+import sha
+import StringIO
+import unittest
+
+import payload
+
+
+class PayloadTests(unittest.TestCase):
+
+    def setUp(self):
+        """Setup push event payload."""
+        super(PayloadTests, self).setUp()
+        self.push = {
+            'ref': 'refs/heads/master',
+            'deleted': False,
+            'compare': 'http://TEST.fake',
+            'repository': {'full_name': 'TESTING/test', 'id': 1234},
+            'pusher': {'name': 'TESTING', 'email': 'TEST@example.com'},
+            'sender': {'login': 'TESTING'},
+            'commits': [{'id': 'abc', 'added': ['x'] * 100}],
+            'head_commit': {
+                'id': 'some-TEST-sha1',
+                'message': 'TEST message',
+                'added': ['a'],
+                'removed': ['r'],
+                'modified': ['m'],
+                'author': {'name': 'TESTING'},
+            },
+        }
+
+    def test_read_body(self):
+        """Verify body is read in chunks and fed to hmac."""
+        body = 'x' * (payload.CHUNK_SIZE * 2 + 10)
+        mac = hmac.new('TEST-secret', digestmod=sha)
+        actual = payload.read_body(StringIO.StringIO(body), len(body),
+                                   len(body), macs=[mac])
+        self.assertEqual(body, actual)
+        self.assertEqual(hmac.new('TEST-secret', body, sha).hexdigest(),
+                         mac.hexdigest())
+
+    def test_read_body__content_length_too_large(self):
+        """Verify nothing is read when content length is over max size."""
+        stream = StringIO.StringIO('x' * 20)
+        self.assertRaises(payload.PayloadTooLarge,
+                          payload.read_body, stream, 20, 10)
+        self.assertEqual(0, stream.tell())
+
+    def test_read_body__too_large(self):
+        """Verify PayloadTooLarge when body is over max size despite its
+        content length."""
+        stream = StringIO.StringIO('x' * (payload.CHUNK_SIZE + 10))
+        self.assertRaises(payload.PayloadTooLarge,
+                          payload.read_body, stream, None, payload.CHUNK_SIZE)
+
+    def test_parse_push(self):
+        """Verify push is parsed and trimmed."""
+        body = json.dumps(self.push)
+        self.assertEqual(payload.trim_push(self.push),
+                         payload.parse_push(body))
+
+    def test_parse_push__commits(self):
+        """Verify up to max commits are kept, the newest ones, and the
+        older ones counted."""
+        self.push['commits'] = [
+            {'id': 'c{0}'.format(i), 'message': 'TEST {0}'.format(i),
+             'author': {'name': 'TESTING', 'email': 'TEST@example.com'},
+             'added': ['a{0}'.format(i)], 'removed': [], 'modified': ['m'],
+             'url': 'http://TEST.fake'}
+            for i in range(3)]
+        expected = [
+            {'id': 'c{0}'.format(i), 'message': 'TEST {0}'.format(i),
+             'author': 'TESTING', 'added': ['a{0}'.format(i)],
+             'removed': [], 'modified': ['m']}
+            for i in range(1, 3)]
+        body = json.dumps(self.push)
+        for parse in (payload.parse_push,
+                      mock.patch('payload.ijson', new=None)(
+                          payload.parse_push)):
+            push = parse(body, max_commits=2)
+            self.assertEqual(expected, push['commits'])
+            self.assertEqual(1, push['omitted_commits'])
+            self.assertNotIn('commits', parse(body))
+
+    @mock.patch('payload.ijson', new=None)
+    def test_parse_push__no_ijson(self):
+        """Verify push is parsed and trimmed when ijson is not installed."""
+        body = json.dumps(self.push)
+        self.assertEqual(payload.trim_push(self.push),
+                         payload.parse_push(body))
+
+    def test_parse_push__deleted(self):
+        """Verify deleted branch push, which has no head commit, is
+        parsed."""
+        body = json.dumps({'deleted': True, 'head_commit': None})
+        self.assertEqual({'deleted': True}, payload.parse_push(body))
+
+    def test_parse_push__invalid(self):
+        """Verify errors for bodies that are not push events."""
+        self.assertRaises(ValueError, payload.parse_push, '{"deleted": ')
+        self.assertRaises(ValueError, payload.parse_push, 'nope')
+        self.assertRaises(TypeError, payload.parse_push, '[]')
+        self.assertRaises(KeyError, payload.parse_push, '{}')
+
+        push = dict(self.push, head_commit=None)
+        self.assertRaises(TypeError, payload.parse_push, json.dumps(push))
+
+    def test_scan_repo(self):
+        """Verify repo name is found, or None for bodies without one."""
+        body = json.dumps(self.push)
+        self.assertEqual('TESTING/test', payload.scan_repo(body))
+        self.assertEqual(None, payload.scan_repo('{"deleted": '))
+        self.assertEqual(None, payload.scan_repo('[]'))
+
+    @mock.patch('payload.ijson', new=None)
+    def test_scan_repo__no_ijson(self):
+        """Verify repo name is found when ijson is not installed."""
+        body = json.dumps(self.push)
+        self.assertEqual('TESTING/test', payload.scan_repo(body))
+        self.assertEqual(None, payload.scan_repo('[]'))
+
+    def test_trim_push(self):
+        """Verify only fields needed for the email are kept."""
+        trimmed = payload.trim_push(json.loads(json.dumps(self.push)))
+        expected = dict(self.push)
+        del expected['commits']
+        del expected['sender']
+        expected['repository'] = {'full_name': 'TESTING/test'}
+        expected['head_commit'] = dict(self.push['head_commit'])
+        del expected['head_commit']['author']
+        self.assertEqual(expected, trimmed)
+
+    def test_trim_push__deleted(self):
+        """Verify deleted branch push is trimmed to deleted flag."""
+        self.assertEqual({'deleted': True},
+                         payload.trim_push({'deleted': True}))
+
+    def test_trim_push__missing_field(self):
+        """Verify KeyError when push is missing a field."""
+        del self.push['pusher']
+        self.assertRaises(KeyError, payload.trim_push, self.push)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import mock
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import ratelimit
+
+
+class MemoryBucketsTests(unittest.TestCase):
+
+    def setUp(self):
+        super(MemoryBucketsTests, self).setUp()
+        self.buckets = self.new_buckets()
+
+    def new_buckets(self):
+        return ratelimit.MemoryBuckets()
+
+    def test_take__burst(self):
+        """Verify bucket starts full and refills at its rate."""
+        limits = [('a', 0.5, 2)]
+        self.assertEqual(0, self.buckets.take(limits, now=100))
+        self.assertEqual(0, self.buckets.take(limits, now=100))
+        self.assertEqual(2, self.buckets.take(limits, now=100))
+        self.assertEqual(1, self.buckets.take(limits, now=101))
+        self.assertEqual(0, self.buckets.take(limits, now=102))
+        # Refills up to burst only.
+        self.assertEqual(0, self.buckets.take(limits, now=1000))
+        self.assertEqual(0, self.buckets.take(limits, now=1000))
+        self.assertEqual(2, self.buckets.take(limits, now=1000))
+
+    def test_take__all_or_nothing(self):
+        """Verify tokens are only taken if every bucket has one."""
+        self.assertEqual(0, self.buckets.take([('a', 1, 1)], now=100))
+        self.assertEqual(1, self.buckets.take([('a', 1, 1), ('b', 1, 1)],
+                                              now=100))
+        self.assertEqual(0, self.buckets.take([('b', 1, 1)], now=100))
+
+
+class SQLiteBucketsTests(MemoryBucketsTests):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'ratelimit.db')
+        super(SQLiteBucketsTests, self).setUp()
+
+    def tearDown(self):
+        self.buckets.close()
+        shutil.rmtree(self.tmp_dir)
+        super(SQLiteBucketsTests, self).tearDown()
+
+    def new_buckets(self):
+        return ratelimit.SQLiteBuckets(self.path)
+
+    def test_shared(self):
+        """Verify buckets are shared between connections."""
+        other = ratelimit.SQLiteBuckets(self.path)
+        try:
+            self.assertEqual(0, self.buckets.take([('a', 1, 1)], now=100))
+            self.assertEqual(1, other.take([('a', 1, 1)], now=100))
+        finally:
+            other.close()
+
+    @mock.patch('ratelimit.SQLiteBuckets.PURGE_INTERVAL', new=2)
+    def test_purge(self):
+        """Verify buckets that have filled up again are purged."""
+        self.buckets.take([('a', 1, 2)], now=100)
+        self.buckets.take([('b', 1, 2)], now=103)
+        self.assertEqual(
+            [('b',)],
+            self.buckets._db.execute('SELECT key FROM buckets').fetchall())
+
+
+class RateLimiterTests(unittest.TestCase):
+
+    def setUp(self):
+        super(RateLimiterTests, self).setUp()
+        self.buckets = mock.Mock()
+        self.buckets.take.return_value = 0
+
+    def test_try_acquire(self):
+        """Verify global and per recipient buckets are used."""
+        limiter = ratelimit.RateLimiter(self.buckets, rate=1, burst=5,
+                                        recipient_rate=0.5,
+                                        recipient_burst=2)
+        self.assertEqual(0, limiter.try_acquire(['B@fake.fake',
+                                                 'a@fake.fake']))
+        self.buckets.take.assert_called_once_with([
+            ('global', 1, 5),
+            ('rcpt:a@fake.fake', 0.5, 2),
+            ('rcpt:b@fake.fake', 0.5, 2)])
+
+    def test_try_acquire__no_limits(self):
+        """Verify buckets are not used without limits."""
+        limiter = ratelimit.RateLimiter(self.buckets)
+        self.assertEqual(0, limiter.try_acquire(['a@fake.fake']))
+        self.assertEqual(0, self.buckets.take.call_count)
+
+    @mock.patch('time.sleep')
+    def test_acquire(self, mock_sleep):
+        """Verify acquire waits until a token is taken."""
+        self.buckets.take.side_effect = [1.5, 0.5, 0]
+        limiter = ratelimit.RateLimiter(self.buckets, rate=1)
+        limiter.acquire(['a@fake.fake'], max_wait=10)
+        self.assertEqual([mock.call(1.5), mock.call(0.5)],
+                         mock_sleep.call_args_list)
+
+    @mock.patch('time.sleep')
+    def test_acquire__too_long(self, mock_sleep):
+        """Verify RateLimited when waiting would take longer than allowed."""
+        self.buckets.take.return_value = 30
+        limiter = ratelimit.RateLimiter(self.buckets, rate=1)
+        self.assertRaises(ratelimit.RateLimited, limiter.acquire,
+                          ['a@fake.fake'], max_wait=10)
+        self.assertEqual(0, mock_sleep.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
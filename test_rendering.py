@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+import email
+import email.header
+import jinja2
+import mock
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import rendering
+import routing
+
+
+class RenderingTests(unittest.TestCase):
+
+    def setUp(self):
+        """Setup config and message info."""
+        super(RenderingTests, self).setUp()
+        self.config = rendering.Config(
+            sender='noreply@fake.fake',
+            send_from_author=False,
+            recipient='recip@fake.fake',
+            reply_to=None,
+            approved=None,
+            template_dir=None,
+            routes_path=None,
+        )
+        self.msg_info = {
+            'repo': 'TESTING/test',
+            'branch': 'the/TEST/master',
+            'revision': 'some-TEST-sha1',
+            'message': 'A lovely TEST\n\nTEST commit message.',
+            'changed_files': 'R a.out\nM README.md',
+            'pusher': 'TESTING-the-tester',
+            'pusher_email': 'TESTING-the-tester <TEST@example.com>',
+            'compare_url': 'http://TEST.fake',
+        }
+
+    def render(self, **config):
+        """Returns message rendered with config overrides, parsed back into
+        an email.message.Message."""
+        renderer = rendering.Renderer(self.config._replace(**config))
+        msg = renderer.render(self.msg_info)
+        return msg, email.message_from_string(msg.data)
+
+    def test_load_config(self):
+        """Verify config is read from environment."""
+        config = rendering.load_config({
+            'GITHUB_COMMIT_EMAILER_SENDER': 'a@fake.fake',
+            'GITHUB_COMMIT_EMAILER_RECIPIENT': 'b@fake.fake',
+            'GITHUB_COMMIT_EMAILER_SEND_FROM_AUTHOR': '',
+        })
+        self.assertEqual('a@fake.fake', config.sender)
+        self.assertEqual('b@fake.fake', config.recipient)
+        self.assertTrue(config.send_from_author)
+        self.assertEqual(None, config.reply_to)
+
+    def test_render(self):
+        """Verify rendered message has expected headers and body."""
+        msg, parsed = self.render()
+        self.assertEqual('noreply@fake.fake', msg.from_addr)
+        self.assertEqual(['recip@fake.fake'], msg.to_addrs)
+        self.assertEqual('noreply@fake.fake', parsed['From'])
+        self.assertEqual('recip@fake.fake', parsed['To'])
+        self.assertEqual('[TESTING/test] TEST commit message.',
+                         parsed['Subject'])
+        self.assertEqual(rendering.SENDGRID_HEADER, parsed['X-SMTPAPI'])
+        self.assertEqual(None, parsed['Reply-To'])
+        self.assertEqual(None, parsed['Approved'])
+        self.assertEqual('7bit', parsed['Content-Transfer-Encoding'])
+        self.assertEqual(
+            rendering.DEFAULT_TEMPLATE.format(**self.msg_info),
+            parsed.get_payload(decode=True))
+
+    def test_render__optional_headers(self):
+        """Verify reply-to and approved headers are added when configured."""
+        msg, parsed = self.render(reply_to='reply@fake.fake',
+                                  approved='my-super-secret')
+        self.assertEqual('reply@fake.fake', parsed['Reply-To'])
+        self.assertEqual('my-super-secret', parsed['Approved'])
+        self.assertEqual('reply@fake.fake', msg.headers['Reply-To'])
+
+    def test_render__from_author(self):
+        """Verify sent from pusher when configured."""
+        msg, parsed = self.render(send_from_author=True)
+        self.assertEqual('TEST@example.com', msg.from_addr)
+        self.assertEqual('TESTING-the-tester <TEST@example.com>',
+                         parsed['From'])
+
+    def test_render__not_configured(self):
+        """Verify ValueError when sender or recipient is not configured."""
+        self.assertRaises(ValueError, self.render, sender=None)
+        self.assertRaises(ValueError, self.render, recipient=None)
+
+    def test_render__subject(self):
+        """Verify subject from message info is used when present."""
+        self.msg_info['subject'] = '[x] 2 pushes'
+        msg, parsed = self.render()
+        self.assertEqual('[x] 2 pushes', parsed['Subject'])
+
+    def test_render__unicode(self):
+        """Verify non-ascii subject, sender name and body are encoded."""
+        self.msg_info['message'] = u'Caf\xe9 ☃'
+        self.msg_info['pusher_email'] = u'J\xfcrgen <j@example.com>'
+        msg, parsed = self.render(send_from_author=True)
+        subject, charset = email.header.decode_header(parsed['Subject'])[0]
+        self.assertEqual(u'[TESTING/test] Caf\xe9 ☃',
+                         subject.decode(charset))
+        name, charset = email.header.decode_header(
+            parsed['From'].split(' <')[0])[0]
+        self.assertEqual(u'J\xfcrgen', name.decode(charset))
+        self.assertEqual('base64', parsed['Content-Transfer-Encoding'])
+        self.assertIn(u'Caf\xe9 ☃',
+                      parsed.get_payload(decode=True).decode('utf-8'))
+
+    def test_render__long_line(self):
+        """Verify bodies with lines too long for SMTP are encoded."""
+        self.msg_info['message'] = 'x' * 1000
+        msg, parsed = self.render()
+        self.assertEqual('base64', parsed['Content-Transfer-Encoding'])
+
+    def test_render__routed(self):
+        """Verify route of the repo and branch overrides config."""
+        routes = routing.RoutingTable([
+            {'repo': 'TESTING/*', 'recipient': ['a@fake.fake', 'b@fake.fake'],
+             'sender': 'repo@fake.fake', 'approved': 'secret'},
+        ])
+        config = self.config._replace(send_from_author=True)
+        renderer = rendering.Renderer(config, routes=routes)
+        msg = renderer.render(self.msg_info)
+        parsed = email.message_from_string(msg.data)
+        self.assertEqual(['a@fake.fake', 'b@fake.fake'], msg.to_addrs)
+        self.assertEqual('a@fake.fake, b@fake.fake', parsed['To'])
+        self.assertEqual('repo@fake.fake', parsed['From'])
+        self.assertEqual('secret', parsed['Approved'])
+        self.assertIs(msg.headers, renderer.render(self.msg_info).headers)
+
+        self.msg_info['repo'] = 'OTHER/test'
+        msg = renderer.render(self.msg_info)
+        self.assertEqual(['recip@fake.fake'], msg.to_addrs)
+        self.assertEqual('TEST@example.com', msg.from_addr)
+
+    def test_preload(self):
+        """Verify headers of every route are encoded by preload."""
+        routes = routing.RoutingTable([
+            {'repo': 'TESTING/*', 'recipient': 'a@fake.fake'},
+            {'repo': 'OTHER/*', 'recipient': 'b@fake.fake'},
+        ])
+        renderer = rendering.Renderer(self.config, routes=routes)
+        renderer.preload()
+        self.assertEqual(2, len(renderer._routed))
+        with mock.patch('rendering._Headers') as mock_headers:
+            msg = renderer.render(self.msg_info)
+        self.assertEqual(0, mock_headers.call_count)
+        self.assertEqual(['a@fake.fake'], msg.to_addrs)
+
+    def test_message_repr(self):
+        """Verify message repr shows addresses and subject."""
+        msg, parsed = self.render()
+        self.assertEqual(
+            '<Message from="noreply@fake.fake" to="recip@fake.fake" '
+            'subject="[TESTING/test] TEST commit message.">', repr(msg))
+
+    def test_get_subject(self):
+        """Verify get_subject returns first line of commit message and
+        repo name.
+        """
+        expected = '[TEST/it] this is a message'
+        actual = rendering.get_subject('TEST/it', 'this is a message')
+        self.assertEqual(expected, actual)
+
+    def test_get_subject__msg_greater_than_50(self):
+        """Verify subject when commit message line has more than 50 chars."""
+        repo = 'TEST/realllllllllllllllyyyyyyyyyyy-loooooooooooooong'
+        msg = 'this is really long {0}'.format('.' * 100)
+        assert len(msg) > 50
+        expected = '[{0}] {1}'.format(repo, msg[:50])
+        actual = rendering.get_subject(repo, msg)
+        self.assertEqual(expected, actual)
+
+    def test_get_subject__third_line(self):
+        """Verify subject when commit message has three lines."""
+        msg = ('merge pull request #blah\n\n'
+               'my real message\n\n'
+               'with lots of info\n')
+        expected = '[TEST/it] my real message'
+        actual = rendering.get_subject('TEST/it', msg)
+        self.assertEqual(expected, actual)
+
+
+class TemplateSetTests(unittest.TestCase):
+
+    def setUp(self):
+        """Setup template directory."""
+        super(TemplateSetTests, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp_dir, 'TESTING'))
+        self.write('TESTING/test.txt', u'{{ repo }} at {{ revision }}\n')
+        self.msg_info = {'repo': 'TESTING/test', 'revision': 'abc'}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        super(TemplateSetTests, self).tearDown()
+
+    def write(self, name, source):
+        with open(os.path.join(self.tmp_dir, name), 'w') as f:
+            f.write(source.encode('utf-8'))
+
+    def test_get__repo(self):
+        """Verify repo template is used when present."""
+        templates = rendering.TemplateSet(self.tmp_dir)
+        self.assertEqual(u'TESTING/test at abc\n',
+                         templates.get('TESTING/test').render(self.msg_info))
+
+    def test_get__default(self):
+        """Verify default.txt is used for repos without a template, and the
+        built-in template when there is no default.txt either."""
+        templates = rendering.TemplateSet(self.tmp_dir)
+        self.assertIsInstance(templates.get('TESTING/other'),
+                              rendering.FormatTemplate)
+
+        self.write('default.txt', u'default {{ revision }}')
+        templates = rendering.TemplateSet(self.tmp_dir)
+        self.assertEqual(u'default abc',
+                         templates.get('TESTING/other').render(self.msg_info))
+
+    def test_get__no_dir(self):
+        """Verify built-in template is used when no directory is set."""
+        templates = rendering.TemplateSet()
+        self.assertIsInstance(templates.get('TESTING/test'),
+                              rendering.FormatTemplate)
+
+    def test_get__cached(self):
+        """Verify templates are compiled once per repo."""
+        templates = rendering.TemplateSet(self.tmp_dir)
+        with mock.patch.object(templates._env, 'select_template',
+                               wraps=templates._env.select_template) as m:
+            first = templates.get('TESTING/test')
+            self.assertIs(first, templates.get('TESTING/test'))
+        self.assertEqual(1, m.call_count)
+
+    def test_preload(self):
+        """Verify every template in the dir is compiled by preload."""
+        self.write('default.txt', u'default {{ revision }}')
+        templates = rendering.TemplateSet(self.tmp_dir)
+        templates.preload()
+        with mock.patch.object(templates._env, 'select_template') as m:
+            self.assertEqual(
+                u'TESTING/test at abc\n',
+                templates.get('TESTING/test').render(self.msg_info))
+        self.assertEqual(0, m.call_count)
+
+    def test_preload__no_dir(self):
+        """Verify preload without template dir does nothing."""
+        templates = rendering.TemplateSet()
+        templates.preload()
+        self.assertEqual({}, templates._templates)
+
+    def test_get__strict(self):
+        """Verify unknown template variables are errors."""
+        self.write('default.txt', u'{{ nope }}')
+        templates = rendering.TemplateSet(self.tmp_dir)
+        template = templates.get('TESTING/other')
+        self.assertRaises(jinja2.UndefinedError, template.render,
+                          self.msg_info)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+import StringIO
+import json
+import mock
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import emailer
+import replay
+
+
+def _push(seq, deleted=False):
+    """Returns push event payload whose head commit is `seq`."""
+    commit = {
+        'id': '{0:040x}'.format(seq + 1),
+        'message': 'TEST commit {0}'.format(seq),
+        'added': [],
+        'removed': [],
+        'modified': ['README.md'],
+        'author': {'name': 'TEST', 'email': 'TEST@example.com'},
+    }
+    return {
+        'ref': 'refs/heads/master',
+        'deleted': deleted,
+        'compare': 'http://TEST.fake',
+        'repository': {'full_name': 'TESTING/test'},
+        'pusher': {'name': 'TEST', 'email': 'TEST@example.com'},
+        'head_commit': commit,
+        'commits': [commit],
+    }
+
+
+def _exported(guid, data, event='push'):
+    """Returns delivery as exported from github's API."""
+    return {'guid': guid, 'event': event, 'request': {'payload': data}}
+
+
+def _delivery(data, location='TEST'):
+    return replay.Delivery(location, json.dumps(data))
+
+
+@mock.patch('logging.error', new=mock.Mock())
+@mock.patch('logging.info', new=mock.Mock())
+class ReplayTests(unittest.TestCase):
+
+    def setUp(self):
+        """Setup temporary directory and env config."""
+        super(ReplayTests, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        emailer._renderer = None
+        emailer._settings = None
+        self.old_environ = dict(os.environ)
+        os.environ['GITHUB_COMMIT_EMAILER_SENDER'] = 'noreply@fake.fake'
+        os.environ['GITHUB_COMMIT_EMAILER_RECIPIENT'] = 'recip@fake.fake'
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.old_environ)
+        emailer._renderer = None
+        emailer._settings = None
+        shutil.rmtree(self.tmp_dir)
+        super(ReplayTests, self).tearDown()
+
+    def test_read_deliveries(self):
+        """Verify deliveries are read from JSONL files, skipping blank
+        lines, and from directories, skipping hidden files."""
+        path = os.path.join(self.tmp_dir, 'deliveries.jsonl')
+        with open(path, 'w') as f:
+            f.write('{"a": 1}\n\n{"b": 2}\n')
+        self.assertEqual(
+            [replay.Delivery(path + ':1', '{"a": 1}\n'),
+             replay.Delivery(path + ':3', '{"b": 2}\n')],
+            list(replay.read_deliveries(path)))
+
+        directory = os.path.join(self.tmp_dir, 'dir')
+        os.mkdir(directory)
+        for name in ('b.json', 'a.json', '.hidden'):
+            with open(os.path.join(directory, name), 'w') as f:
+                f.write(name)
+        self.assertEqual(
+            [replay.Delivery(os.path.join(directory, 'a.json'), 'a.json'),
+             replay.Delivery(os.path.join(directory, 'b.json'), 'b.json')],
+            list(replay.read_deliveries(directory)))
+
+    @mock.patch('emailer._send_email')
+    def test_replay_one__sent(self, mock_send):
+        """Verify pushes are sent with the same message info as web hooks,
+        keyed by guid or push."""
+        self.assertEqual(
+            ('delivery:TEST-guid', replay.SENT, None),
+            replay.replay_one(_delivery(_exported('TEST-guid', _push(0)))))
+        msg_info = mock_send.call_args[0][0]
+        self.assertEqual('TEST-guid', msg_info['delivery_id'])
+        self.assertEqual('TESTING/test', msg_info['repo'])
+        self.assertEqual('TEST commit 0', msg_info['message'])
+
+        self.assertEqual(
+            ('push:TESTING/test:refs/heads/master:' + '{0:040x}'.format(2),
+             replay.SENT, None),
+            replay.replay_one(_delivery(_push(1))))
+        self.assertNotIn('delivery_id', mock_send.call_args[0][0])
+
+    @mock.patch('emailer._send_email')
+    def test_replay_one__payload_string(self, mock_send):
+        """Verify form encoded payloads of exported deliveries are parsed."""
+        delivery = _delivery(_exported('g', json.dumps(_push(0))))
+        self.assertEqual(replay.SENT, replay.replay_one(delivery)[1])
+        self.assertEqual(1, mock_send.call_count)
+
+    @mock.patch('emailer._send_email')
+    def test_replay_one__skipped(self, mock_send):
+        """Verify other events and deleted branches are skipped."""
+        self.assertEqual(
+            ('delivery:g', replay.SKIPPED, 'not_push'),
+            replay.replay_one(_delivery(_exported('g', {}, event='ping'))))
+        self.assertEqual(
+            ('delivery:h', replay.SKIPPED, 'deleted_branch'),
+            replay.replay_one(_delivery(
+                _exported('h', _push(0, deleted=True)))))
+        self.assertEqual(0, mock_send.call_count)
+
+    @mock.patch('emailer._send_email')
+    def test_replay_one__done_before(self, mock_send):
+        """Verify deliveries whose key is done are not sent again."""
+        done = {'delivery:g',
+                'push:TESTING/test:refs/heads/master:' + '{0:040x}'.format(1)}
+        self.assertEqual(
+            replay.DONE_BEFORE,
+            replay.replay_one(_delivery(_exported('g', _push(5))),
+                              done=done)[1])
+        self.assertEqual(
+            replay.DONE_BEFORE,
+            replay.replay_one(_delivery(_push(0)), done=done)[1])
+        self.assertEqual(0, mock_send.call_count)
+
+    @mock.patch('emailer._send_email')
+    def test_replay_one__failed(self, mock_send):
+        """Verify errors are returned as failed outcome."""
+        mock_send.side_effect = ValueError('boom')
+        self.assertEqual(
+            ('delivery:g', replay.FAILED, "ValueError('boom',)"),
+            replay.replay_one(_delivery(_exported('g', _push(0)))))
+        self.assertEqual(
+            ('TEST:7', replay.FAILED, mock.ANY),
+            replay.replay_one(replay.Delivery('TEST:7', '{not json')))
+
+    @mock.patch('emailer._send_email')
+    def test_replay_one__dry_run(self, mock_send):
+        """Verify dry run renders email to file instead of sending it."""
+        key, outcome, path = replay.replay_one(
+            _delivery(_exported('TEST/guid', _push(0))),
+            dry_run_dir=self.tmp_dir)
+        self.assertEqual(replay.RENDERED, outcome)
+        self.assertEqual(os.path.join(self.tmp_dir, 'delivery_TEST_guid.eml'),
+                         path)
+        with open(path) as f:
+            data = f.read()
+        self.assertIn('To: recip@fake.fake', data)
+        self.assertIn('TEST commit 0', data)
+        self.assertEqual(0, mock_send.call_count)
+
+    def test_checkpoint(self):
+        """Verify checkpoint keeps keys added before it was reopened."""
+        path = os.path.join(self.tmp_dir, 'replay.done')
+        checkpoint = replay.Checkpoint(path)
+        checkpoint.add('a')
+        self.assertIn('a', checkpoint)
+        checkpoint.close()
+        checkpoint = replay.Checkpoint(path)
+        try:
+            self.assertIn('a', checkpoint)
+            self.assertNotIn('b', checkpoint)
+        finally:
+            checkpoint.close()
+
+    @mock.patch('emailer._send_email')
+    def test_replayer(self, mock_send):
+        """Verify every delivery is replayed once, with its outcome
+        reported, and sent or skipped ones checkpointed."""
+        deliveries = [_delivery(_exported('g{0}'.format(i), _push(i)))
+                      for i in range(20)]
+        deliveries.append(_delivery(_exported('ping', {}, event='ping')))
+        report = StringIO.StringIO()
+        path = os.path.join(self.tmp_dir, 'replay.done')
+        checkpoint = replay.Checkpoint(path)
+        counts = replay.Replayer(4, checkpoint, report=report).run(deliveries)
+        checkpoint.close()
+        self.assertEqual({replay.SENT: 20, replay.SKIPPED: 1}, dict(counts))
+        self.assertEqual(20, mock_send.call_count)
+        records = [json.loads(line) for line in
+                   report.getvalue().splitlines()]
+        self.assertEqual(21, len(records))
+        self.assertEqual({'key', 'location', 'outcome', 'seconds'},
+                         set(records[0]))
+
+        # Resume: nothing left to send.
+        checkpoint = replay.Checkpoint(path)
+        counts = replay.Replayer(4, checkpoint, report=report).run(deliveries)
+        checkpoint.close()
+        self.assertEqual({replay.DONE_BEFORE: 21}, dict(counts))
+        self.assertEqual(20, mock_send.call_count)
+
+    @mock.patch('emailer._send_email')
+    def test_replayer__failed_retried(self, mock_send):
+        """Verify failed deliveries are not checkpointed, so they are
+        retried when resuming."""
+        mock_send.side_effect = [ValueError('boom'), None]
+        deliveries = [_delivery(_exported('g', _push(0)))]
+        path = os.path.join(self.tmp_dir, 'replay.done')
+        for outcome in (replay.FAILED, replay.SENT):
+            checkpoint = replay.Checkpoint(path)
+            counts = replay.Replayer(1, checkpoint,
+                                     report=StringIO.StringIO()).run(
+                                         deliveries)
+            checkpoint.close()
+            self.assertEqual({outcome: 1}, dict(counts))
+
+    @mock.patch('emailer._smtp_pool', new=None)
+    def test_run__smtp_pool_size(self):
+        """Verify the SMTP pool has a connection for each thread."""
+        path = os.path.join(self.tmp_dir, 'deliveries.jsonl')
+        with open(path, 'w') as f:
+            f.write(json.dumps(_exported('g', {}, event='ping')) + '\n')
+        counts = replay.run([path], concurrency=5,
+                            report_path=os.path.join(self.tmp_dir, 'report'))
+        self.assertEqual({replay.SKIPPED: 1}, dict(counts))
+        self.assertEqual(5, emailer._get_smtp_pool()._max_size)
+
+    def test_shard(self):
+        """Verify shards split deliveries without overlap."""
+        shards = [list(replay._shard(range(10), i, 3)) for i in range(3)]
+        self.assertEqual([[0, 3, 6, 9], [1, 4, 7], [2, 5, 8]], shards)
+
+    @mock.patch('logging.getLogger', new=mock.Mock())
+    @mock.patch('replay.run')
+    def test_main(self, mock_run):
+        """Verify exit status is 1 if any delivery failed."""
+        mock_run.return_value = replay.collections.Counter({replay.SENT: 2})
+        with mock.patch('sys.stderr', new=StringIO.StringIO()):
+            self.assertEqual(0, replay.main(['--concurrency', '3', 'x.jsonl']))
+            mock_run.return_value[replay.FAILED] = 1
+            self.assertEqual(1, replay.main(['x.jsonl']))
+        mock_run.assert_called_with(
+            ['x.jsonl'], concurrency=8, processes=1, checkpoint_path=None,
+            dry_run_dir=None, report_path=None)
+
+
+if __name__ == '__main__':
+    unittest.main()
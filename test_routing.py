@@ -0,0 +1,103 @@
+import json
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import routing
+
+
+class RoutingTableTests(unittest.TestCase):
+
+    def setUp(self):
+        """Setup routing table with exact and pattern rules."""
+        super(RoutingTableTests, self).setUp()
+        self.table = routing.RoutingTable([
+            {'repo': 'chapel-lang/chapel', 'branch': 'refs/heads/release/*',
+             'recipient': 'release@fake.fake'},
+            {'repo': 'chapel-lang/chapel', 'recipient': 'commits@fake.fake',
+             'approved': 'secret'},
+            {'repo': 'chapel-lang/*', 'branch': 'refs/heads/master',
+             'recipient': 'master@fake.fake'},
+            {'repo': 're:chapel-lang/(docs|www)', 'sender': 'web@fake.fake'},
+            {'repo': '*', 'recipient': ['a@fake.fake', 'b@fake.fake']},
+        ])
+
+    def test_lookup__exact(self):
+        """Verify first exact repo rule with matching branch is used."""
+        route = self.table.lookup('chapel-lang/chapel',
+                                  'refs/heads/release/1.2')
+        self.assertEqual('release@fake.fake', route.recipient)
+        route = self.table.lookup('chapel-lang/chapel', 'refs/heads/master')
+        self.assertEqual(
+            routing.Route('commits@fake.fake', None, None, 'secret'), route)
+
+    def test_lookup__pattern(self):
+        """Verify first matching pattern rule is used, in rule order."""
+        self.assertEqual(
+            'master@fake.fake',
+            self.table.lookup('chapel-lang/docs',
+                              'refs/heads/master').recipient)
+        self.assertEqual(
+            'web@fake.fake',
+            self.table.lookup('chapel-lang/docs', 'refs/heads/x').sender)
+        self.assertEqual(
+            ('a@fake.fake', 'b@fake.fake'),
+            self.table.lookup('chapel-lang/docs2', 'refs/heads/x').recipient)
+
+    def test_lookup__no_match(self):
+        """Verify None when no rule matches."""
+        table = routing.RoutingTable([{'repo': 'a/*', 'branch': 'x'}])
+        self.assertEqual(None, table.lookup('a/b', 'y'))
+        self.assertEqual(None, table.lookup('b/a', 'x'))
+
+    def test_lookup__anchored(self):
+        """Verify patterns must match the whole repo and branch."""
+        table = routing.RoutingTable([{'repo': 're:a', 'branch': 'x'}])
+        self.assertEqual(None, table.lookup('ab', 'x'))
+        self.assertEqual(None, table.lookup('a', 'xy'))
+        self.assertNotEqual(None, table.lookup('a', 'x'))
+
+    def test_lookup__many_rules(self):
+        """Verify thousands of pattern rules, with groups of their own, are
+        combined and matched in order."""
+        rules = [{'repo': 're:org{0}/(a|b)'.format(i),
+                  'recipient': 'r{0}'.format(i)} for i in range(2000)]
+        table = routing.RoutingTable(rules)
+        self.assertTrue(len(table._matchers) > 1)
+        self.assertEqual('r0', table.lookup('org0/a', 'x').recipient)
+        self.assertEqual('r1234', table.lookup('org1234/b', 'x').recipient)
+        self.assertEqual('r1999', table.lookup('org1999/a', 'x').recipient)
+
+    def test_routes(self):
+        """Verify routes of all rules are listed in order."""
+        routes = self.table.routes()
+        self.assertEqual(5, len(routes))
+        self.assertEqual('release@fake.fake', routes[0].recipient)
+        self.assertEqual('web@fake.fake', routes[3].sender)
+
+    def test_invalid(self):
+        """Verify ValueError for invalid rules."""
+        self.assertRaises(ValueError, routing.RoutingTable, [{}])
+        self.assertRaises(ValueError, routing.RoutingTable, ['a/b'])
+        self.assertRaises(ValueError, routing.RoutingTable,
+                          [{'repo': 'a/b', 'recipent': 'x'}])
+        self.assertRaises(ValueError, routing.RoutingTable,
+                          [{'repo': 're:('}])
+
+    def test_load_routes(self):
+        """Verify routes are loaded from JSON file."""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'routes.json')
+            with open(path, 'w') as f:
+                json.dump([{'repo': 'a/b', 'recipient': 'x'}], f)
+            table = routing.load_routes(path)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual('x', table.lookup('a/b', 'y').recipient)
+
+
+if __name__ == '__main__':
+    unittest.main()
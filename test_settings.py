@@ -0,0 +1,38 @@
+import unittest
+
+import settings
+
+
+class SettingsTests(unittest.TestCase):
+
+    def test_load_settings(self):
+        """Verify settings are read from environment."""
+        config = settings.load_settings({
+            'GITHUB_COMMIT_EMAILER_MAX_BODY_SIZE': '1000',
+            'GITHUB_COMMIT_EMAILER_MIRROR_DIR': '/TEST/mirrors',
+            'GITHUB_COMMIT_EMAILER_RATE_LIMIT': '60',
+        })
+        self.assertEqual(1000, config.max_body_size)
+        self.assertEqual('/TEST/mirrors', config.mirror_dir)
+        self.assertEqual(60.0, config.rate_limit)
+
+    def test_load_settings__defaults(self):
+        """Verify defaults when nothing is configured."""
+        config = settings.load_settings({
+            'GITHUB_COMMIT_EMAILER_SPOOL_PATH': ''})
+        self.assertEqual(25 * 1024 * 1024, config.max_body_size)
+        self.assertEqual(0, config.max_commits)
+        self.assertEqual(200, config.max_changed_files)
+        self.assertIsNone(config.spool_path)
+        self.assertEqual(0, config.send_workers)
+        self.assertEqual(10.0, config.rate_limit_wait)
+        self.assertIsNone(config.work_queue)
+
+    def test_load_settings__invalid(self):
+        """Verify ValueError for malformed numbers."""
+        self.assertRaises(ValueError, settings.load_settings,
+                          {'GITHUB_COMMIT_EMAILER_MAX_COMMITS': 'lots'})
+
+
+if __name__ == '__main__':
+    unittest.main()
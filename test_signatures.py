@@ -0,0 +1,123 @@
+import hashlib
+import hmac
+import json
+import mock
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import signatures
+
+
+class SignaturesTests(unittest.TestCase):
+
+    def test_get_signature(self):
+        """Verify sha256 signature is preferred over sha1."""
+        self.assertEqual(
+            signatures.Signature('sha256', 'abc'),
+            signatures.get_signature({'x-hub-signature': 'sha1=def',
+                                      'x-hub-signature-256': 'sha256=abc'}))
+        self.assertEqual(
+            signatures.Signature('sha1', 'def'),
+            signatures.get_signature({'x-hub-signature': u'sha1=def'}))
+
+    def test_get_signature__missing(self):
+        """Verify None for missing or malformed signatures."""
+        self.assertEqual(None, signatures.get_signature({}))
+        self.assertEqual(None, signatures.get_signature(
+            {'x-hub-signature': 'md5=abc'}))
+
+    def test_key(self):
+        """Verify key returns new hmac objects keyed with the secret."""
+        key = signatures.Key(u'TEST-secret')
+        for algorithm, digestmod in (('sha1', hashlib.sha1),
+                                     ('sha256', hashlib.sha256)):
+            mac = key.new(algorithm)
+            mac.update('body')
+            self.assertEqual(
+                hmac.new('TEST-secret', 'body', digestmod).hexdigest(),
+                mac.hexdigest())
+            self.assertEqual(
+                hmac.new('TEST-secret', '', digestmod).hexdigest(),
+                key.new(algorithm).hexdigest())
+
+
+class SecretRegistryTests(unittest.TestCase):
+
+    def setUp(self):
+        """Setup registry with default, org and repo secrets."""
+        super(SecretRegistryTests, self).setUp()
+        self.registry = signatures.SecretRegistry(
+            [signatures.Key('default')],
+            {'org': [signatures.Key('org')],
+             'org/repo': [signatures.Key('new'),
+                          signatures.Key('old', expires=1000)]})
+
+    def digests(self, repo):
+        """Returns hexdigests of the empty string for the repo's secrets."""
+        return [m.hexdigest() for m in self.registry.macs('sha1', repo)]
+
+    def secret_digest(self, secret):
+        return hmac.new(secret, '', hashlib.sha1).hexdigest()
+
+    @mock.patch('time.time')
+    def test_macs(self, mock_time):
+        """Verify repo secrets, then org secrets, then default are used."""
+        mock_time.return_value = 999
+        self.assertEqual([self.secret_digest('new'),
+                          self.secret_digest('old')],
+                         self.digests('org/repo'))
+        self.assertEqual([self.secret_digest('org')],
+                         self.digests('org/other'))
+        self.assertEqual([self.secret_digest('default')],
+                         self.digests('other/repo'))
+        self.assertEqual([self.secret_digest('default')],
+                         self.digests(None))
+        self.assertTrue(self.registry.per_repo)
+
+    @mock.patch('time.time')
+    def test_macs__expired(self, mock_time):
+        """Verify expired secrets are not used."""
+        mock_time.return_value = 1000
+        self.assertEqual([self.secret_digest('new')],
+                         self.digests('org/repo'))
+
+    def test_load_registry(self):
+        """Verify default and old secret are loaded from environment."""
+        registry = signatures.load_registry({
+            'GITHUB_COMMIT_EMAILER_SECRET': 'new',
+            'GITHUB_COMMIT_EMAILER_OLD_SECRET': 'old',
+        })
+        self.assertFalse(registry.per_repo)
+        self.assertEqual(2, len(registry.macs('sha1')))
+
+    def test_load_registry__file(self):
+        """Verify secrets are loaded from secrets file."""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'secrets.json')
+            with open(path, 'w') as f:
+                json.dump({
+                    'org': 'org-secret',
+                    'org/repo': ['new', {'secret': 'old',
+                                         'expires': '1970-01-01T00:16:40Z'}],
+                }, f)
+            registry = signatures.load_registry(
+                {'GITHUB_COMMIT_EMAILER_SECRETS': path})
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertTrue(registry.per_repo)
+        self.assertEqual(1, len(registry.macs('sha1', 'org/other')))
+        self.assertEqual(0, len(registry.macs('sha1', 'other/repo')))
+        keys = registry._secrets['org/repo']
+        self.assertEqual([None, 1000], [k.expires for k in keys])
+
+    @mock.patch('logging.error', new=mock.Mock())
+    def test_load_registry__not_configured(self):
+        """Verify ValueError when no secret is configured."""
+        self.assertRaises(ValueError, signatures.load_registry, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
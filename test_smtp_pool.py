@@ -0,0 +1,263 @@
+import mock
+import smtplib
+import socket
+import threading
+import unittest
+
+import rendering
+import smtp_pool
+
+
+@mock.patch('logging.warn', new=mock.Mock())
+class SMTPPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        """Setup pool with fake SMTP factory."""
+        super(SMTPPoolTests, self).setUp()
+        self.created = []
+        self.pool = smtp_pool.SMTPPool(self.factory, max_size=2,
+                                       checkout_timeout=0.1)
+
+    def factory(self):
+        """Returns new fake envelopes.SMTP connection."""
+        smtp = mock.Mock(name='smtp-{0}'.format(len(self.created)))
+        smtp.is_connected = True
+        self.created.append(smtp)
+        return smtp
+
+    def test_send__reuses_connection(self):
+        """Verify consecutive sends share one connection."""
+        for _ in range(3):
+            self.pool.send('msg')
+        self.assertEqual(1, len(self.created))
+        self.assertEqual(3, self.created[0].send.call_count)
+        stats = self.pool.stats()
+        self.assertEqual(1, stats['handshakes'])
+        self.assertEqual(2, stats['handshakes_avoided'])
+        self.assertEqual(3, stats['checkouts'])
+        self.assertEqual(1, stats['idle'])
+        self.assertEqual(0, stats['checked_out'])
+
+    def test_send__reconnect(self):
+        """Verify send is retried once on a new connection when the
+        connection fails."""
+        self.pool.send('msg')
+        self.created[0].send.side_effect = smtplib.SMTPServerDisconnected()
+        self.pool.send('msg2')
+        self.assertEqual(2, len(self.created))
+        self.created[1].send.assert_called_once_with('msg2')
+        self.assertEqual(1, self.pool.stats()['discarded'])
+        self.assertEqual(1, self.pool.stats()['idle'])
+
+    def test_send__reconnect_fails(self):
+        """Verify error is raised when the fresh connection fails too."""
+        def factory():
+            smtp = self.factory()
+            smtp.send.side_effect = socket.error('nope')
+            return smtp
+        self.pool._factory = factory
+        self.assertRaises(socket.error, self.pool.send, 'msg')
+        self.assertEqual(2, len(self.created))
+        self.assertEqual(0, self.pool.stats()['checked_out'])
+
+    def test_send__rejected(self):
+        """Verify connection is kept when server rejects a message."""
+        self.pool.send('msg')
+        self.created[0].send.side_effect = smtplib.SMTPRecipientsRefused({})
+        self.assertRaises(smtplib.SMTPRecipientsRefused,
+                          self.pool.send, 'msg')
+        self.assertEqual(1, len(self.created))
+        self.assertEqual(1, self.pool.stats()['idle'])
+
+    def test_send__rendered(self):
+        """Verify rendered messages are passed to smtplib as is, connecting
+        first if needed."""
+        msg = rendering.Message('a@fake.fake', ['b@fake.fake'], 'hi', {},
+                                'Subject: hi\n\nbody')
+        smtp = self.factory()
+        smtp._conn = None
+
+        def connect():
+            smtp._conn = mock.Mock()
+        smtp._connect.side_effect = connect
+        stats = mock.MagicMock()
+        self.pool = smtp_pool.SMTPPool(lambda: smtp, metrics=stats)
+
+        self.pool.send(msg)
+        self.pool.send(msg)
+        self.assertEqual(
+            [mock.call('github_email_stage_seconds', stage='smtp_connect'),
+             mock.call('github_email_stage_seconds', stage='smtp_send'),
+             mock.call('github_email_stage_seconds', stage='smtp_send')],
+            stats.timer.call_args_list)
+        self.assertEqual(1, smtp._connect.call_count)
+        self.assertEqual(0, smtp.send.call_count)
+        self.assertEqual(
+            [mock.call('a@fake.fake', ['b@fake.fake'],
+                       'Subject: hi\n\nbody')] * 2,
+            smtp._conn.sendmail.call_args_list)
+
+    def test_send_many(self):
+        """Verify several envelopes are sent in one session."""
+        errors = self.pool.send_many(['a', 'b', 'c'])
+        self.assertEqual([None, None, None], errors)
+        self.assertEqual(1, len(self.created))
+        self.assertEqual([mock.call('a'), mock.call('b'), mock.call('c')],
+                         self.created[0].send.call_args_list)
+        self.assertEqual(1, self.pool.stats()['checkouts'])
+
+    def test_send_many__rejected(self):
+        """Verify a rejected envelope does not stop the rest."""
+        refused = smtplib.SMTPRecipientsRefused({})
+        self.pool.send('warm-up')
+        self.created[0].send.side_effect = [refused, None]
+        errors = self.pool.send_many(['a', 'b'])
+        self.assertEqual([refused, None], errors)
+        self.assertEqual(1, len(self.created))
+
+    def test_send_many__reconnect(self):
+        """Verify unsent envelopes are resent on a fresh connection when the
+        connection dies part way through."""
+        self.pool.send('warm-up')
+        self.created[0].send.side_effect = [
+            None, smtplib.SMTPServerDisconnected()]
+        errors = self.pool.send_many(['a', 'b', 'c'])
+        self.assertEqual([None, None, None], errors)
+        self.assertEqual(2, len(self.created))
+        self.assertEqual([mock.call('b'), mock.call('c')],
+                         self.created[1].send.call_args_list)
+
+    def test_send_many__reconnect_fails(self):
+        """Verify connection error is returned for each unsent envelope when
+        the fresh connection fails too."""
+        err = socket.error('nope')
+
+        def factory():
+            smtp = self.factory()
+            smtp.send.side_effect = err
+            return smtp
+        self.pool._factory = factory
+        self.assertEqual([err, err], self.pool.send_many(['a', 'b']))
+        self.assertEqual(0, self.pool.stats()['checked_out'])
+
+    @mock.patch('time.time')
+    def test_checkout__max_age(self, mock_time):
+        """Verify connections older than max age are recycled."""
+        mock_time.return_value = 1000
+        self.pool.send('msg')
+        mock_time.return_value = 1000 + self.pool._max_age + 1
+        self.pool.send('msg')
+        self.assertEqual(2, len(self.created))
+        self.assertEqual(1, self.pool.stats()['discarded'])
+        self.created[0]._conn.quit.assert_called_once_with()
+
+    @mock.patch('time.time')
+    def test_checkout__idle_timeout(self, mock_time):
+        """Verify connections idle longer than idle timeout are recycled."""
+        mock_time.return_value = 1000
+        self.pool.send('msg')
+        mock_time.return_value = 1000 + self.pool._idle_timeout + 1
+        self.pool.send('msg')
+        self.assertEqual(2, len(self.created))
+
+    @mock.patch('time.time')
+    def test_checkout__health_check(self, mock_time):
+        """Verify idle connections that fail NOOP are recycled."""
+        mock_time.return_value = 1000
+        self.pool.send('msg')
+        self.created[0].is_connected = False
+        mock_time.return_value = 1000 + self.pool._check_interval + 1
+        self.pool.send('msg')
+        self.assertEqual(2, len(self.created))
+
+    def test_checkout__no_health_check_when_fresh(self):
+        """Verify recently used connections are not checked with NOOP."""
+        self.pool.send('msg')
+        self.created[0].is_connected = False
+        self.pool.send('msg')
+        self.assertEqual(1, len(self.created))
+
+    def test_checkout__timeout(self):
+        """Verify PoolTimeout when all connections stay checked out."""
+        with self.pool.connection():
+            with self.pool.connection():
+                self.assertRaises(smtp_pool.PoolTimeout,
+                                  self.pool._checkout)
+        self.assertEqual(0, self.pool.stats()['checked_out'])
+        self.assertEqual(2, self.pool.stats()['idle'])
+
+    def test_checkout__waits(self):
+        """Verify checkout waits for a connection to be returned."""
+        self.pool._checkout_timeout = 5
+        got = []
+        with self.pool.connection():
+            with self.pool.connection():
+                t = threading.Thread(target=lambda: got.append(
+                    self.pool.send('msg')))
+                t.start()
+        t.join(5)
+        self.assertEqual(1, len(got))
+        self.assertEqual(2, len(self.created))
+        self.assertGreater(self.pool.stats()['checkout_wait_seconds'], 0)
+
+    def test_checkout__in_order(self):
+        """Verify waiting callers are handed connections in the order they
+        arrived."""
+        self.pool._checkout_timeout = 5
+        served = []
+
+        def send(n):
+            with self.pool.connection():
+                served.append(n)
+        threads = []
+        first = self.pool._checkout()
+        with self.pool.connection():
+            for n in range(3):
+                threads.append(threading.Thread(target=send, args=(n,)))
+                threads[-1].start()
+                while self.pool.stats()['waiting'] <= n:
+                    threading.Event().wait(0.001)
+        for t in threads:
+            t.join(5)
+        self.pool._checkin(first)
+        self.assertEqual([0, 1, 2], served)
+        self.assertEqual(0, self.pool.stats()['checked_out'])
+
+    def test_checkout__factory_error(self):
+        """Verify a failed connect does not leak a pool slot."""
+        self.pool._factory = mock.Mock(side_effect=ValueError('boom'))
+        for _ in range(3):
+            self.assertRaises(ValueError, self.pool.send, 'msg')
+        self.assertEqual(0, self.pool.stats()['checked_out'])
+
+    def test_close(self):
+        """Verify close quits idle connections."""
+        self.pool.send('msg')
+        self.pool.close()
+        self.created[0]._conn.quit.assert_called_once_with()
+        self.assertEqual(0, self.pool.stats()['idle'])
+
+    def test_warm(self):
+        """Verify a connection is opened ahead of the first send."""
+        def factory():
+            smtp = self.factory()
+            smtp._conn = None
+            return smtp
+        self.pool._factory = factory
+        self.pool.warm()
+        self.created[0]._connect.assert_called_once_with()
+        self.assertEqual(1, self.pool.stats()['idle'])
+        self.pool.send('msg')
+        self.assertEqual(1, len(self.created))
+
+    def test_warm__fails(self):
+        """Verify failing to open a connection ahead of time is not an
+        error."""
+        self.pool._factory = mock.Mock(side_effect=socket.error('nope'))
+        self.pool.warm()
+        self.assertEqual(0, self.pool.stats()['idle'])
+        self.assertEqual(0, self.pool.stats()['checked_out'])
+
+
+if __name__ == '__main__':
+    unittest.main()
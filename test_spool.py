@@ -0,0 +1,202 @@
+import json
+import mock
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+
+import spool
+
+
+@mock.patch('logging.error', new=mock.Mock())
+@mock.patch('logging.info', new=mock.Mock())
+class SpoolTests(unittest.TestCase):
+
+    def setUp(self):
+        """Setup spool in a temporary directory."""
+        super(SpoolTests, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'spool.db')
+        self.spool = spool.Spool(self.path, max_attempts=3, base_delay=10,
+                                 max_delay=25, lease=60)
+        self.msg_info = {'repo': 'TESTING/test', 'message': 'TEST message'}
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.tmp_dir)
+        super(SpoolTests, self).tearDown()
+
+    def test_put__leased(self):
+        """Verify new message is not claimable while leased to caller."""
+        self.spool.put(self.msg_info)
+        self.assertEqual(1, self.spool.pending())
+        self.assertEqual([], self.spool.claim())
+
+    def test_put__strips_spool_ids(self):
+        """Verify spool ids are not stored in message body."""
+        spool_id = self.spool.put(dict(self.msg_info, spool_ids=[42]))
+        self.spool.release([spool_id])
+        claimed = self.spool.claim()
+        self.assertEqual([dict(self.msg_info, spool_ids=[spool_id])],
+                         claimed)
+
+    @mock.patch('time.time')
+    def test_claim__after_lease(self, mock_time):
+        """Verify message is claimed again once its lease expires, e.g.
+        after a crash, and is then leased to the new owner."""
+        mock_time.return_value = 1000
+        spool_id = self.spool.put(self.msg_info)
+
+        mock_time.return_value = 1061
+        claimed = self.spool.claim()
+        self.assertEqual([spool_id], claimed[0]['spool_ids'])
+        self.assertEqual('TESTING/test', claimed[0]['repo'])
+        self.assertEqual([], self.spool.claim())
+
+    def test_claim__reopened(self):
+        """Verify messages survive closing and reopening the spool."""
+        spool_id = self.spool.put(self.msg_info)
+        self.spool.release([spool_id])
+        self.spool.close()
+        self.spool = spool.Spool(self.path)
+        self.assertEqual(1, len(self.spool.claim()))
+
+    def test_claim__limit(self):
+        """Verify claim returns at most limit messages, oldest first."""
+        ids = [self.spool.put({'n': i}) for i in range(5)]
+        self.spool.release(ids)
+        claimed = self.spool.claim(limit=2)
+        self.assertEqual([0, 1], [m['n'] for m in claimed])
+        self.assertEqual(3, len(self.spool.claim(limit=10)))
+
+    def test_ack(self):
+        """Verify acked messages are removed."""
+        spool_id = self.spool.put(self.msg_info)
+        self.spool.ack([spool_id])
+        self.assertEqual(0, self.spool.pending())
+
+    @mock.patch('time.time')
+    def test_extend(self, mock_time):
+        """Verify leases of messages put or claimed are renewed until they
+        are acked, failed or released, and longer holds are kept."""
+        mock_time.return_value = 1000
+        ids = [self.spool.put({'n': i}) for i in range(3)]
+        held = self.spool.put({'n': 3}, hold=200)
+        mock_time.return_value = 1050
+        self.assertEqual(4, self.spool.extend())
+        mock_time.return_value = 1100
+        self.assertEqual([], self.spool.claim())
+
+        self.spool.ack([ids[0]])
+        self.spool.fail([ids[1]], ValueError('boom'))
+        self.spool.release([ids[2]])
+        self.assertEqual(1, self.spool.extend())
+        mock_time.return_value = 1259
+        self.assertEqual([1, 2], sorted(m['n'] for m in self.spool.claim()))
+        mock_time.return_value = 1261
+        self.assertEqual([held], self.spool.claim()[0]['spool_ids'])
+
+    @mock.patch('random.uniform')
+    @mock.patch('time.time')
+    def test_fail__retry(self, mock_time, mock_uniform):
+        """Verify failed message is retried after backoff."""
+        mock_time.return_value = 1000
+        mock_uniform.side_effect = lambda a, b: b
+        spool_id = self.spool.put(self.msg_info)
+        self.spool.fail([spool_id], ValueError('boom'))
+
+        mock_time.return_value = 1009
+        self.assertEqual([], self.spool.claim())
+        mock_time.return_value = 1010
+        self.assertEqual(1, len(self.spool.claim()))
+
+    def test_fail__dead_letter(self):
+        """Verify message is moved to dead letter directory after max
+        attempts."""
+        spool_id = self.spool.put(self.msg_info)
+        for _ in range(2):
+            self.assertEqual([], self.spool.fail([spool_id],
+                                                 ValueError('boom')))
+        self.assertEqual([spool_id],
+                         self.spool.fail([spool_id], ValueError('boom')))
+        self.assertEqual(0, self.spool.pending())
+
+        path = os.path.join(self.path + '.dead', '{0}.json'.format(spool_id))
+        with open(path) as f:
+            dead = json.load(f)
+        self.assertEqual(self.msg_info, dead['msg_info'])
+        self.assertEqual(3, dead['attempts'])
+        self.assertEqual("ValueError('boom',)", dead['last_error'])
+
+    def test_fail__unknown(self):
+        """Verify failing an unknown message is ignored."""
+        self.spool.fail([1234], ValueError('boom'))
+        self.assertEqual(0, self.spool.pending())
+
+    @mock.patch('random.uniform')
+    def test_backoff(self, mock_uniform):
+        """Verify backoff doubles up to max delay, with jitter."""
+        mock_uniform.side_effect = lambda a, b: (a, b)
+        self.assertEqual((5, 10), self.spool.backoff(1))
+        self.assertEqual((10, 20), self.spool.backoff(2))
+        self.assertEqual((12.5, 25), self.spool.backoff(3))
+
+    def test_retry_scheduler(self):
+        """Verify scheduler delivers all due messages in batches."""
+        ids = [self.spool.put({'n': i}) for i in range(3)]
+        self.spool.release(ids)
+        deliver = mock.Mock()
+        scheduler = spool.RetryScheduler(self.spool, deliver, batch_size=2)
+        self.assertEqual(3, scheduler.run_once())
+        self.assertEqual(2, deliver.call_count)
+        first_batch = deliver.call_args_list[0][0][0]
+        self.assertEqual([0, 1], [m['n'] for m in first_batch])
+
+    @mock.patch('logging.exception', new=mock.Mock())
+    def test_retry_scheduler__error(self):
+        """Verify messages of a batch whose delivery raises are failed, so
+        they are retried later instead of staying leased."""
+        spool_id = self.spool.put(self.msg_info)
+        self.spool.release([spool_id])
+        deliver = mock.Mock(side_effect=ValueError('boom'))
+        scheduler = spool.RetryScheduler(self.spool, deliver)
+        self.assertEqual(0, scheduler.run_once())
+        self.assertEqual(1, deliver.call_count)
+        self.assertEqual([], self.spool.held([spool_id]))
+        self.assertEqual(1, self.spool.pending())
+        self.assertEqual(0, self.spool.extend())
+
+    def test_retry_scheduler__stop(self):
+        """Verify stopped scheduler thread exits."""
+        scheduler = spool.RetryScheduler(self.spool, mock.Mock(),
+                                         interval=60)
+        scheduler.start()
+        scheduler.stop(timeout=5)
+        self.assertFalse(any(t.is_alive() for t in scheduler._threads))
+
+    def test_retry_scheduler__heartbeat(self):
+        """Verify message waiting to be sent is not claimed by another
+        process while the scheduler extends its lease, but is once the
+        process holding it is gone."""
+        holder = spool.Spool(self.path, lease=0.2)
+        other = spool.Spool(self.path)
+        scheduler = spool.RetryScheduler(holder, mock.Mock(), interval=60,
+                                         heartbeat=0.02)
+        try:
+            holder.put(self.msg_info)
+            scheduler.start()
+            time.sleep(0.5)
+            self.assertEqual([], other.claim())
+            scheduler.stop(timeout=5)
+            time.sleep(0.3)
+            self.assertEqual(1, len(other.claim()))
+        finally:
+            scheduler.stop(timeout=5)
+            holder.close()
+            other.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
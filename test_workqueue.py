@@ -0,0 +1,319 @@
+import mock
+import os.path
+import shutil
+import tempfile
+import threading
+import unittest
+
+import workqueue
+
+
+@mock.patch('logging.error', new=mock.Mock())
+class SQLiteWorkQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        """Setup work queue in a temporary directory."""
+        super(SQLiteWorkQueueTests, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'jobs.db')
+        self.queue = workqueue.SQLiteWorkQueue(
+            self.path, lease=60, max_attempts=3, base_delay=10, max_delay=25,
+            retention=100)
+        self.msg_info = {'repo': 'TESTING/test', 'message': 'TEST message'}
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmp_dir)
+        super(SQLiteWorkQueueTests, self).tearDown()
+
+    def test_put_claim(self):
+        """Verify jobs are claimed once, oldest first, up to limit."""
+        ids = [self.queue.put({'n': i}) for i in range(3)]
+        jobs = self.queue.claim('a', limit=2)
+        self.assertEqual(ids[:2], [job.id for job in jobs])
+        self.assertEqual([{'n': 0}, {'n': 1}], [job.msg_info for job in jobs])
+        self.assertEqual([1, 1], [job.attempts for job in jobs])
+        self.assertEqual([ids[2]], [j.id for j in self.queue.claim('b')])
+        self.assertEqual([], self.queue.claim('c'))
+
+    def test_put__duplicate_key(self):
+        """Verify job with a key that is queued or done is dropped."""
+        self.assertIsNotNone(self.queue.put(self.msg_info, key='k'))
+        self.assertIsNone(self.queue.put(self.msg_info, key='k'))
+        self.assertTrue(self.queue.complete(self.queue.claim('a')[0]))
+        self.assertIsNone(self.queue.put(self.msg_info, key='k'))
+        self.assertIsNotNone(self.queue.put(self.msg_info))
+        self.assertIsNotNone(self.queue.put(self.msg_info))
+
+    @mock.patch('time.time')
+    def test_put__delay(self, mock_time):
+        """Verify job is not claimed before its delay has passed."""
+        mock_time.return_value = 1000
+        self.queue.put(self.msg_info, delay=30)
+        self.assertEqual([], self.queue.claim('a'))
+        mock_time.return_value = 1030
+        self.assertEqual(1, len(self.queue.claim('a')))
+
+    @mock.patch('time.time')
+    def test_claim__group(self, mock_time):
+        """Verify held jobs of the same group are claimed along with the
+        first one that is due."""
+        mock_time.return_value = 1000
+        first = self.queue.put({'n': 0}, delay=30, group='org/bot')
+        mock_time.return_value = 1020
+        second = self.queue.put({'n': 1}, delay=30, group='org/bot')
+        other = self.queue.put({'n': 2}, delay=30, group='org/other')
+        mock_time.return_value = 1030
+        jobs = self.queue.claim('a')
+        self.assertEqual([first, second], [job.id for job in jobs])
+        self.assertEqual(['org/bot', 'org/bot'], [job.group for job in jobs])
+        mock_time.return_value = 1050
+        self.assertEqual([other], [job.id for job in self.queue.claim('a')])
+
+    @mock.patch('time.time')
+    def test_claim__lease_expired(self, mock_time):
+        """Verify job of a dead sender is claimed again once its lease
+        expires, and the dead sender can no longer complete it."""
+        mock_time.return_value = 1000
+        self.queue.put(self.msg_info)
+        stale = self.queue.claim('a')[0]
+        mock_time.return_value = 1059
+        self.assertEqual([], self.queue.claim('b'))
+        mock_time.return_value = 1061
+        job = self.queue.claim('b')[0]
+        self.assertEqual(2, job.attempts)
+        self.assertNotEqual(stale.token, job.token)
+        self.assertFalse(self.queue.complete(stale))
+        self.assertFalse(self.queue.fail(stale, ValueError('late')))
+        self.assertTrue(self.queue.complete(job))
+        self.assertTrue(self.queue.complete(job))
+
+    @mock.patch('time.time')
+    def test_claim__max_attempts(self, mock_time):
+        """Verify job whose every lease expired is marked dead."""
+        mock_time.return_value = 1000
+        self.queue.put(self.msg_info)
+        for i in range(3):
+            mock_time.return_value = 1000 + i * 61
+            self.assertEqual(1, len(self.queue.claim('a')))
+        mock_time.return_value = 1000 + 3 * 61
+        self.assertEqual([], self.queue.claim('a'))
+        self.assertEqual(1, self.queue.stats()['dead'])
+
+    @mock.patch('time.time')
+    def test_extend(self, mock_time):
+        """Verify extended lease keeps job from being claimed again, and
+        lost leases are returned."""
+        mock_time.return_value = 1000
+        self.queue.put(self.msg_info)
+        job = self.queue.claim('a')[0]
+        mock_time.return_value = 1050
+        self.assertEqual([], self.queue.extend([job]))
+        mock_time.return_value = 1100
+        self.assertEqual([], self.queue.claim('b'))
+        mock_time.return_value = 1111
+        self.queue.claim('b')
+        self.assertEqual([job], self.queue.extend([job]))
+
+    @mock.patch('random.uniform')
+    @mock.patch('time.time')
+    def test_fail__retry(self, mock_time, mock_uniform):
+        """Verify failed job is retried after a backoff."""
+        mock_time.return_value = 1000
+        mock_uniform.return_value = 10
+        self.queue.put(self.msg_info)
+        self.assertTrue(self.queue.fail(self.queue.claim('a')[0],
+                                        ValueError('boom')))
+        mock_uniform.assert_called_once_with(5.0, 10)
+        self.assertEqual([], self.queue.claim('a'))
+        mock_time.return_value = 1010
+        self.assertEqual(2, self.queue.claim('a')[0].attempts)
+
+    @mock.patch('random.uniform', new=mock.Mock(return_value=0))
+    def test_fail__dead(self):
+        """Verify job is marked dead after max attempts, and is replaced by a
+        job put again with its key."""
+        self.queue.put(self.msg_info, key='k')
+        for _ in range(3):
+            self.queue.fail(self.queue.claim('a')[0], ValueError('boom'))
+        self.assertEqual([], self.queue.claim('a'))
+        self.assertEqual(
+            {'queued': 0, 'leased': 0, 'done': 0, 'dead': 1},
+            self.queue.stats())
+        job_id = self.queue.put(self.msg_info, key='k')
+        self.assertIsNotNone(job_id)
+        self.assertEqual([job_id], [j.id for j in self.queue.claim('a')])
+        self.assertEqual(
+            {'queued': 1, 'leased': 1, 'done': 0, 'dead': 0},
+            self.queue.stats())
+
+    def test_claim__priority(self):
+        """Verify jobs are claimed by priority, taking turns between repos
+        within each priority."""
+        ids = [self.queue.put({'n': i}, priority=1, repo='a')
+               for i in range(3)]
+        ids.append(self.queue.put({'n': 3}, priority=1, repo='b'))
+        ids.append(self.queue.put({'n': 4}, priority=0, repo='c'))
+        self.assertEqual([ids[4], ids[0], ids[3], ids[1]],
+                         [j.id for j in self.queue.claim('a', limit=4)])
+        self.assertEqual([ids[2]], [j.id for j in self.queue.claim('b')])
+
+    @mock.patch('time.time')
+    def test_purge(self, mock_time):
+        """Verify done jobs are purged after the retention period."""
+        mock_time.return_value = 1000
+        self.queue.PURGE_INTERVAL = 2
+        self.queue.put(self.msg_info, key='k')
+        self.queue.complete(self.queue.claim('a')[0])
+        mock_time.return_value = 1101
+        self.queue.put(self.msg_info)
+        self.queue.complete(self.queue.claim('a')[0])
+        self.assertEqual(1, self.queue.stats()['done'])
+        self.assertIsNotNone(self.queue.put(self.msg_info, key='k'))
+
+    @mock.patch('time.time')
+    def test_purge__dead(self, mock_time):
+        """Verify dead jobs are purged after the retention period."""
+        mock_time.return_value = 1000
+        self.queue.PURGE_INTERVAL = 1
+        self.queue.put(self.msg_info)
+        for _ in range(3):
+            self.queue.fail(self.queue.claim('a')[0], ValueError('boom'))
+            mock_time.return_value += 30
+        self.assertEqual(1, self.queue.stats()['dead'])
+        mock_time.return_value += 101
+        self.queue.put(self.msg_info)
+        self.queue.complete(self.queue.claim('a')[0])
+        self.assertEqual(0, self.queue.stats()['dead'])
+
+    def test_shared(self):
+        """Verify jobs put through one handle are claimed through another,
+        like on another node."""
+        self.queue.put(self.msg_info)
+        other = workqueue.SQLiteWorkQueue(self.path)
+        try:
+            job = other.claim('b')[0]
+            self.assertEqual([], self.queue.claim('a'))
+            self.assertTrue(other.complete(job))
+        finally:
+            other.close()
+        self.assertEqual(1, self.queue.stats()['done'])
+
+
+class OpenQueueTests(unittest.TestCase):
+
+    def test_open_queue(self):
+        """Verify backend is chosen by URL scheme."""
+        mock_queue = mock.Mock()
+        with mock.patch.dict('workqueue.BACKENDS', {'sqlite': mock_queue}):
+            self.assertIs(mock_queue.return_value,
+                          workqueue.open_queue('sqlite:///TEST/jobs.db',
+                                               lease=5))
+        mock_queue.assert_called_once_with('/TEST/jobs.db', lease=5)
+
+    def test_open_queue__unknown(self):
+        """Verify ValueError for unknown backends."""
+        self.assertRaises(ValueError, workqueue.open_queue, '/TEST/jobs.db')
+        self.assertRaises(ValueError, workqueue.open_queue, 'redis://x')
+
+
+@mock.patch('logging.warn', new=mock.Mock())
+@mock.patch('logging.error', new=mock.Mock())
+class SendersTests(unittest.TestCase):
+
+    def setUp(self):
+        """Setup work queue in a temporary directory."""
+        super(SendersTests, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'jobs.db')
+        self.queue = workqueue.SQLiteWorkQueue(self.path)
+
+    def tearDown(self):
+        self.queue.close()
+        shutil.rmtree(self.tmp_dir)
+        super(SendersTests, self).tearDown()
+
+    def test_run_once(self):
+        """Verify sent jobs are completed and failed ones retried."""
+        ok = self.queue.put({'n': 0})
+        self.queue.put({'n': 1})
+        deliver = mock.Mock(return_value=[None, ValueError('boom')])
+        senders = workqueue.Senders(self.queue, deliver, owner='a')
+        self.assertEqual(2, senders.run_once())
+        self.assertEqual([[ok, ok + 1]], [[j.id for j in c[0][0]]
+                                          for c in deliver.call_args_list])
+        self.assertEqual({'queued': 1, 'leased': 0, 'done': 1, 'dead': 0},
+                         self.queue.stats())
+        self.assertEqual(0, senders.run_once())
+
+    @mock.patch('logging.exception', new=mock.Mock())
+    def test_run_once__error(self):
+        """Verify whole batch is failed if delivering it raises."""
+        self.queue.put({'n': 0})
+        senders = workqueue.Senders(
+            self.queue, mock.Mock(side_effect=ValueError('boom')), owner='a')
+        self.assertEqual(1, senders.run_once())
+        self.assertEqual(1, self.queue.stats()['queued'])
+
+    def test_heartbeat(self):
+        """Verify leases of jobs being sent are extended."""
+        self.queue.put({'n': 0})
+        extended = threading.Event()
+        queue = mock.Mock(wraps=self.queue)
+        queue.extend.side_effect = lambda jobs: extended.set() or []
+
+        def deliver(jobs):
+            extended.wait(5)
+            return [None] * len(jobs)
+        senders = workqueue.Senders(queue, deliver, heartbeat=0.01)
+        senders.start()
+        try:
+            for _ in range(500):
+                if self.queue.stats()['done']:
+                    break
+                extended.wait(0.01)
+        finally:
+            self.assertTrue(senders.stop(timeout=5))
+        self.assertTrue(extended.is_set())
+        self.assertEqual(1, self.queue.stats()['done'])
+
+    def test_nodes(self):
+        """Verify jobs are sent exactly once by senders on several nodes,
+        including jobs of a node that died while sending them."""
+        for i in range(50):
+            self.queue.put({'n': i}, key=str(i))
+        # A node that claims jobs and dies without completing them.
+        dead = workqueue.SQLiteWorkQueue(self.path, lease=0.2)
+        dead.claim('dead', limit=5)
+        dead.close()
+
+        sent = []
+        lock = threading.Lock()
+
+        def deliver(jobs):
+            with lock:
+                sent.extend(job.msg_info['n'] for job in jobs)
+            return [None] * len(jobs)
+
+        queues = [workqueue.SQLiteWorkQueue(self.path) for _ in range(2)]
+        nodes = [workqueue.Senders(q, deliver, workers=2, batch_size=3,
+                                   poll_interval=0.05,
+                                   owner='node{0}'.format(i))
+                 for i, q in enumerate(queues)]
+        for node in nodes:
+            node.start()
+        try:
+            for _ in range(500):
+                if self.queue.stats()['done'] == 50:
+                    break
+                threading.Event().wait(0.01)
+        finally:
+            for node in nodes:
+                node.stop(timeout=5)
+            for q in queues:
+                q.close()
+        self.assertEqual(range(50), sorted(sent))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,400 @@
+"""Work queue shared by several nodes, so that a push accepted by any node
+can be sent by sender threads on any node."""
+
+import collections
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+# A claimed job. `token` identifies the lease, so that a sender whose lease
+# expired, e.g. because it stalled, cannot complete or fail the job after it
+# has been handed to another sender. `group` is set on jobs held to be merged
+# into a digest.
+Job = collections.namedtuple('Job',
+                             ['id', 'token', 'msg_info', 'attempts', 'group'])
+
+QUEUED = 'queued'
+DONE = 'done'
+DEAD = 'dead'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT UNIQUE,
+    group_key TEXT,
+    priority INTEGER NOT NULL DEFAULT 0,
+    repo TEXT,
+    body TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    lease_token TEXT,
+    lease_owner TEXT,
+    last_error TEXT,
+    created REAL NOT NULL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_available ON jobs (state, available_at);
+CREATE INDEX IF NOT EXISTS jobs_group ON jobs (group_key, state);
+"""
+
+
+class SQLiteWorkQueue(object):
+    """Work queue in an SQLite database (WAL mode), for the processes of one
+    host, e.g. the gunicorn workers of a dyno, and for trying out a
+    multi-node setup locally. WAL needs memory shared between the processes
+    using the database, so it must not be put on a network filesystem to
+    share it between hosts.
+
+    Claiming a job leases it to one sender for `lease` seconds. Senders
+    extend the lease while they work on the job; if a sender dies, its
+    lease expires and the job is claimed again. A job that was claimed
+    `max_attempts` times without being completed is marked dead. Completed
+    jobs are kept for `retention` seconds, so that a job put again with the
+    same key in that time is dropped as a duplicate. Dead jobs are kept as
+    long, unless they are put again.
+
+    Jobs that are due are claimed by priority, lowest first, taking turns
+    between repos within a priority, like delivery.FairQueue does.
+    """
+
+    # Done and dead jobs past their retention are purged once every this
+    # many completions.
+    PURGE_INTERVAL = 500
+
+    # Turns between repos are taken among up to this many times as many due
+    # jobs as are claimed.
+    FAIR_WINDOW = 10
+
+    def __init__(self, path, lease=60, max_attempts=8, base_delay=30,
+                 max_delay=3600, retention=86400, fsync=True):
+        self.lease = lease
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._retention = retention
+        self._lock = threading.Lock()
+        self._completed = 0
+
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous={0}'.format(
+            'FULL' if fsync else 'NORMAL'))
+        self._db.executescript(_SCHEMA)
+
+    def put(self, msg_info, key=None, delay=0, group=None, priority=0,
+            repo=None):
+        """Add job for message, to be claimed in `delay` seconds, and return
+        its id. Returns None, without adding it, if a job with the same
+        `key` is queued or was completed within the retention period. A
+        dead job with the same key is replaced. When a job with a `group` is
+        claimed, queued jobs of the same group are claimed along with it,
+        even if their delay has not passed."""
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                if key is not None:
+                    self._db.execute(
+                        'DELETE FROM jobs WHERE key = ? AND state = ?',
+                        (key, DEAD))
+                cursor = self._db.execute(
+                    'INSERT INTO jobs (key, group_key, priority, repo, body, '
+                    'state, available_at, created) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (key, group, priority, repo, json.dumps(msg_info),
+                     QUEUED, now + delay, now))
+                self._db.execute('COMMIT')
+            except sqlite3.IntegrityError:
+                self._db.execute('ROLLBACK')
+                return None
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+        return cursor.lastrowid
+
+    def claim(self, owner, limit=10):
+        """Lease up to `limit` jobs that are due, plus queued jobs of their
+        groups, to `owner`, and return them."""
+        now = time.time()
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                rows = _take_turns(self._db.execute(
+                    'SELECT id, group_key, body, attempts, priority, repo '
+                    'FROM jobs WHERE state = ? AND available_at <= ? '
+                    'ORDER BY priority, available_at, id LIMIT ?',
+                    (QUEUED, now, limit * self.FAIR_WINDOW)), limit)
+                groups = set(row[1] for row in rows if row[1] is not None)
+                ids = set(row[0] for row in rows)
+                for group in sorted(groups):
+                    rows.extend(
+                        row for row in self._db.execute(
+                            'SELECT id, group_key, body, attempts, priority, '
+                            'repo FROM jobs WHERE group_key = ? AND state = ? '
+                            'AND (lease_token IS NULL OR available_at <= ?) '
+                            'ORDER BY id', (group, QUEUED, now))
+                        if row[0] not in ids)
+                jobs = self._lease(rows, owner, now)
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+        return jobs
+
+    def extend(self, jobs):
+        """Renew leases of jobs being worked on. Returns the jobs whose
+        lease had already been lost."""
+        available_at = time.time() + self.lease
+        lost = []
+        with self._lock:
+            for job in jobs:
+                cursor = self._db.execute(
+                    'UPDATE jobs SET available_at = ? '
+                    'WHERE id = ? AND lease_token = ? AND state = ?',
+                    (available_at, job.id, job.token, QUEUED))
+                if cursor.rowcount == 0:
+                    lost.append(job)
+        return lost
+
+    def complete(self, job):
+        """Mark job done. Returns True if it is done, also if it was already
+        completed with this lease, and False if the lease was lost."""
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                'UPDATE jobs SET state = ?, finished = ? '
+                'WHERE id = ? AND lease_token = ? AND state = ?',
+                (DONE, now, job.id, job.token, QUEUED))
+            if cursor.rowcount == 0:
+                row = self._db.execute(
+                    'SELECT state FROM jobs WHERE id = ? AND lease_token = ?',
+                    (job.id, job.token)).fetchone()
+                return row is not None and row[0] == DONE
+
+            self._completed += 1
+            if self._completed % self.PURGE_INTERVAL == 0:
+                self._purge(now)
+        return True
+
+    def fail(self, job, error):
+        """Record failed attempt at job. Schedules a retry with exponential
+        backoff and jitter, or marks the job dead once it has used up its
+        attempts. Returns False if the lease was lost."""
+        error = repr(error)
+        if job.attempts >= self._max_attempts:
+            state, available_at = DEAD, time.time()
+        else:
+            state, available_at = QUEUED, time.time() + self.backoff(
+                job.attempts)
+        with self._lock:
+            cursor = self._db.execute(
+                'UPDATE jobs SET state = ?, available_at = ?, '
+                'lease_token = NULL, last_error = ?, finished = ? '
+                'WHERE id = ? AND lease_token = ? AND state = ?',
+                (state, available_at, error,
+                 available_at if state == DEAD else None, job.id, job.token,
+                 QUEUED))
+        if cursor.rowcount and state == DEAD:
+            logging.error('Giving up on job %s after %d attempts: %s',
+                          job.id, job.attempts, error)
+        return cursor.rowcount > 0
+
+    def backoff(self, attempts):
+        """Returns seconds to wait before retrying after `attempts` failed
+        attempts."""
+        delay = min(self._max_delay, self._base_delay * 2 ** (attempts - 1))
+        return random.uniform(delay / 2.0, delay)
+
+    def stats(self):
+        """Returns dict of number of jobs per state, and of queued jobs
+        that are leased."""
+        now = time.time()
+        counts = dict.fromkeys([QUEUED, 'leased', DONE, DEAD], 0)
+        with self._lock:
+            counts.update(self._db.execute(
+                'SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+            counts['leased'] = self._db.execute(
+                'SELECT COUNT(*) FROM jobs WHERE state = ? AND '
+                'lease_token IS NOT NULL AND available_at > ?',
+                (QUEUED, now)).fetchone()[0]
+        return counts
+
+    def close(self):
+        """Close the database connection."""
+        with self._lock:
+            self._db.close()
+
+    def _lease(self, rows, owner, now):
+        jobs = []
+        for job_id, group, body, attempts, _, _ in rows:
+            if attempts >= self._max_attempts:
+                # Every attempt ended with the lease expiring, e.g. because
+                # the job kills the sender.
+                self._db.execute(
+                    'UPDATE jobs SET state = ?, lease_token = NULL, '
+                    'last_error = ?, finished = ? WHERE id = ?',
+                    (DEAD, 'lease expired', now, job_id))
+                logging.error('Giving up on job %s after %d attempts: lease '
+                              'expired', job_id, attempts)
+                continue
+            token = uuid.uuid4().hex
+            self._db.execute(
+                'UPDATE jobs SET available_at = ?, lease_token = ?, '
+                'lease_owner = ?, attempts = ? WHERE id = ?',
+                (now + self.lease, token, owner, attempts + 1, job_id))
+            jobs.append(Job(job_id, token, json.loads(body), attempts + 1,
+                            group))
+        return jobs
+
+    def _purge(self, now):
+        self._db.execute(
+            'DELETE FROM jobs WHERE state IN (?, ?) AND finished <= ?',
+            (DONE, DEAD, now - self._retention))
+
+
+def _take_turns(rows, limit):
+    """Returns up to `limit` of rows of (id, group, body, attempts, priority,
+    repo), which are ordered by priority, taking turns between repos within
+    each priority. Rows of the same repo and priority keep their order."""
+    turns = collections.Counter()
+    keyed = []
+    for i, row in enumerate(rows):
+        level = (row[4], row[5])
+        keyed.append((row[4], turns[level], i, row))
+        turns[level] += 1
+    keyed.sort()
+    return [row for _, _, _, row in keyed[:limit]]
+
+
+# Work queue classes by URL scheme. Each is created with the rest of the URL
+# and keyword options, and has the methods of SQLiteWorkQueue.
+BACKENDS = {
+    'sqlite': SQLiteWorkQueue,
+}
+
+
+def open_queue(url, **options):
+    """Returns work queue for a URL like "sqlite:///var/spool/jobs.db".
+    Raises ValueError if the scheme is unknown."""
+    scheme, sep, location = url.partition('://')
+    if not sep or scheme not in BACKENDS:
+        raise ValueError('Unknown work queue {0!r}, expected one of: '
+                         '{1}'.format(url, ', '.join(
+                             s + '://...' for s in sorted(BACKENDS))))
+    return BACKENDS[scheme](location, **options)
+
+
+class Senders(object):
+    """Threads that claim jobs from a work queue and send them.
+
+    `deliver_func` is called with a batch of up to `batch_size` jobs and
+    returns a list with the error of each job, or None for each job that was
+    sent. While a batch is being sent, its leases are extended every
+    `heartbeat` seconds. Idle threads poll the queue every `poll_interval`
+    seconds, or as soon as wake() is called.
+    """
+
+    def __init__(self, queue, deliver_func, workers=1, batch_size=10,
+                 poll_interval=1, heartbeat=20, owner=None):
+        self._queue = queue
+        self._deliver_func = deliver_func
+        self._workers = workers
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._heartbeat = heartbeat
+        self._owner = owner
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._in_flight_lock = threading.Lock()
+        self._in_flight = {}
+        self._threads = []
+
+    def start(self):
+        """Start sender threads, and the thread that extends their leases.
+        Calling more than once is a no-op."""
+        if self._threads:
+            return
+        if self._owner is None:
+            self._owner = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        for i in range(self._workers):
+            self._threads.append(threading.Thread(
+                target=self._run, name='sender-{0}'.format(i)))
+        self._threads.append(threading.Thread(target=self._run_heartbeat,
+                                              name='sender-heartbeat'))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def wake(self):
+        """Make an idle sender poll the queue now, e.g. after a put."""
+        self._wakeup.set()
+
+    def stop(self, timeout=None):
+        """Stop claiming jobs and wait up to `timeout` seconds for the
+        batches being sent. Jobs still queued are left to other nodes.
+        Returns False if a batch is still being sent."""
+        self._stop.set()
+        self._wakeup.set()
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None
+                        else max(0, deadline - time.time()))
+        return not any(thread.is_alive() for thread in self._threads)
+
+    def run_once(self):
+        """Claim and send one batch. Returns number of jobs claimed."""
+        jobs = self._queue.claim(self._owner, self._batch_size)
+        if not jobs:
+            return 0
+        with self._in_flight_lock:
+            self._in_flight.update((job.id, job) for job in jobs)
+        try:
+            try:
+                errors = self._deliver_func(jobs)
+            except Exception as e:
+                logging.exception('Failed to send %d job(s).', len(jobs))
+                errors = [e] * len(jobs)
+            for job, error in zip(jobs, errors):
+                if error is None:
+                    done = self._queue.complete(job)
+                else:
+                    done = self._queue.fail(job, error)
+                if not done:
+                    logging.warn('Lease on job %s was lost while it was '
+                                 'being sent, it may be sent twice.', job.id)
+        finally:
+            with self._in_flight_lock:
+                for job in jobs:
+                    self._in_flight.pop(job.id, None)
+        return len(jobs)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except Exception:
+                logging.exception('Failed to claim jobs from work queue.')
+            self._wakeup.wait(self._poll_interval)
+            self._wakeup.clear()
+
+    def _run_heartbeat(self):
+        while not self._stop.wait(self._heartbeat):
+            with self._in_flight_lock:
+                jobs = list(self._in_flight.values())
+            if not jobs:
+                continue
+            try:
+                for job in self._queue.extend(jobs):
+                    logging.warn('Lease on job %s expired before it could '
+                                 'be extended.', job.id)
+            except Exception:
+                logging.exception('Failed to extend leases.')